@@ -55,6 +55,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'payment.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -104,7 +105,53 @@ DATABASES = {
         conn_max_age=600
     )
 }
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    # Test on a file rather than shared-cache memory so concurrent writers wait for
+    # the lock like they do in production instead of failing with "table is locked"
+    DATABASES['default']['TEST'] = {'NAME': os.path.join('db', 'test_db.sqlite3')}
+    # Concurrency profile: WAL lets readers run alongside the writer, write
+    # transactions take the lock up front (BEGIN IMMEDIATE) instead of failing
+    # when they upgrade from a read, and waiting writers retry for `timeout` seconds
+    DATABASES['default']['OPTIONS'] = {
+        'transaction_mode': 'IMMEDIATE',
+        'timeout': env.float('SQLITE_BUSY_TIMEOUT', default=20.0),
+        'init_command': (
+            'PRAGMA journal_mode=WAL;'
+            'PRAGMA synchronous=NORMAL;'
+            f"PRAGMA mmap_size={env.int('SQLITE_MMAP_SIZE', default=128 * 1024 * 1024)};"
+            # Negative cache_size is in KiB
+            f"PRAGMA cache_size=-{env.int('SQLITE_CACHE_SIZE_KB', default=64 * 1024)};"
+            'PRAGMA temp_store=MEMORY;'
+        ),
+    }
+
+# Report, export and rollup reads go to the `reports` alias when there is one:
+# a replica given by REPORTS_DATABASE_URL or, on SQLite, a read-only connection
+# to the same file (under WAL its scans never hold up checkout writes)
+REPORTS_DATABASE_URL = env('REPORTS_DATABASE_URL', default='')
+if REPORTS_DATABASE_URL:
+    DATABASES['reports'] = dj_database_url.parse(REPORTS_DATABASE_URL, conn_max_age=600)
+elif DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3' and env.bool('SQLITE_READ_ONLY_REPORTS', default=True):
+    DATABASES['reports'] = {
+        **DATABASES['default'],
+        'NAME': f"file:{DATABASES['default']['NAME']}?mode=ro",
+        'OPTIONS': {
+            'timeout': DATABASES['default']['OPTIONS']['timeout'],
+            'init_command': DATABASES['default']['OPTIONS']['init_command'].replace('PRAGMA journal_mode=WAL;', ''),
+        },
+    }
+if 'reports' in DATABASES:
+    # Tests read the reports alias from the default test database
+    DATABASES['reports']['TEST'] = {'MIRROR': 'default'}
+DATABASE_ROUTERS = ['payment.routers.ReportsRouter']
+
 
+# Cache (shared status responses etc.); set CACHE_URL, e.g. redis://..., to share it between workers
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+# The locmem and dummy backends are private to each process
+CACHE_IS_SHARED = CACHES['default']['BACKEND'].rsplit('.', 1)[-1] not in ('LocMemCache', 'DummyCache')
 
 
 # Password validation
@@ -173,8 +220,72 @@ MESSAGE_TAGS = {
 INTASEND_PUBLISHABLE_KEY = env('INTASEND_PUBLISHABLE_KEY')
 INTASEND_SECRET_KEY = env('INTASEND_SECRET_KEY')
 INTASEND_TEST_MODE = env.bool('INTASEND_TEST_MODE', default=True)
+# Override the API root (e.g. a local stub gateway); empty uses the SDK's sandbox/live URL
+INTASEND_API_BASE_URL = env('INTASEND_API_BASE_URL', default='')
+# Keep-alive connections kept per worker process, and request timeouts in seconds
+INTASEND_POOL_SIZE = env.int('INTASEND_POOL_SIZE', default=10)
+INTASEND_CONNECT_TIMEOUT = env.float('INTASEND_CONNECT_TIMEOUT', default=5.0)
+INTASEND_READ_TIMEOUT = env.float('INTASEND_READ_TIMEOUT', default=30.0)
+# Per-operation read deadlines; a slow Intasend can't hold a worker longer than this
+INTASEND_CHECKOUT_TIMEOUT = env.float('INTASEND_CHECKOUT_TIMEOUT', default=10.0)
+INTASEND_STATUS_TIMEOUT = env.float('INTASEND_STATUS_TIMEOUT', default=5.0)
+# After this many consecutive gateway failures, calls fail fast for the reset timeout (seconds)
+INTASEND_CIRCUIT_FAILURE_THRESHOLD = env.int('INTASEND_CIRCUIT_FAILURE_THRESHOLD', default=5)
+INTASEND_CIRCUIT_RESET_TIMEOUT = env.float('INTASEND_CIRCUIT_RESET_TIMEOUT', default=30.0)
+# Seconds to cache status responses: short while pending, long once complete/failed
+INTASEND_STATUS_CACHE_PENDING_TTL = env.int('INTASEND_STATUS_CACHE_PENDING_TTL', default=5)
+INTASEND_STATUS_CACHE_FINAL_TTL = env.int('INTASEND_STATUS_CACHE_FINAL_TTL', default=3600)
+# Queue callbacks for the process_callbacks worker instead of handling them inline
+PAYMENT_CALLBACK_ASYNC = env.bool('PAYMENT_CALLBACK_ASYNC', default=False)
+# Route checkout, callback and status to the async views (for uvicorn/daphne via asgi.py)
+PAYMENT_ASYNC_VIEWS = env.bool('PAYMENT_ASYNC_VIEWS', default=False)
+# Push status changes to pending status pages over server-sent events. Only under
+# ASGI (PAYMENT_ASYNC_VIEWS), where an open stream doesn't hold a worker, and with a
+# shared cache so changes made by other processes reach it; otherwise the page
+# keeps its refresh button
+PAYMENT_STATUS_STREAM = PAYMENT_ASYNC_VIEWS and CACHE_IS_SHARED
+# Status page event stream: seconds between cache checks for changes made by other
+# workers, between heartbeats, and before the stream ends (the browser reconnects)
+PAYMENT_STREAM_POLL_INTERVAL = env.float('PAYMENT_STREAM_POLL_INTERVAL', default=1.0)
+PAYMENT_STREAM_HEARTBEAT = env.float('PAYMENT_STREAM_HEARTBEAT', default=15.0)
+PAYMENT_STREAM_MAX_SECONDS = env.float('PAYMENT_STREAM_MAX_SECONDS', default=300.0)
+PAYMENT_STREAM_RETRY_MS = env.int('PAYMENT_STREAM_RETRY_MS', default=3000)
+# Bulk checkout endpoint: rows per request, gateway calls in flight and per second (0 = unlimited).
+# The whole batch runs inside the request, so rows / rate must stay well inside gunicorn's
+# 30s worker timeout (200 rows at 20/s is 10s); larger batches go through the command
+BULK_CHECKOUT_MAX_ROWS = env.int('BULK_CHECKOUT_MAX_ROWS', default=200)
+BULK_CHECKOUT_CONCURRENCY = env.int('BULK_CHECKOUT_CONCURRENCY', default=8)
+BULK_CHECKOUT_RATE = env.float('BULK_CHECKOUT_RATE', default=20)
+# /metrics answers "Authorization: Bearer <token>" with this token set, and staff users
+METRICS_TOKEN = env.str('METRICS_TOKEN', default='')
+# Serve report statistics from the daily rollup table (rebuild with `rebuild_rollups`)
+PAYMENT_REPORTS_USE_ROLLUP = env.bool('PAYMENT_REPORTS_USE_ROLLUP', default=True)
+# Rows per page in the reports table (?page_size= may ask for up to the maximum)
+PAYMENT_REPORTS_PAGE_SIZE = env.int('PAYMENT_REPORTS_PAGE_SIZE', default=50)
+PAYMENT_REPORTS_MAX_PAGE_SIZE = env.int('PAYMENT_REPORTS_MAX_PAGE_SIZE', default=500)
+# Seconds to reuse a report page's stats and rows for identical filters (0 = off).
+# A payment change retires cached pages at once only for processes sharing the cache,
+# so this is off by default unless CACHE_URL is shared. Pages can still be up to this
+# many seconds stale: a page built from a lagging reports replica just after a change
+# is cached under the new generation
+PAYMENT_REPORTS_CACHE_TTL = env.int('PAYMENT_REPORTS_CACHE_TTL', default=60 if CACHE_IS_SHARED else 0)
+# Days of per-minute completed payment buckets to keep for rolling-window metrics;
+# windows reaching back further are counted from whole hours
+PAYMENT_WINDOW_MINUTE_RETENTION_DAYS = env.int('PAYMENT_WINDOW_MINUTE_RETENTION_DAYS', default=31)
+# Parquet/Arrow exports stop at rows updated this many seconds ago, so payments still
+# being written are picked up by the next incremental export rather than skipped
+PAYMENT_EXPORT_LAG_SECONDS = env.int('PAYMENT_EXPORT_LAG_SECONDS', default=60)
 
 # Logging configuration
+LOG_LEVEL = env.str('LOG_LEVEL', default='DEBUG' if DEBUG else 'INFO')
+# Gateway payloads longer than this are truncated in the JSON log
+LOG_PAYLOAD_MAX_CHARS = env.int('LOG_PAYLOAD_MAX_CHARS', default=2000)
+# Fraction of high-volume debug events to keep, by ``event`` name
+LOG_SAMPLE_RATES = {
+    'gateway_response': env.float('LOG_GATEWAY_RESPONSE_SAMPLE_RATE', default=1.0 if DEBUG else 0.1),
+    'callback_params': env.float('LOG_CALLBACK_PARAMS_SAMPLE_RATE', default=1.0 if DEBUG else 0.1),
+}
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -187,6 +298,16 @@ LOGGING = {
             'format': '{levelname} {message}',
             'style': '{',
         },
+        'json': {
+            '()': 'payment.log.JsonFormatter',
+            'max_field_chars': LOG_PAYLOAD_MAX_CHARS,
+        },
+    },
+    'filters': {
+        'sampling': {
+            '()': 'payment.log.SamplingFilter',
+            'rates': LOG_SAMPLE_RATES,
+        },
     },
     'handlers': {
         'console': {
@@ -198,18 +319,25 @@ LOGGING = {
             'level': 'DEBUG',
             'class': 'logging.FileHandler',
             'filename': os.path.join(BASE_DIR, 'debug.log'),
-            'formatter': 'verbose',
+            'formatter': 'json',
+        },
+        # Console and file output happen on a background thread; handlers
+        # are configured in name order, so the targets exist by now
+        'queue': {
+            '()': 'payment.log.QueueListenerHandler',
+            'handlers': ['cfg://handlers.console', 'cfg://handlers.file'],
+            'filters': ['sampling'],
         },
     },
     'loggers': {
         'django': {
-            'handlers': ['console', 'file'],
+            'handlers': ['queue'],
             'level': 'INFO',
             'propagate': True,
         },
         'payment': {
-            'handlers': ['console', 'file'],
-            'level': 'DEBUG',
+            'handlers': ['queue'],
+            'level': LOG_LEVEL,
             'propagate': True,
         },
     },
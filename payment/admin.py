@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Payment
+from .models import CallbackEvent, Payment
 
 @admin.register(Payment)
 class PaymentAdmin(admin.ModelAdmin):
@@ -7,3 +7,11 @@ class PaymentAdmin(admin.ModelAdmin):
     list_filter = ('status', 'currency')
     search_fields = ('reference', 'checkout_id')
     readonly_fields = ('created_at', 'updated_at')
+
+
+@admin.register(CallbackEvent)
+class CallbackEventAdmin(admin.ModelAdmin):
+    list_display = ('id', 'checkout_id', 'status', 'state', 'attempts', 'received_at', 'processed_at')
+    list_filter = ('state',)
+    search_fields = ('checkout_id',)
+    readonly_fields = ('received_at', 'processed_at', 'claimed_at')
@@ -0,0 +1,204 @@
+import datetime
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404, StreamingHttpResponse
+from django.shortcuts import redirect, render
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+
+from .breaker import GatewayUnavailable
+from .callbacks import (COMPLETE_STATES, FAILED_STATES, areconcile_callback, enqueue_callback, find_payment,
+                        parse_status_response)
+from .gateway import aget_cached_status, gateway_available, get_async_intasend_service
+from .models import Payment
+from .reports import bump_reports_generation
+from .stream import status_events, status_version_key
+from .transitions import set_payment_method, transition_payment
+from .checkout import checkout_error, checkout_invoice_id, new_reference
+from .views import (CALLBACK_QUEUED_MESSAGE, GATEWAY_UNAVAILABLE_MESSAGE, callback_parameters, callback_result,
+                    callback_unavailable, form_checkout_arguments, payment_login_required)
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Rendering runs context processors that touch the session and user, which
+# are synchronous database lookups
+arender = sync_to_async(render)
+
+
+async def create_checkout(request):
+    """Async version of ``views.create_checkout``"""
+    if request.method != 'POST':
+        return redirect('home')
+
+    try:
+        amount = float(request.POST.get('amount', 0))
+        if amount <= 0:
+            return await arender(request, 'payment/home.html', {'error': 'Please enter a valid amount'})
+
+        if not gateway_available():
+            logger.warning("Intasend circuit open, refusing new checkout")
+            return await arender(request, 'payment/home.html', {'error': GATEWAY_UNAVAILABLE_MESSAGE}, status=503)
+
+        logger.info(f"Processing payment attempt for amount: {amount}")
+
+        reference = new_reference()
+        payment = await Payment.objects.acreate(
+            amount=amount,
+            reference=reference,
+            payer_phone=request.POST.get('phone_number', ''),
+            payer_email=request.POST.get('email', ''),
+            payer_name=f"{request.POST.get('first_name', '')} {request.POST.get('last_name', '')}".strip()
+        )
+        logger.info(f"Created payment record with reference: {reference}")
+
+        service = get_async_intasend_service()
+        response = await service.collect.checkout(**form_checkout_arguments(request, amount, reference))
+        logger.debug("Checkout response", extra={'event': 'gateway_response', 'payload': response})
+
+        if 'url' not in response:
+            error_msg = checkout_error(response)
+            logger.error(f"Payment creation failed: {error_msg}")
+            return await arender(request, 'payment/home.html', {'error': error_msg})
+
+        invoice_id = checkout_invoice_id(response)
+        if invoice_id:
+            logger.info(f"Payment checkout created successfully: {invoice_id}")
+        else:
+            logger.warning("No invoice ID found in response, using reference as checkout_id")
+        # checkout_id isn't tracked by the rollup, so a plain UPDATE is enough;
+        # it skips the save signal, so retire cached report pages here
+        await Payment.objects.filter(id=payment.id).aupdate(
+            checkout_id=invoice_id or reference, updated_at=timezone.now()
+        )
+        await sync_to_async(bump_reports_generation)()
+        return redirect(response.get('url'))
+
+    except Exception as e:
+        error = f"Error: {str(e)}"
+        logger.exception(f"Exception in payment processing: {error}")
+        return await arender(request, 'payment/home.html', {'error': error})
+
+
+@csrf_exempt
+async def payment_callback(request):
+    """Async version of ``views.payment_callback``"""
+    logger.info(f"Payment callback received: {request.method}")
+
+    if request.method not in ('GET', 'POST'):
+        logger.warning(f"Invalid callback request method: {request.method}")
+        return await arender(request, 'payment/result.html', {'success': False, 'message': 'Invalid request method'})
+
+    checkout_id, status = callback_parameters(request)
+    logger.info(f"Processing callback for checkout ID: {checkout_id}, status: {status}")
+
+    # If we still don't have a checkout ID, check if we can find a payment by reference
+    if not checkout_id:
+        reference = request.GET.get('reference', '') or request.POST.get('reference', '')
+        if reference:
+            payment = await Payment.objects.filter(reference=reference).afirst()
+            if payment:
+                checkout_id = payment.checkout_id or reference
+                logger.info(f"Found payment by reference: {reference}, using checkout_id: {checkout_id}")
+
+    if not checkout_id:
+        logger.error("Invalid callback: No checkout ID provided")
+        return await arender(request, 'payment/result.html', {
+            'success': False,
+            'message': 'Invalid request - missing checkout ID'
+        })
+
+    # Fast-ack mode: persist the callback and let the worker talk to Intasend
+    if settings.PAYMENT_CALLBACK_ASYNC:
+        await sync_to_async(enqueue_callback)(checkout_id, status, {**request.GET.dict(), **request.POST.dict()})
+        return await arender(request, 'payment/result.html', {'success': False, 'message': CALLBACK_QUEUED_MESSAGE})
+    if not gateway_available():
+        return await sync_to_async(callback_unavailable)(request)
+
+    try:
+        payment = await sync_to_async(find_payment)(checkout_id)
+        if not payment:
+            logger.error(f"Payment record not found for checkout ID: {checkout_id}")
+            return await arender(request, 'payment/result.html', {
+                'success': False,
+                'message': f'Payment record not found for ID: {checkout_id}'
+            })
+
+        payment_status = await areconcile_callback(payment, checkout_id, status)
+        return await arender(request, 'payment/result.html', callback_result(payment, payment_status))
+
+    except GatewayUnavailable:
+        return await sync_to_async(callback_unavailable)(request)
+
+    except Exception as e:
+        logger.exception(f"Error processing callback: {str(e)}")
+        return await arender(request, 'payment/result.html', {
+            'success': False,
+            'message': f'Error processing payment: {str(e)}'
+        })
+
+
+@payment_login_required
+async def payment_status(request, payment_id):
+    """Async version of ``views.payment_status``"""
+    try:
+        payment = await Payment.objects.aget(id=payment_id)
+    except Payment.DoesNotExist:
+        logger.error(f"Payment record not found for ID: {payment_id}")
+        return redirect('home')
+    logger.info(f"Checking status for payment ID: {payment_id}")
+
+    # In sandbox, a payment still pending after a minute is treated as successful
+    if settings.INTASEND_TEST_MODE and payment.status == Payment.PENDING:
+        if payment.created_at < timezone.now() - datetime.timedelta(minutes=1):
+            logger.info(f"Sandbox mode: Simulating success for older pending payment")
+            await sync_to_async(transition_payment)(payment, Payment.COMPLETE)
+            return await arender(request, 'payment/status.html', {'payment': payment, 'sandbox_mode': True})
+
+    gateway_unavailable = False
+    if payment.checkout_id and payment.status == Payment.PENDING:
+        try:
+            logger.info(f"Checking payment status with Intasend for checkout ID: {payment.checkout_id}")
+            status_response = await aget_cached_status(payment.checkout_id)
+            logger.debug("Status response", extra={'event': 'gateway_response', 'payload': status_response})
+
+            payment_status, payment_method = parse_status_response(status_response)
+            logger.info(f"Detected payment status: {payment_status}")
+
+            if payment_status in COMPLETE_STATES:
+                await sync_to_async(transition_payment)(payment, Payment.COMPLETE, payment_method)
+            elif payment_status in FAILED_STATES:
+                await sync_to_async(transition_payment)(payment, Payment.FAILED, payment_method)
+            else:
+                await sync_to_async(set_payment_method)(payment, payment_method)
+        except GatewayUnavailable as e:
+            logger.warning(f"Showing stored status for payment {payment_id}: {str(e)}")
+            gateway_unavailable = True
+        except Exception as e:
+            logger.error(f"Error checking payment status: {str(e)}")
+
+    return await arender(request, 'payment/status.html', {
+        'payment': payment,
+        'sandbox_mode': settings.INTASEND_TEST_MODE,
+        'gateway_unavailable': gateway_unavailable,
+        'status_stream': settings.PAYMENT_STATUS_STREAM,
+    })
+
+
+@payment_login_required
+async def payment_events(request, payment_id):
+    """Server-sent events with the payment's status, pushed when a callback or check changes it"""
+    # Read the version before the status so a change in between isn't missed
+    version = await cache.aget(status_version_key(payment_id))
+    status = await Payment.objects.filter(id=payment_id).values_list('status', flat=True).afirst()
+    if status is None:
+        raise Http404("Payment not found")
+
+    response = StreamingHttpResponse(status_events(payment_id, status, version), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Don't let nginx hold events back in its buffer
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,82 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+class GatewayUnavailable(Exception):
+    """Raised instead of calling Intasend while the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Stops calling a failing dependency for a while, shared by every thread in the process.
+
+    Closed: calls go through; ``INTASEND_CIRCUIT_FAILURE_THRESHOLD``
+    consecutive failures open the circuit. Open: calls fail at once with
+    ``GatewayUnavailable`` until ``INTASEND_CIRCUIT_RESET_TIMEOUT`` seconds
+    have passed. Half-open: a single probe call is let through; success
+    closes the circuit, failure opens it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def retry_in(self):
+        """Seconds until an open circuit lets a probe through"""
+        return max(0.0, self.opened_at + settings.INTASEND_CIRCUIT_RESET_TIMEOUT - time.monotonic())
+
+    def available(self):
+        """Whether a call made now would be let through (without claiming the probe)"""
+        return self.state == self.CLOSED or (self.state == self.OPEN and not self.retry_in())
+
+    def before_call(self):
+        """Claim permission for one call, or raise GatewayUnavailable"""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and not self.retry_in():
+                self.state = self.HALF_OPEN
+                logger.info(f"Circuit {self.name} half-open, sending a probe call")
+                return
+            retry_in = self.retry_in()
+        raise GatewayUnavailable(f"{self.name} is unavailable; retrying in {retry_in:.0f}s")
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                logger.info(f"Circuit {self.name} closed")
+            self.reset()
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (
+                    self.state == self.CLOSED and self.failures >= settings.INTASEND_CIRCUIT_FAILURE_THRESHOLD):
+                logger.warning(f"Circuit {self.name} open after {self.failures} failure(s)")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        """The claimed call was abandoned (e.g. cancelled) without an outcome"""
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                # Let the next caller probe straight away
+                self.state = self.OPEN
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+        self.reset()
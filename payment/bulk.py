@@ -0,0 +1,177 @@
+import csv
+import io
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction
+from django.utils import timezone
+
+from .checkout import checkout_arguments, checkout_error, checkout_invoice_id, new_reference
+from .gateway import get_intasend_service
+from .models import Payment
+from .reconcile import RateLimiter
+from .reports import bump_reports_generation
+from .rollups import apply_rollup_deltas, payment_deltas, rollup_state
+from .stream import publish_status_change
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Columns a batch row may have; only amount is required
+BATCH_FIELDS = ('amount', 'currency', 'phone_number', 'email', 'first_name', 'last_name')
+
+REPORT_FIELDS = ('row', 'status', 'reference', 'checkout_id', 'url', 'error')
+
+
+def parse_batch(data, format='csv'):
+    """Rows of a CSV (with a header line) or JSON batch as a list of dicts.
+
+    A JSON batch is either a list of objects or ``{"payments": [...]}``.
+    Raises ValueError if the batch can't be read.
+    """
+    if format == 'json':
+        try:
+            rows = json.loads(data)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON: {str(e)}")
+        if isinstance(rows, dict):
+            rows = rows.get('payments')
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise ValueError("JSON batch must be a list of objects")
+        return rows
+    if format == 'csv':
+        return list(csv.DictReader(io.StringIO(data)))
+    raise ValueError(f"Unsupported batch format: {format}")
+
+
+def clean_row(row):
+    """Validate one batch row; returns (Payment fields, checkout fields) or raises ValueError"""
+    try:
+        amount = Decimal(str(row.get('amount') or '').strip())
+    except InvalidOperation:
+        raise ValueError(f"Invalid amount: {row.get('amount')!r}")
+    if not amount.is_finite() or amount <= 0:
+        raise ValueError(f"Invalid amount: {row.get('amount')!r}")
+    amount = amount.quantize(Decimal('0.01'))
+
+    # JSON batches may carry numbers where CSV has strings
+    currency = str(row.get('currency') or 'KES').strip().upper()
+    if len(currency) != 3 or not currency.isalpha():
+        raise ValueError(f"Invalid currency: {currency!r}")
+
+    details = {field: str(row.get(field) or '').strip() for field in BATCH_FIELDS[2:]}
+    fields = {
+        'amount': amount,
+        'currency': currency,
+        'payer_phone': details['phone_number'],
+        'payer_email': details['email'],
+        'payer_name': f"{details['first_name']} {details['last_name']}".strip(),
+    }
+    return fields, details
+
+
+def start_checkout(service, limiter, payment, details, redirect_url):
+    """Create the Intasend checkout for one inserted payment; returns the response"""
+    limiter.wait()
+    return service.collect.checkout(**checkout_arguments(
+        float(payment.amount), payment.reference, currency=payment.currency,
+        redirect_url=redirect_url, **details,
+    ))
+
+
+def write_results(payments, failed):
+    """Save checkout IDs, and mark ``failed`` payments FAILED, in one transaction"""
+    now = timezone.now()
+    deltas = {}
+    for payment in failed:
+        old_state = rollup_state(payment)
+        payment.status = Payment.FAILED
+        payment_deltas(old_state, rollup_state(payment), deltas)
+    for payment in payments:
+        payment.updated_at = now
+    with transaction.atomic():
+        # Only the failed rows get a status; a callback may already have settled the others
+        Payment.objects.bulk_update(payments, ['checkout_id', 'updated_at'])
+        Payment.objects.bulk_update(failed, ['status'])
+        # bulk_update skips the save signals, so keep the rollup and report cache in step here
+        apply_rollup_deltas(deltas)
+        bump_reports_generation()
+        publish_status_change(*[payment.id for payment in failed])
+    for payment in payments:
+        payment._rollup_state = rollup_state(payment)
+
+
+def create_bulk_checkouts(rows, redirect_url=None, concurrency=8, rate=20, batch_size=500):
+    """Insert a payment per valid row and start its Intasend checkout.
+
+    Rows are handled ``batch_size`` at a time. Each batch is inserted with
+    one ``bulk_create``, using references generated up front. Its checkouts
+    are requested with up to ``concurrency`` calls in flight, at most
+    ``rate`` per second. The checkout IDs are then written back with one
+    ``bulk_update``. A payment whose checkout could not be created is
+    marked FAILED. Checkouts are never retried, so a slow reply can't turn
+    into a second invoice. Returns one report dict per input row, in input
+    order.
+    """
+    service = get_intasend_service()
+    limiter = RateLimiter(rate)
+    report = []
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for start in range(0, len(rows), batch_size):
+            batch = []
+            for number, row in enumerate(rows[start:start + batch_size], start + 1):
+                try:
+                    fields, details = clean_row(row)
+                except ValueError as e:
+                    report.append({'row': number, 'status': 'invalid', 'error': str(e)})
+                    continue
+                entry = {'row': number, 'status': 'pending', 'reference': new_reference()}
+                report.append(entry)
+                batch.append((entry, Payment(reference=entry['reference'], **fields), details))
+            if not batch:
+                continue
+
+            payments = [payment for _, payment, _ in batch]
+            with transaction.atomic():
+                Payment.objects.bulk_create(payments)
+                # bulk_create skips the save signals, so keep the rollup and report cache in step here
+                deltas = {}
+                for payment in payments:
+                    payment_deltas(None, rollup_state(payment), deltas)
+                    payment._rollup_state = rollup_state(payment)
+                apply_rollup_deltas(deltas)
+                bump_reports_generation()
+
+            futures = [
+                executor.submit(start_checkout, service, limiter, payment, details, redirect_url)
+                for _, payment, details in batch
+            ]
+            failed = []
+            for (entry, payment, _), future in zip(batch, futures):
+                try:
+                    response = future.result()
+                    if 'url' not in response:
+                        raise ValueError(checkout_error(response))
+                except Exception as e:
+                    logger.error(f"Bulk checkout failed for {payment.reference}: {str(e)}")
+                    entry.update(status='failed', error=str(e))
+                    failed.append(payment)
+                    continue
+                payment.checkout_id = checkout_invoice_id(response) or payment.reference
+                entry.update(status='created', checkout_id=payment.checkout_id, url=response['url'])
+
+            write_results(payments, failed)
+            logger.info(f"Bulk checkout batch of {len(batch)}: {len(batch) - len(failed)} created, {len(failed)} failed")
+
+    return report
+
+
+def summarize(report):
+    """Count report rows by status"""
+    totals = {'created': 0, 'failed': 0, 'invalid': 0}
+    for entry in report:
+        totals[entry['status']] += 1
+    return totals
@@ -0,0 +1,208 @@
+import datetime
+import logging
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .breaker import GatewayUnavailable
+from .classifier import classify_payment_method
+from .gateway import (COMPLETE_STATES, FAILED_STATES, GATEWAY_FAILURES, PENDING_STATES, aget_cached_status,
+                      gateway_available, get_cached_status)
+from .models import CallbackEvent, Payment
+from .transitions import TERMINAL_STATUSES, transition_payment
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+def find_payment(checkout_id):
+    """Find the payment a callback refers to by checkout_id, falling back to reference"""
+    try:
+        payment = Payment.objects.get(checkout_id=checkout_id)
+        logger.info(f"Found payment record by checkout_id: {payment.id}")
+        return payment
+    except Payment.DoesNotExist:
+        # Try to find by reference if checkout_id lookup fails
+        payment = Payment.objects.filter(reference=checkout_id).first()
+        if payment:
+            logger.info(f"Found payment record by reference: {payment.id}")
+        return payment
+
+
+def parse_status_response(status_response):
+    """Extract the normalized state and payment method from an Intasend status response"""
+    payment_status = None
+
+    # Extract payment status - handle different response formats
+    if 'state' in status_response:
+        payment_status = status_response.get('state', '').lower()
+    elif 'status' in status_response:
+        payment_status = status_response.get('status', '').lower()
+
+    return payment_status, classify_payment_method(status_response)
+
+
+def reconcile_callback(payment, checkout_id, status='', queued=False):
+    """Check a callback against Intasend and record the outcome on the payment.
+
+    ``status`` is the state reported in the callback itself and is only used
+    when the gateway does not return one. Returns the normalized status.
+    Once a payment is complete or failed, repeated callbacks return its
+    status without calling the gateway or writing anything. With ``queued``
+    a gateway failure is raised instead, so the worker retries the callback.
+    """
+    if payment.status in TERMINAL_STATUSES:
+        logger.info(f"Payment {payment.id} is already {payment.status.upper()}, ignoring repeated callback")
+        return payment.status
+
+    status_response = None
+    # Get payment status from Intasend
+    try:
+        logger.info(f"Checking payment status with Intasend for invoice ID: {checkout_id}")
+        # A callback usually means the state just moved on, so don't trust a cached pending reply
+        status_response = get_cached_status(checkout_id, refresh_pending=True)
+    except GatewayUnavailable:
+        # Don't settle on the callback's own (unverified) status; the caller queues it for later
+        raise
+    except Exception as e:
+        if queued and isinstance(e, GATEWAY_FAILURES):
+            raise
+        logger.error(f"Error getting status from API: {str(e)}")
+
+    return record_callback_status(payment, status_response, status)
+
+
+async def areconcile_callback(payment, checkout_id, status=''):
+    """Async version of ``reconcile_callback`` using the async gateway client"""
+    if payment.status in TERMINAL_STATUSES:
+        logger.info(f"Payment {payment.id} is already {payment.status.upper()}, ignoring repeated callback")
+        return payment.status
+
+    status_response = None
+    try:
+        logger.info(f"Checking payment status with Intasend for invoice ID: {checkout_id}")
+        status_response = await aget_cached_status(checkout_id, refresh_pending=True)
+    except GatewayUnavailable:
+        raise
+    except Exception as e:
+        logger.error(f"Error getting status from API: {str(e)}")
+
+    return await sync_to_async(record_callback_status)(payment, status_response, status)
+
+
+def record_callback_status(payment, status_response, status=''):
+    """Apply a gateway status response (None if the call failed) to the payment; returns the status"""
+    payment_status = None
+    payment_method = Payment.UNKNOWN
+
+    if status_response is not None:
+        logger.debug("Status response", extra={'event': 'gateway_response', 'payload': status_response})
+        payment_status, payment_method = parse_status_response(status_response)
+
+    logger.info(f"Detected payment status from API: {payment_status}")
+    logger.info(f"Detected payment method: {payment_method}")
+
+    # If no status from API, use the one from URL parameters
+    if not payment_status and status:
+        payment_status = status.lower()
+        logger.info(f"Using status from URL: {payment_status}")
+
+    # Handle sandbox mode with missing status
+    if settings.INTASEND_TEST_MODE and not payment_status:
+        logger.info("Sandbox mode: No status detected, simulating success")
+        payment_status = 'success'
+
+    if payment_status in COMPLETE_STATES:
+        transition_payment(payment, Payment.COMPLETE, payment_method)
+    elif payment_status in FAILED_STATES:
+        transition_payment(payment, Payment.FAILED, payment_method)
+    elif payment_status in PENDING_STATES:
+        logger.info(f"Payment is still PENDING")
+    else:
+        # No verified outcome (e.g. the gateway call failed): FAILED is final, so leave
+        # the payment pending for a later callback or status check to settle
+        logger.warning(f"Unrecognised status {payment_status!r} for payment {payment.id}, leaving it PENDING")
+
+    return payment_status
+
+
+def enqueue_callback(checkout_id, status, payload):
+    """Durably queue a callback for the worker and return immediately"""
+    event = CallbackEvent.objects.create(checkout_id=checkout_id, status=status, payload=payload)
+    logger.info(f"Queued callback {event.id} for checkout ID: {checkout_id}")
+    return event
+
+
+def requeue_stale_callbacks(timeout):
+    """Put back callbacks claimed by a worker that died before finishing them"""
+    cutoff = timezone.now() - datetime.timedelta(seconds=timeout)
+    return CallbackEvent.objects.filter(
+        state=CallbackEvent.PROCESSING, claimed_at__lt=cutoff
+    ).update(state=CallbackEvent.QUEUED, claim_token='')
+
+
+def claim_callbacks(limit, retry_delay=0):
+    """Atomically claim up to ``limit`` queued callbacks for this worker.
+
+    The claim is a single conditional UPDATE, so several workers can drain
+    the queue at once without picking up the same event. Events that were
+    tried before wait ``retry_delay`` seconds from their last claim.
+    """
+    retry_before = timezone.now() - datetime.timedelta(seconds=retry_delay)
+    ids = list(
+        CallbackEvent.objects.filter(state=CallbackEvent.QUEUED)
+        .filter(Q(claimed_at__isnull=True) | Q(claimed_at__lte=retry_before))
+        .order_by('id').values_list('id', flat=True)[:limit]
+    )
+    if not ids:
+        return []
+    token = uuid.uuid4().hex
+    CallbackEvent.objects.filter(id__in=ids, state=CallbackEvent.QUEUED).update(
+        state=CallbackEvent.PROCESSING,
+        claim_token=token,
+        claimed_at=timezone.now(),
+        attempts=F('attempts') + 1,
+    )
+    return list(CallbackEvent.objects.filter(claim_token=token).order_by('id'))
+
+
+def process_callback_event(event, max_attempts):
+    """Reconcile one queued callback and record the result on the event"""
+    try:
+        payment = find_payment(event.checkout_id)
+        if not payment:
+            raise LookupError(f"Payment record not found for checkout ID: {event.checkout_id}")
+        reconcile_callback(payment, event.checkout_id, event.status, queued=True)
+    except Exception as e:
+        logger.error(f"Error processing queued callback {event.id}: {str(e)}")
+        event.last_error = str(e)
+        if isinstance(e, GatewayUnavailable):
+            # An open circuit says nothing about this callback, so give back the attempt claiming took
+            event.attempts -= 1
+        event.state = CallbackEvent.FAILED if event.attempts >= max_attempts else CallbackEvent.QUEUED
+        event.claim_token = ''
+        event.save(update_fields=['state', 'attempts', 'last_error', 'claim_token'])
+        return False
+
+    event.state = CallbackEvent.DONE
+    event.processed_at = timezone.now()
+    event.save(update_fields=['state', 'processed_at'])
+    return True
+
+
+def drain_callback_queue(batch_size=50, max_attempts=5, retry_delay=10):
+    """Process one batch of queued callbacks; returns how many were claimed.
+
+    Nothing is claimed while the Intasend circuit is open. A callback that
+    failed waits ``retry_delay`` seconds before its next attempt, so one
+    that arrives before its checkout ID is saved isn't retried to exhaustion.
+    """
+    if not gateway_available():
+        return 0
+    events = claim_callbacks(batch_size, retry_delay)
+    for event in events:
+        process_callback_event(event, max_attempts)
+    return len(events)
@@ -0,0 +1,58 @@
+import json
+import logging
+import uuid
+
+from django.conf import settings
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+def new_reference():
+    """A fresh payment reference, generated before the row is inserted"""
+    return f"payment-{uuid.uuid4().hex[:12]}"
+
+
+def format_phone_number(phone_number):
+    """Ensure phone number has country code for sandbox"""
+    if settings.INTASEND_TEST_MODE and phone_number and not phone_number.startswith('+'):
+        if not phone_number.startswith('254'):
+            phone_number = '254' + phone_number.lstrip('0')
+            logger.info(f"Formatted phone number for sandbox: {phone_number}")
+    return phone_number
+
+
+def checkout_arguments(amount, reference, phone_number='', email='', first_name='', last_name='',
+                       currency='KES', redirect_url=None):
+    """Keyword arguments for ``collect.checkout``"""
+    phone_number = format_phone_number(phone_number)
+    logger.info(f"Calling Intasend API with: phone={phone_number}, email={email}, amount={amount}, reference={reference}")
+    return {
+        'phone_number': phone_number,
+        'email': email,
+        'amount': amount,
+        'currency': currency,
+        'comment': "Payment via Django app",
+        'first_name': first_name,
+        'last_name': last_name,
+        'api_ref': reference,
+        'redirect_url': redirect_url,
+    }
+
+
+def checkout_invoice_id(response):
+    """The invoice ID in a checkout response, or None"""
+    if 'invoice' in response and isinstance(response['invoice'], dict):
+        return response['invoice'].get('id', '')
+    return response.get('id')
+
+
+def checkout_error(response):
+    """Error message to show for a checkout response without a URL"""
+    if 'errors' in response:
+        return f"API Error: {json.dumps(response['errors'])}"
+    elif 'message' in response:
+        return f"API Error: {response['message']}"
+    elif isinstance(response, dict):
+        return f"API Error: {json.dumps(response)}"
+    return 'Failed to create payment session'
@@ -0,0 +1,53 @@
+import re
+
+from .models import Payment
+
+# Response fields that name the payment method, most specific first. The first
+# one present decides the method; if it matches no token the method is OTHER.
+METHOD_FIELDS = ('payment_method', 'channel', 'provider')
+
+# Every token we recognise, in one alternation so a value is scanned once.
+# Group names map to Payment method constants.
+METHOD_PATTERN = re.compile(
+    r'(?P<mpesa>m-?pesa)'
+    r'|(?P<card>card|visa|master-?card)'
+    r'|(?P<google_pay>google|gpay)'
+    r'|(?P<bank>bank)',
+    re.IGNORECASE,
+)
+
+# When one value mentions several methods, the first in this list wins
+METHOD_PRIORITY = {Payment.MPESA: 0, Payment.CARD: 1, Payment.GOOGLE_PAY: 2, Payment.BANK: 3}
+
+
+def match_method(value):
+    """Payment method named in a single string, or None if it names none"""
+    best = None
+    for match in METHOD_PATTERN.finditer(value):
+        method = match.lastgroup
+        if method == Payment.MPESA:
+            return method
+        if best is None or METHOD_PRIORITY[method] < METHOD_PRIORITY[best]:
+            best = method
+    return best
+
+
+def classify_payment_method(status_response):
+    """Turn an Intasend status response into a Payment method constant.
+
+    The first of ``METHOD_FIELDS`` present in the response decides. Without
+    any of them, every string value is scanned in order and the first one
+    that names a method wins; if none does the method stays UNKNOWN.
+    """
+    for field in METHOD_FIELDS:
+        if field in status_response:
+            value = status_response[field]
+            method = match_method(value) if isinstance(value, str) else None
+            return method or Payment.OTHER
+
+    for value in status_response.values():
+        if isinstance(value, str):
+            method = match_method(value)
+            if method:
+                return method
+    return Payment.UNKNOWN
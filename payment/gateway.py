@@ -0,0 +1,409 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.core.cache import cache
+from intasend.client import get_service_url
+from intasend.collections import Collect
+from intasend.exceptions import (IntaSendBadRequest, IntaSendNotAllowed,
+                                 IntaSendServerError, IntaSendUnauthorized)
+
+from .breaker import CircuitBreaker, GatewayUnavailable
+from .metrics import GATEWAY_SHORT_CIRCUITS, record_gateway_call
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Gateway / callback states and what they mean for a Payment
+COMPLETE_STATES = ['complete', 'success', 'paid']
+PENDING_STATES = ['pending', 'processing']
+FAILED_STATES = ['failed', 'cancelled', 'rejected']
+
+
+def check_response(resp):
+    """Raise the SDK's exception for an error reply, otherwise return the decoded JSON"""
+    if resp.status_code == 400:
+        raise IntaSendBadRequest(resp.text)
+    elif resp.status_code == 403:
+        raise IntaSendNotAllowed(resp.text)
+    elif resp.status_code == 401:
+        raise IntaSendUnauthorized(resp.text)
+    elif resp.status_code >= 500:
+        # 502/503/504 from a proxy in front of Intasend mean an outage too, even with a JSON body
+        raise IntaSendServerError(resp.text)
+    return resp.json()
+
+
+# Errors meaning Intasend is down or struggling, as opposed to rejecting a bad request
+GATEWAY_FAILURES = (requests.RequestException, httpx.HTTPError, IntaSendServerError, ValueError)
+
+circuit_breaker = CircuitBreaker('Intasend')
+
+
+@contextmanager
+def guarded_call(service_endpoint):
+    """Run one gateway call through the circuit breaker, recording its latency and outcome.
+
+    Raises GatewayUnavailable without calling out while the circuit is open.
+    """
+    try:
+        circuit_breaker.before_call()
+    except GatewayUnavailable:
+        GATEWAY_SHORT_CIRCUITS.inc((service_endpoint,))
+        raise
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = type(e).__name__
+        if isinstance(e, GATEWAY_FAILURES):
+            circuit_breaker.record_failure()
+        else:
+            # Intasend answered (e.g. a 400), so it is up
+            circuit_breaker.record_success()
+        raise
+    except BaseException:
+        circuit_breaker.release()
+        raise
+    else:
+        circuit_breaker.record_success()
+    finally:
+        record_gateway_call(service_endpoint, time.perf_counter() - start, error)
+
+
+def operation_deadlines():
+    """Read timeout per Intasend endpoint; any other endpoint uses INTASEND_READ_TIMEOUT"""
+    return {
+        'checkout/': settings.INTASEND_CHECKOUT_TIMEOUT,
+        'payment/status/': settings.INTASEND_STATUS_TIMEOUT,
+    }
+
+
+def gateway_available():
+    """False while the circuit breaker is failing Intasend calls fast"""
+    return circuit_breaker.available()
+
+
+class PooledCollect(Collect):
+    """Intasend Collect API that sends requests through a shared keep-alive session"""
+    def __init__(self, session, timeout, base_url='', deadlines=None, **kwargs):
+        self.session = session
+        self.timeout = timeout
+        self.base_url = base_url
+        self.deadlines = deadlines or {}
+        super().__init__(**kwargs)
+
+    def get_url(self, service_endpoint):
+        if self.base_url:
+            return f"{self.base_url.rstrip('/')}/{service_endpoint}"
+        return get_service_url(service_endpoint, self.test)
+
+    def request_timeout(self, service_endpoint):
+        deadline = self.deadlines.get(service_endpoint)
+        return self.timeout if deadline is None else (self.timeout[0], deadline)
+
+    def send_request(self, request_type, service_endpoint, payload, noauth=False):
+        # Same error mapping as the SDK, but over the pooled session with timeouts
+        with guarded_call(service_endpoint):
+            resp = self.session.request(
+                request_type, self.get_url(service_endpoint), json=payload,
+                headers=self.get_headers(noauth), timeout=self.request_timeout(service_endpoint))
+            return check_response(resp)
+
+
+class AsyncCollect(PooledCollect):
+    """Collect API whose calls return awaitables, sent over a shared ``httpx.AsyncClient``.
+
+    The SDK builds the payloads and hands them to ``send_request``, so
+    ``await collect.checkout(...)`` and ``await collect.status(...)`` send
+    exactly what the synchronous client would.
+    """
+    def send_request(self, request_type, service_endpoint, payload, noauth=False):
+        return self._send(request_type, service_endpoint, payload, noauth)
+
+    def request_timeout(self, service_endpoint):
+        deadline = self.deadlines.get(service_endpoint)
+        return self.timeout if deadline is None else httpx.Timeout(deadline, connect=self.timeout.connect)
+
+    async def _send(self, request_type, service_endpoint, payload, noauth):
+        with guarded_call(service_endpoint):
+            resp = await self.session.request(
+                request_type, self.get_url(service_endpoint), json=payload,
+                headers=self.get_headers(noauth), timeout=self.request_timeout(service_endpoint))
+            return check_response(resp)
+
+
+class IntasendClient:
+    """Drop-in replacement for ``intasend.APIService`` exposing ``collect``"""
+    def __init__(self, session, timeout, base_url='', **kwargs):
+        self.session = session
+        self.collect = PooledCollect(session, timeout, base_url=base_url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncIntasendClient:
+    """Async counterpart of ``IntasendClient``; ``collect`` methods must be awaited"""
+    def __init__(self, session, timeout, base_url='', **kwargs):
+        self.session = session
+        self.collect = AsyncCollect(session, timeout, base_url=base_url, **kwargs)
+
+    async def aclose(self):
+        await self.session.aclose()
+
+
+def build_session():
+    """Create a requests session with a bounded keep-alive connection pool"""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        # Connections beyond the pool size are opened on demand but not kept
+        pool_maxsize=settings.INTASEND_POOL_SIZE,
+        pool_block=False,
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def build_client():
+    """Build an Intasend client from the current settings"""
+    return IntasendClient(
+        build_session(),
+        timeout=(settings.INTASEND_CONNECT_TIMEOUT, settings.INTASEND_READ_TIMEOUT),
+        deadlines=operation_deadlines(),
+        base_url=settings.INTASEND_API_BASE_URL,
+        publishable_key=settings.INTASEND_PUBLISHABLE_KEY,
+        token=settings.INTASEND_SECRET_KEY,
+        test=settings.INTASEND_TEST_MODE,
+    )
+
+
+def build_async_client():
+    """Build an async Intasend client from the current settings"""
+    session = httpx.AsyncClient(limits=httpx.Limits(
+        # As with the sync pool, extra connections are opened on demand but not kept
+        max_connections=None,
+        max_keepalive_connections=settings.INTASEND_POOL_SIZE,
+    ))
+    return AsyncIntasendClient(
+        session,
+        timeout=httpx.Timeout(settings.INTASEND_READ_TIMEOUT, connect=settings.INTASEND_CONNECT_TIMEOUT),
+        deadlines=operation_deadlines(),
+        base_url=settings.INTASEND_API_BASE_URL,
+        publishable_key=settings.INTASEND_PUBLISHABLE_KEY,
+        token=settings.INTASEND_SECRET_KEY,
+        test=settings.INTASEND_TEST_MODE,
+    )
+
+
+_client = None
+_client_lock = threading.Lock()
+# httpx connections belong to the event loop that opened them, so async
+# clients are kept per loop: one for the ASGI server's loop, short-lived
+# ones for async views run under WSGI.
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_intasend_service():
+    """Return the process-wide Intasend client, creating it on first use.
+
+    The underlying session is shared by every thread in the worker so TLS
+    sessions and keep-alive connections are reused across requests.
+    """
+    global _client
+    client = _client
+    if client is None:
+        with _client_lock:
+            if _client is None:
+                _client = build_client()
+                logger.info(f"Created pooled Intasend client (pool size {settings.INTASEND_POOL_SIZE})")
+            client = _client
+    return client
+
+
+def get_async_intasend_service():
+    """Return the async Intasend client for the running event loop, creating it on first use"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = build_async_client()
+        logger.info(f"Created async Intasend client (pool size {settings.INTASEND_POOL_SIZE})")
+    return client
+
+
+def reset_intasend_service():
+    """Close the shared client so the next call builds a fresh one, and close the circuit"""
+    global _client
+    with _client_lock:
+        client, _client = _client, None
+    if client is not None:
+        client.close()
+    circuit_breaker.record_success()
+
+
+def _reinit_after_fork():
+    # The child must not reuse sockets inherited from the parent, and the lock
+    # may have been held by another thread at fork time, so start over.
+    global _client, _client_lock, _async_clients
+    _client = None
+    _client_lock = threading.Lock()
+    _async_clients = weakref.WeakKeyDictionary()
+    circuit_breaker.after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reinit_after_fork)
+
+
+class InflightCall:
+    """A status request other threads can wait on instead of repeating it"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+# loop -> {cache key: Future} for async callers, which can't block on InflightCall
+_async_inflight = weakref.WeakKeyDictionary()
+_status_counters = {'hits': 0, 'gateway_calls': 0, 'collapsed': 0}
+_counters_lock = threading.Lock()
+
+
+def _count(counter):
+    with _counters_lock:
+        _status_counters[counter] += 1
+
+
+def status_cache_key(invoice_id):
+    return f"intasend:status:{invoice_id}"
+
+
+def response_state(status_response):
+    """The lower-cased state reported in a status response, or ''"""
+    state = status_response.get('state') or status_response.get('status') or ''
+    return state.lower() if isinstance(state, str) else ''
+
+
+def is_terminal(status_response):
+    return response_state(status_response) in COMPLETE_STATES + FAILED_STATES
+
+
+def status_cache_ttl(status_response):
+    if is_terminal(status_response):
+        return settings.INTASEND_STATUS_CACHE_FINAL_TTL
+    return settings.INTASEND_STATUS_CACHE_PENDING_TTL
+
+
+def get_cached_status(invoice_id, refresh_pending=False):
+    """Intasend status for an invoice, served from Django's cache when possible.
+
+    Terminal (complete/failed) replies are cached for
+    INTASEND_STATUS_CACHE_FINAL_TTL, anything else for the much shorter
+    INTASEND_STATUS_CACHE_PENDING_TTL. With ``refresh_pending`` a cached
+    non-terminal reply is ignored. Concurrent misses for the same invoice in
+    this process share a single gateway request.
+    """
+    key = status_cache_key(invoice_id)
+    cached = cache.get(key)
+    if cached is not None and (is_terminal(cached) or not refresh_pending):
+        _count('hits')
+        return cached
+
+    with _inflight_lock:
+        call = _inflight.get(key)
+        leader = call is None
+        if leader:
+            call = _inflight[key] = InflightCall()
+
+    if not leader:
+        # Someone else is already asking the gateway; wait for their answer
+        if call.done.wait(settings.INTASEND_CONNECT_TIMEOUT + settings.INTASEND_READ_TIMEOUT):
+            _count('collapsed')
+            if call.error is not None:
+                raise call.error
+            return call.response
+        logger.warning(f"Timed out waiting for in-flight status check of {invoice_id}")
+
+    try:
+        _count('gateway_calls')
+        response = get_intasend_service().collect.status(invoice_id=invoice_id)
+        cache.set(key, response, status_cache_ttl(response))
+        call.response = response
+        return response
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        if leader:
+            call.done.set()
+            with _inflight_lock:
+                _inflight.pop(key, None)
+
+
+async def aget_cached_status(invoice_id, refresh_pending=False):
+    """Async version of ``get_cached_status`` using the async client.
+
+    Shares the cache and counters with the sync version; concurrent misses
+    on the same event loop share a single gateway request.
+    """
+    key = status_cache_key(invoice_id)
+    cached = await cache.aget(key)
+    if cached is not None and (is_terminal(cached) or not refresh_pending):
+        _count('hits')
+        return cached
+
+    loop = asyncio.get_running_loop()
+    inflight = _async_inflight.setdefault(loop, {})
+    call = inflight.get(key)
+    if call is not None:
+        # Shield so a cancelled waiter doesn't cancel the leader's request
+        response = await asyncio.shield(call)
+        _count('collapsed')
+        return response
+
+    call = inflight[key] = loop.create_future()
+    try:
+        _count('gateway_calls')
+        response = await get_async_intasend_service().collect.status(invoice_id=invoice_id)
+        await cache.aset(key, response, status_cache_ttl(response))
+        call.set_result(response)
+        return response
+    except Exception as e:
+        call.set_exception(e)
+        # Mark the error as retrieved in case nobody else was waiting
+        call.exception()
+        raise
+    finally:
+        if not call.done():
+            # We were cancelled; waiters get CancelledError and may retry
+            call.cancel()
+        inflight.pop(key, None)
+
+
+def status_cache_metrics():
+    """Counters for the status cache since the process started (or the last reset)"""
+    with _counters_lock:
+        metrics = dict(_status_counters)
+    lookups = metrics['hits'] + metrics['collapsed'] + metrics['gateway_calls']
+    metrics['calls_saved'] = metrics['hits'] + metrics['collapsed']
+    metrics['hit_rate'] = metrics['calls_saved'] / lookups if lookups else 0.0
+    return metrics
+
+
+def reset_status_cache_metrics():
+    with _counters_lock:
+        for counter in _status_counters:
+            _status_counters[counter] = 0
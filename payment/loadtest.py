@@ -0,0 +1,147 @@
+import logging
+import math
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from .models import Payment
+from .reconcile import RateLimiter
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# The steps of one payment, in the order a payer goes through them
+STEPS = ('create_checkout', 'payment_callback', 'payment_status')
+
+LOADTEST_USERNAME = 'loadtest'
+
+
+class StepStats:
+    """Latencies and query counts for one step, collected from every worker"""
+    def __init__(self):
+        self.latencies = []
+        self.queries = []
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def record(self, seconds, queries, ok):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.queries.append(queries)
+            if not ok:
+                self.errors += 1
+
+    def summary(self, elapsed):
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        return {
+            'count': count,
+            'errors': self.errors,
+            'throughput': count / elapsed if elapsed else 0.0,
+            'p50': percentile(latencies, 0.50),
+            'p90': percentile(latencies, 0.90),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else 0.0,
+            'queries': sum(self.queries) / count if count else 0.0,
+        }
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+def timed(stats, send, check):
+    """Send one request, recording its latency and database queries; returns the response or None"""
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        try:
+            response = send()
+        except Exception as e:
+            stats.record(time.perf_counter() - start, len(queries), False)
+            logger.error(f"Load test request failed: {str(e)}")
+            return None
+        seconds = time.perf_counter() - start
+    stats.record(seconds, len(queries), check(response))
+    return response
+
+
+def run_flow(client, number, stats, settle_wait=0.0):
+    """Drive one payment through checkout, callback and status; returns the payment's final status"""
+    response = timed(stats['create_checkout'], lambda: client.post(reverse('create_checkout'), {
+        'amount': '100',
+        'email': f'load{number}@example.com',
+        'phone_number': '254700000000',
+        'first_name': 'Load',
+        'last_name': f'Test {number}',
+    }, secure=True), lambda response: response.status_code == 302 and '/checkout/' in response['Location'])
+    if response is None or response.status_code != 302:
+        return None
+    invoice_id = response['Location'].rstrip('/').rsplit('/', 1)[-1]
+
+    if settle_wait:
+        time.sleep(settle_wait)
+    timed(stats['payment_callback'], lambda: client.get(
+        reverse('payment_callback'), {'invoice_id': invoice_id}, secure=True
+    ), lambda response: response.status_code == 200)
+
+    # Found outside the timed requests, the way the payer's browser already knows it
+    payment_id = Payment.objects.filter(checkout_id=invoice_id).values_list('id', flat=True).first()
+    if payment_id is None:
+        return None
+    timed(stats['payment_status'], lambda: client.get(
+        reverse('payment_status', args=[payment_id]), secure=True
+    ), lambda response: response.status_code == 200)
+    return Payment.objects.filter(id=payment_id).values_list('status', flat=True).first()
+
+
+def run_load_test(flows=100, rate=20, concurrency=8, settle_wait=0.0):
+    """Run ``flows`` payments through the views at up to ``rate`` new payments per second.
+
+    Requests go through Django's test client, so they run the full
+    middleware stack in-process and talk to whatever Intasend API
+    ``INTASEND_API_BASE_URL`` points at. Returns a dict with the elapsed
+    time, per-step summaries and a count of final payment statuses.
+    """
+    user, _ = User.objects.get_or_create(username=LOADTEST_USERNAME)
+    limiter = RateLimiter(rate)
+    stats = {step: StepStats() for step in STEPS}
+    outcomes = Counter()
+    outcomes_lock = threading.Lock()
+    local = threading.local()
+
+    def worker(number):
+        if not hasattr(local, 'client'):
+            local.client = Client()
+            local.client.force_login(user)
+        limiter.wait()
+        try:
+            # Connect before the first timed request so it doesn't pay for it
+            connection.ensure_connection()
+            status = run_flow(local.client, number, stats, settle_wait)
+        finally:
+            connection.close()
+        with outcomes_lock:
+            outcomes[status or 'error'] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(worker, number) for number in range(1, flows + 1)]:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    return {
+        'flows': flows,
+        'elapsed': elapsed,
+        'steps': {step: stats[step].summary(elapsed) for step in STEPS},
+        'outcomes': dict(outcomes),
+    }
@@ -0,0 +1,118 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import weakref
+from logging.handlers import QueueHandler, QueueListener
+
+# Attributes every LogRecord has; anything else on a record came from ``extra``
+RECORD_ATTRIBUTES = frozenset(logging.makeLogRecord({}).__dict__) | {'message', 'asctime', 'taskName'}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with ``extra`` fields included.
+
+    Extra fields (e.g. a gateway ``payload``) are serialised here, on the
+    listener thread, and any field whose JSON is longer than
+    ``max_field_chars`` is replaced by its truncated text.
+    """
+    def __init__(self, max_field_chars=2000, **kwargs):
+        super().__init__(**kwargs)
+        self.max_field_chars = max_field_chars
+
+    def field(self, value):
+        text = json.dumps(value, default=str)
+        if len(text) > self.max_field_chars:
+            text = json.dumps(f"{text[:self.max_field_chars]}... [{len(text)} chars]")
+        return text
+
+    def format(self, record):
+        fields = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        fields.update((key, value) for key, value in record.__dict__.items() if key not in RECORD_ATTRIBUTES)
+        if record.exc_info:
+            fields['exception'] = self.formatException(record.exc_info)
+        return '{' + ', '.join(f'{json.dumps(key)}: {self.field(value)}' for key, value in fields.items()) + '}'
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of the records for each ``event`` named in ``rates``.
+
+    Records without an ``event`` extra, and warnings or worse, always pass.
+    """
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = rates or {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(getattr(record, 'event', None), 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        # Block rather than drop the stop marker; the listener is draining the queue
+        self.queue.put(self._sentinel)
+
+
+_queue_handlers = weakref.WeakSet()
+
+
+class QueueListenerHandler(QueueHandler):
+    """Hands records to ``handlers`` on a background thread so logging never waits on I/O.
+
+    When the queue is full, records are dropped (and counted in ``dropped``)
+    rather than blocking the request. In LOGGING, refer to the target
+    handlers as ``cfg://handlers.<name>``.
+    """
+    def __init__(self, handlers, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        # Index rather than iterate so dictConfig resolves the cfg:// references
+        self.targets = [handlers[i] for i in range(len(handlers))]
+        self.dropped = 0
+        self.start()
+        _queue_handlers.add(self)
+        atexit.register(self.stop)
+
+    def start(self):
+        self.listener = _Listener(self.queue, *self.targets, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        if self.listener._thread is not None:
+            self.listener.stop()
+
+    def prepare(self, record):
+        # Only merge the (short) message here; extras such as payloads are
+        # left for the target handlers to format off the request thread
+        record = logging.makeLogRecord(record.__dict__)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _restart_after_fork():
+    # The listener thread doesn't survive a fork; give each child its own
+    for handler in list(_queue_handlers):
+        handler.queue = queue.Queue(handler.queue.maxsize)
+        handler.dropped = 0
+        handler.start()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_after_fork)
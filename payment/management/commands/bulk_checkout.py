@@ -0,0 +1,53 @@
+import csv
+from django.core.management.base import BaseCommand, CommandError
+
+from payment.bulk import REPORT_FIELDS, create_bulk_checkouts, parse_batch, summarize
+
+
+class Command(BaseCommand):
+    help = 'Creates payments and Intasend checkouts for every row of a CSV or JSON batch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('batch', help='CSV (with header) or JSON file of payments; columns: amount, '
+                                          'currency, phone_number, email, first_name, last_name')
+        parser.add_argument('--format', choices=['csv', 'json'],
+                            help='Batch format (default: from the file extension)')
+        parser.add_argument('--redirect-url', default=None,
+                            help='Absolute URL Intasend sends the payer back to (the callback URL)')
+        parser.add_argument('--report', default=None,
+                            help='Write the per-row report as CSV to this file')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Payments inserted and written back per batch (default: 500)')
+        parser.add_argument('--concurrency', type=int, default=8,
+                            help='Gateway calls in flight at once (default: 8)')
+        parser.add_argument('--rate', type=float, default=20,
+                            help='Maximum gateway calls per second, 0 for unlimited (default: 20)')
+
+    def handle(self, *args, **options):
+        batch_format = options['format'] or ('json' if options['batch'].lower().endswith('.json') else 'csv')
+        try:
+            with open(options['batch'], encoding='utf-8-sig') as f:
+                rows = parse_batch(f.read(), batch_format)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Could not read {options['batch']}: {str(e)}")
+
+        self.stdout.write(self.style.SUCCESS(f'Creating checkouts for {len(rows)} row(s)...'))
+        report = create_bulk_checkouts(
+            rows,
+            redirect_url=options['redirect_url'],
+            concurrency=options['concurrency'],
+            rate=options['rate'],
+            batch_size=options['batch_size'],
+        )
+
+        if options['report']:
+            with open(options['report'], 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+                writer.writeheader()
+                writer.writerows(report)
+            self.stdout.write(f"Report written to {options['report']}")
+
+        totals = summarize(report)
+        self.stdout.write(self.style.SUCCESS(
+            f"{totals['created']} checkout(s) created, {totals['failed']} failed, {totals['invalid']} invalid row(s)"
+        ))
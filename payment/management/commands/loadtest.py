@@ -0,0 +1,86 @@
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from payment.gateway import reset_intasend_service
+from payment.loadtest import STEPS, run_load_test
+from payment.stub_gateway import StubIntasendServer
+
+from .stub_intasend import add_stub_arguments, stub_options
+
+
+class Command(BaseCommand):
+    help = ('Drives payments through create_checkout, payment_callback and payment_status against '
+            'a local stub Intasend API and reports throughput, latency and queries per step')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--flows', type=int, default=100,
+                            help='Payments to run through the whole flow (default: 100)')
+        parser.add_argument('--rate', type=float, default=20,
+                            help='New payments started per second, 0 for as fast as possible (default: 20)')
+        parser.add_argument('--concurrency', type=int, default=8,
+                            help='Payments in flight at once (default: 8)')
+        parser.add_argument('--settle-wait', type=float, default=0.0,
+                            help='Seconds between checkout and callback (default: 0)')
+        parser.add_argument('--gateway-url', default=None,
+                            help='Use a stub already running at this API URL (e.g. from stub_intasend) '
+                                 'instead of starting one')
+        parser.add_argument('--no-test-db', dest='test_db', action='store_false',
+                            help='Write to the configured database instead of a throwaway test database')
+        add_stub_arguments(parser)
+
+    def handle(self, *args, **options):
+        server = None
+        gateway_url = options['gateway_url']
+        if not gateway_url:
+            server = StubIntasendServer(**stub_options(options)).start()
+            gateway_url = server.base_url
+        self.stdout.write(self.style.SUCCESS(
+            f"Running {options['flows']} payment(s) at up to {options['rate'] or 'unlimited'}/s "
+            f"against {gateway_url}..."
+        ))
+
+        old_name = None
+        with tempfile.TemporaryDirectory() as tmpdir:
+            if options['test_db']:
+                if connection.vendor == 'sqlite':
+                    # A file rather than shared memory, so concurrent writers behave as in production
+                    connection.settings_dict['TEST']['NAME'] = os.path.join(tmpdir, 'loadtest.sqlite3')
+                old_name = connection.settings_dict['NAME']
+                connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            try:
+                with override_settings(INTASEND_API_BASE_URL=gateway_url,
+                                       ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+                    reset_intasend_service()
+                    try:
+                        results = run_load_test(options['flows'], options['rate'], options['concurrency'],
+                                                options['settle_wait'])
+                    finally:
+                        reset_intasend_service()
+            finally:
+                if server:
+                    server.stop()
+                if old_name is not None:
+                    connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.report(results)
+
+    def report(self, results):
+        elapsed = results['elapsed']
+        self.stdout.write(
+            f"\n{results['flows']} flow(s) in {elapsed:.2f}s ({results['flows'] / elapsed:.1f} flows/s)\n"
+        )
+        self.stdout.write(f"{'step':<18}{'count':>7}{'errors':>8}{'req/s':>8}{'p50 ms':>9}"
+                          f"{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}{'queries':>9}")
+        for step in STEPS:
+            s = results['steps'][step]
+            self.stdout.write(
+                f"{step:<18}{s['count']:>7}{s['errors']:>8}{s['throughput']:>8.1f}{s['p50'] * 1000:>9.1f}"
+                f"{s['p90'] * 1000:>9.1f}{s['p99'] * 1000:>9.1f}{s['max'] * 1000:>9.1f}{s['queries']:>9.1f}"
+            )
+        outcomes = ', '.join(f'{status}: {count}' for status, count in sorted(results['outcomes'].items()))
+        self.stdout.write(self.style.SUCCESS(f"\nFinal payment status: {outcomes}"))
@@ -0,0 +1,44 @@
+import time
+from django.core.management.base import BaseCommand
+
+from payment.callbacks import drain_callback_queue, requeue_stale_callbacks
+
+
+class Command(BaseCommand):
+    help = 'Processes Intasend callbacks queued by payment_callback (PAYMENT_CALLBACK_ASYNC)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help='Callbacks claimed per round (default: 50)')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to sleep when the queue is empty (default: 1.0)')
+        parser.add_argument('--max-attempts', type=int, default=5,
+                            help='Attempts before a callback is marked failed (default: 5)')
+        parser.add_argument('--retry-delay', type=float, default=10.0,
+                            help='Seconds before a failed callback is tried again (default: 10.0)')
+        parser.add_argument('--stale-after', type=int, default=300,
+                            help='Seconds before a claimed callback is handed to another worker (default: 300)')
+        parser.add_argument('--once', action='store_true',
+                            help='Drain the queue and exit instead of polling forever')
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.SUCCESS('Starting callback worker...'))
+
+        processed = 0
+        try:
+            while True:
+                requeued = requeue_stale_callbacks(options['stale_after'])
+                if requeued:
+                    self.stdout.write(self.style.WARNING(f'Requeued {requeued} stale callback(s)'))
+
+                claimed = drain_callback_queue(options['batch_size'], options['max_attempts'], options['retry_delay'])
+                processed += claimed
+
+                if not claimed:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(self.style.SUCCESS(f'Callback worker stopped after {processed} callback(s)'))
@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from payment.rollups import rebuild_rollups
+from payment.windows import prune_window_buckets
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the daily and rolling-window payment rollup tables from raw payments'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--prune-windows',
+            action='store_true',
+            help='Only delete minute buckets older than PAYMENT_WINDOW_MINUTE_RETENTION_DAYS, without rebuilding',
+        )
+
+    def handle(self, *args, **options):
+        if options['prune_windows']:
+            deleted = prune_window_buckets()
+            self.stdout.write(self.style.SUCCESS(
+                f'Pruned {deleted} minute bucket(s) older than {settings.PAYMENT_WINDOW_MINUTE_RETENTION_DAYS} days'
+            ))
+            return
+        self.stdout.write('Rebuilding payment rollups...')
+        buckets = rebuild_rollups()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {buckets} rollup bucket(s)'))
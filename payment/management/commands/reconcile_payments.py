@@ -0,0 +1,38 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+
+from payment.reconcile import reconcile_pending_payments
+
+
+class Command(BaseCommand):
+    help = 'Refreshes stale pending payments from Intasend in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=30,
+                            help='Only check payments pending for at least this many minutes (default: 30)')
+        parser.add_argument('--page-size', type=int, default=500,
+                            help='Payments loaded and written back per batch (default: 500)')
+        parser.add_argument('--concurrency', type=int, default=8,
+                            help='Gateway calls in flight at once (default: 8)')
+        parser.add_argument('--rate', type=float, default=20,
+                            help='Maximum gateway calls per second, 0 for unlimited (default: 20)')
+        parser.add_argument('--retries', type=int, default=3,
+                            help='Retries for transient gateway errors (default: 3)')
+        parser.add_argument('--backoff', type=float, default=0.5,
+                            help='Initial retry delay in seconds, doubled per attempt (default: 0.5)')
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.SUCCESS('Reconciling pending payments...'))
+
+        totals = reconcile_pending_payments(
+            older_than=timedelta(minutes=options['older_than']),
+            page_size=options['page_size'],
+            concurrency=options['concurrency'],
+            rate=options['rate'],
+            retries=options['retries'],
+            backoff=options['backoff'],
+        )
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Checked {totals['checked']} payment(s): {totals['updated']} updated, {totals['errors']} error(s)"
+        ))
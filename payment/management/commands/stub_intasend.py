@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+
+from payment.stub_gateway import StubIntasendServer
+
+
+def add_stub_arguments(parser):
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Seconds each stub API call takes (default: 0.05)')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Up to this many extra seconds added at random per call (default: 0)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of stub API calls answered with a 500 (default: 0)')
+    parser.add_argument('--fail-rate', type=float, default=0.0,
+                        help='Fraction of invoices that end FAILED rather than COMPLETE (default: 0)')
+    parser.add_argument('--settle-after', type=float, default=0.0,
+                        help='Seconds an invoice stays PENDING/PROCESSING before it settles (default: 0)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Random seed for jitter, errors and failures (default: unseeded)')
+
+
+def stub_options(options):
+    return {name: options[name] for name in ('latency', 'jitter', 'error_rate', 'fail_rate', 'settle_after', 'seed')}
+
+
+class Command(BaseCommand):
+    help = 'Serves a local stand-in for the Intasend checkout and status API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1',
+                            help='Address to listen on (default: 127.0.0.1)')
+        parser.add_argument('--port', type=int, default=8765,
+                            help='Port to listen on (default: 8765)')
+        add_stub_arguments(parser)
+
+    def handle(self, *args, **options):
+        server = StubIntasendServer((options['host'], options['port']), **stub_options(options))
+        self.stdout.write(self.style.SUCCESS(f'Stub Intasend API listening on {server.base_url}'))
+        self.stdout.write(f'Set INTASEND_API_BASE_URL={server.base_url} to send payments to it')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        self.stdout.write(f'Stub issued {len(server.invoices)} invoice(s)')
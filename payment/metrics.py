@@ -0,0 +1,223 @@
+import bisect
+import contextvars
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db.backends.signals import connection_created
+
+# Prometheus' default latency buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_text(labelnames, labels, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """A monotonically increasing value per label set"""
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+
+    def inc(self, labels=(), amount=1):
+        with _lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield f"{self.name}{_label_text(self.labelnames, labels)} {value}"
+
+    def reset(self):
+        self.values = {}
+
+
+class Histogram(Counter):
+    """Bucketed observations per label set, exposed the way Prometheus expects"""
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # One slot per bucket plus +Inf, then the running sum
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self):
+        for labels, counts in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_label_text(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_label_text(self.labelnames, labels)} {counts[-1]}"
+            yield f"{self.name}_count{_label_text(self.labelnames, labels)} {cumulative}"
+
+
+REQUEST_DURATION = Histogram(
+    'payment_http_request_duration_seconds', 'Time spent handling a request',
+    ('route', 'method', 'status'))
+REQUEST_DB_QUERIES = Counter(
+    'payment_http_db_queries_total', 'Database queries run while handling requests', ('route',))
+REQUEST_DB_SECONDS = Counter(
+    'payment_http_db_seconds_total', 'Time spent in database queries while handling requests', ('route',))
+REQUEST_GATEWAY_SECONDS = Counter(
+    'payment_http_gateway_seconds_total', 'Time spent waiting on Intasend while handling requests', ('route',))
+GATEWAY_DURATION = Histogram(
+    'payment_gateway_request_duration_seconds', 'Intasend API call latency', ('endpoint',))
+GATEWAY_ERRORS = Counter(
+    'payment_gateway_errors_total', 'Intasend API calls that raised', ('endpoint', 'error'))
+GATEWAY_SHORT_CIRCUITS = Counter(
+    'payment_gateway_short_circuits_total', 'Intasend API calls refused because the circuit was open', ('endpoint',))
+REPORT_CACHE_LOOKUPS = Counter(
+    'payment_report_cache_lookups_total', 'Report page data served from cache (hit) or computed (miss)', ('outcome',))
+
+METRICS = [REQUEST_DURATION, REQUEST_DB_QUERIES, REQUEST_DB_SECONDS, REQUEST_GATEWAY_SECONDS,
+           GATEWAY_DURATION, GATEWAY_ERRORS, GATEWAY_SHORT_CIRCUITS, REPORT_CACHE_LOOKUPS]
+
+
+class RequestStats:
+    """Database and gateway time attributed to the request being handled"""
+    __slots__ = ('queries', 'db_seconds', 'gateway_seconds')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.gateway_seconds = 0.0
+
+
+# Set by the middleware; context variables follow the request into
+# sync_to_async threads, so async views are measured too
+_request_stats = contextvars.ContextVar('payment_request_stats', default=None)
+
+
+def record_gateway_call(endpoint, seconds, error=None):
+    GATEWAY_DURATION.observe(seconds, (endpoint,))
+    if error is not None:
+        GATEWAY_ERRORS.inc((endpoint, error))
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.gateway_seconds += seconds
+
+
+def time_query(execute, sql, params, many, context):
+    """Database execute wrapper counting queries made on behalf of a request"""
+    stats = _request_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.db_seconds += time.perf_counter() - start
+
+
+def install_query_timer(sender, connection, **kwargs):
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
+
+
+connection_created.connect(install_query_timer, dispatch_uid='payment_metrics_query_timer')
+
+
+class MetricsMiddleware:
+    """Records latency, DB and gateway time per route for the /metrics endpoint"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_stats.reset(token)
+        self.record(request, response, stats, time.perf_counter() - start)
+        return response
+
+    async def __acall__(self, request):
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_stats.reset(token)
+        self.record(request, response, stats, time.perf_counter() - start)
+        return response
+
+    def record(self, request, response, stats, seconds):
+        # Label by URL pattern, not path, so label sets stay bounded
+        match = request.resolver_match
+        route = match.route if match is not None else 'unmatched'
+        REQUEST_DURATION.observe(seconds, (route, request.method, response.status_code))
+        REQUEST_DB_QUERIES.inc((route,), stats.queries)
+        REQUEST_DB_SECONDS.inc((route,), stats.db_seconds)
+        REQUEST_GATEWAY_SECONDS.inc((route,), stats.gateway_seconds)
+
+
+def status_cache_samples():
+    from .gateway import status_cache_metrics
+
+    counters = status_cache_metrics()
+    yield '# HELP payment_status_cache_lookups_total Status cache lookups by outcome'
+    yield '# TYPE payment_status_cache_lookups_total counter'
+    for outcome in ('hits', 'collapsed', 'gateway_calls'):
+        yield f'payment_status_cache_lookups_total{{outcome="{outcome}"}} {counters[outcome]}'
+
+
+def circuit_samples():
+    from .gateway import circuit_breaker
+
+    yield '# HELP payment_gateway_circuit_state Intasend circuit breaker state (0 closed, 1 half-open, 2 open)'
+    yield '# TYPE payment_gateway_circuit_state gauge'
+    state = {circuit_breaker.CLOSED: 0, circuit_breaker.HALF_OPEN: 1, circuit_breaker.OPEN: 2}[circuit_breaker.state]
+    yield f'payment_gateway_circuit_state {state}'
+
+
+def render_metrics():
+    """All metrics for this process in the Prometheus text exposition format"""
+    lines = []
+    with _lock:
+        for metric in METRICS:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+    lines.extend(status_cache_samples())
+    lines.extend(circuit_samples())
+    return '\n'.join(lines) + '\n'
+
+
+def reset_metrics():
+    with _lock:
+        for metric in METRICS:
+            metric.reset()
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payment', '0002_payment_completed_at_payment_payer_email_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='payment',
+            name='checkout_id',
+            field=models.CharField(blank=True, db_index=True, max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='reference',
+            field=models.CharField(blank=True, db_index=True, max_length=100),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['-created_at'], name='payment_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['status', '-created_at'], name='payment_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['payment_method', '-created_at'], name='payment_method_created_idx'),
+        ),
+    ]
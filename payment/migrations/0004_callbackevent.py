@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payment', '0003_payment_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CallbackEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('checkout_id', models.CharField(max_length=100)),
+                ('status', models.CharField(blank=True, max_length=50)),
+                ('payload', models.JSONField(blank=True, default=dict)),
+                ('state', models.CharField(choices=[('queued', 'Queued'), ('processing', 'Processing'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('claim_token', models.CharField(blank=True, db_index=True, max_length=32)),
+                ('claimed_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True)),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['state', 'id'], name='callback_state_idx')],
+            },
+        ),
+    ]
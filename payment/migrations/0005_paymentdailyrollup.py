@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:42
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+
+
+def backfill_rollups(apps, schema_editor):
+    Payment = apps.get_model('payment', 'Payment')
+    PaymentDailyRollup = apps.get_model('payment', 'PaymentDailyRollup')
+    buckets = (
+        Payment.objects.order_by()
+        .annotate(date=TruncDate('created_at'))
+        .values('date', 'status', 'payment_method', 'currency')
+        .annotate(count=Count('id'), amount=Sum('amount'))
+    )
+    PaymentDailyRollup.objects.bulk_create(
+        [PaymentDailyRollup(**bucket) for bucket in buckets],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payment', '0004_callbackevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentDailyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('complete', 'Complete'), ('failed', 'Failed')], max_length=10)),
+                ('payment_method', models.CharField(choices=[('mpesa', 'M-Pesa'), ('card', 'Card Payment'), ('google_pay', 'Google Pay'), ('bank', 'Bank Transfer'), ('other', 'Other Method'), ('unknown', 'Unknown Method')], max_length=20)),
+                ('currency', models.CharField(max_length=3)),
+                ('count', models.IntegerField(default=0)),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('date', 'status', 'payment_method', 'currency'), name='unique_payment_rollup_bucket')],
+            },
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
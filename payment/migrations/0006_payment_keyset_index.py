@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payment', '0005_paymentdailyrollup'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='payment',
+            name='payment_created_idx',
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['-created_at', '-id'], name='payment_created_id_idx'),
+        ),
+    ]
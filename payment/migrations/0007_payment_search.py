@@ -0,0 +1,69 @@
+from django.db import migrations
+
+# Kept in step with payment_payment by triggers, so bulk_create, bulk_update
+# and queryset updates are indexed too
+SQLITE_FORWARD = [
+    """CREATE VIRTUAL TABLE payment_search USING fts5(
+        reference, checkout_id, payer_name, payer_email, payer_phone,
+        content='payment_payment', content_rowid='id', tokenize='trigram'
+    )""",
+    """CREATE TRIGGER payment_search_insert AFTER INSERT ON payment_payment BEGIN
+        INSERT INTO payment_search(rowid, reference, checkout_id, payer_name, payer_email, payer_phone)
+        VALUES (new.id, new.reference, new.checkout_id, new.payer_name, new.payer_email, new.payer_phone);
+    END""",
+    """CREATE TRIGGER payment_search_delete AFTER DELETE ON payment_payment BEGIN
+        INSERT INTO payment_search(payment_search, rowid, reference, checkout_id, payer_name, payer_email, payer_phone)
+        VALUES ('delete', old.id, old.reference, old.checkout_id, old.payer_name, old.payer_email, old.payer_phone);
+    END""",
+    """CREATE TRIGGER payment_search_update
+    AFTER UPDATE OF reference, checkout_id, payer_name, payer_email, payer_phone ON payment_payment BEGIN
+        INSERT INTO payment_search(payment_search, rowid, reference, checkout_id, payer_name, payer_email, payer_phone)
+        VALUES ('delete', old.id, old.reference, old.checkout_id, old.payer_name, old.payer_email, old.payer_phone);
+        INSERT INTO payment_search(rowid, reference, checkout_id, payer_name, payer_email, payer_phone)
+        VALUES (new.id, new.reference, new.checkout_id, new.payer_name, new.payer_email, new.payer_phone);
+    END""",
+    "INSERT INTO payment_search(payment_search) VALUES ('rebuild')",
+]
+
+SQLITE_REVERSE = [
+    "DROP TRIGGER IF EXISTS payment_search_update",
+    "DROP TRIGGER IF EXISTS payment_search_delete",
+    "DROP TRIGGER IF EXISTS payment_search_insert",
+    "DROP TABLE IF EXISTS payment_search",
+]
+
+# Must match payment.search.POSTGRES_DOCUMENT for the planner to use the index
+POSTGRES_FORWARD = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    """CREATE INDEX IF NOT EXISTS payment_search_trgm_idx ON payment_payment USING gin ((
+        COALESCE(reference, '') || ' ' || COALESCE(checkout_id, '') || ' ' || COALESCE(payer_name, '')
+        || ' ' || COALESCE(payer_email, '') || ' ' || COALESCE(payer_phone, '')
+    ) gin_trgm_ops)""",
+]
+
+POSTGRES_REVERSE = [
+    "DROP INDEX IF EXISTS payment_search_trgm_idx",
+]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        vendor = schema_editor.connection.vendor
+        for sql in statements.get(vendor, []):
+            schema_editor.execute(sql)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payment', '0006_payment_keyset_index'),
+    ]
+
+    operations = [
+        # Other backends have no search index; payment.search falls back to LIKE there
+        migrations.RunPython(
+            run({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRES_FORWARD}),
+            run({'sqlite': SQLITE_REVERSE, 'postgresql': POSTGRES_REVERSE}),
+        ),
+    ]
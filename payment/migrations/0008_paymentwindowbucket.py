@@ -0,0 +1,58 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:19
+
+import datetime
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import Coalesce, Trunc
+from django.utils import timezone
+
+
+def backfill_window_buckets(apps, schema_editor):
+    Payment = apps.get_model('payment', 'Payment')
+    PaymentWindowBucket = apps.get_model('payment', 'PaymentWindowBucket')
+    completed = Coalesce('completed_at', 'created_at')
+    complete = Payment.objects.order_by().filter(status='complete').annotate(completed=completed)
+    # Hour-aligned like rebuild_rollups' cutoff, so window reads find minutes for every partial hour
+    retention = datetime.timedelta(days=getattr(settings, 'PAYMENT_WINDOW_MINUTE_RETENTION_DAYS', 31))
+    minutes_since = (timezone.now() - retention).astimezone(datetime.timezone.utc).replace(
+        minute=0, second=0, microsecond=0
+    )
+    for resolution, payments in [('hour', complete), ('minute', complete.filter(completed__gte=minutes_since))]:
+        buckets = (
+            payments
+            .annotate(start=Trunc(completed, resolution, tzinfo=datetime.timezone.utc))
+            .values('start', 'payment_method', 'currency')
+            .annotate(count=Count('id'), amount=Sum('amount'))
+        )
+        PaymentWindowBucket.objects.bulk_create(
+            [PaymentWindowBucket(resolution=resolution, **bucket) for bucket in buckets],
+            batch_size=1000,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payment', '0007_payment_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentWindowBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.CharField(choices=[('minute', 'Minute'), ('hour', 'Hour')], max_length=6)),
+                ('start', models.DateTimeField()),
+                ('payment_method', models.CharField(choices=[('mpesa', 'M-Pesa'), ('card', 'Card Payment'), ('google_pay', 'Google Pay'), ('bank', 'Bank Transfer'), ('other', 'Other Method'), ('unknown', 'Unknown Method')], max_length=20)),
+                ('currency', models.CharField(max_length=3)),
+                ('count', models.IntegerField(default=0)),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('resolution', 'start', 'payment_method', 'currency'), name='unique_payment_window_bucket')],
+            },
+        ),
+        migrations.RunPython(backfill_window_buckets, migrations.RunPython.noop),
+    ]
@@ -31,8 +31,8 @@ class Payment(models.Model):
     
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     currency = models.CharField(max_length=3, default='KES')
-    reference = models.CharField(max_length=100, blank=True)
-    checkout_id = models.CharField(max_length=100, blank=True)
+    reference = models.CharField(max_length=100, blank=True, db_index=True)
+    checkout_id = models.CharField(max_length=100, blank=True, db_index=True)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
     payment_method = models.CharField(max_length=20, choices=PAYMENT_METHOD_CHOICES, default=UNKNOWN)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -42,5 +42,95 @@ class Payment(models.Model):
     payer_email = models.EmailField(blank=True, null=True)
     payer_name = models.CharField(max_length=255, blank=True, null=True)
     
+    class Meta:
+        indexes = [
+            # Report listing, date-range filters and keyset paging by newest first
+            models.Index(fields=['-created_at', '-id'], name='payment_created_id_idx'),
+            # Report filters on status / method combined with the date ordering
+            models.Index(fields=['status', '-created_at'], name='payment_status_created_idx'),
+            models.Index(fields=['payment_method', '-created_at'], name='payment_method_created_idx'),
+        ]
+    
     def __str__(self):
         return f"Payment of {self.amount} {self.currency} ({self.status})"
+
+
+class CallbackEvent(models.Model):
+    """An Intasend callback queued for the process_callbacks worker"""
+    QUEUED = 'queued'
+    PROCESSING = 'processing'
+    DONE = 'done'
+    FAILED = 'failed'
+    
+    STATE_CHOICES = [
+        (QUEUED, 'Queued'),
+        (PROCESSING, 'Processing'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+    
+    checkout_id = models.CharField(max_length=100)
+    status = models.CharField(max_length=50, blank=True)
+    payload = models.JSONField(default=dict, blank=True)
+    state = models.CharField(max_length=10, choices=STATE_CHOICES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    claim_token = models.CharField(max_length=32, blank=True, db_index=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        indexes = [
+            # The worker polls for the oldest queued events
+            models.Index(fields=['state', 'id'], name='callback_state_idx'),
+        ]
+    
+    def __str__(self):
+        return f"Callback for {self.checkout_id} ({self.state})"
+
+
+class PaymentDailyRollup(models.Model):
+    """Per-day payment counts and totals, kept in step with Payment for the reports dashboard"""
+    date = models.DateField()
+    status = models.CharField(max_length=10, choices=Payment.STATUS_CHOICES)
+    payment_method = models.CharField(max_length=20, choices=Payment.PAYMENT_METHOD_CHOICES)
+    currency = models.CharField(max_length=3)
+    count = models.IntegerField(default=0)
+    amount = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'status', 'payment_method', 'currency'],
+                                    name='unique_payment_rollup_bucket'),
+        ]
+    
+    def __str__(self):
+        return f"{self.date} {self.status}/{self.payment_method}: {self.count} ({self.amount} {self.currency})"
+
+
+class PaymentWindowBucket(models.Model):
+    """Completed payments per minute or hour, for trailing-window totals (1h, 24h, 7d, ...)"""
+    MINUTE = 'minute'
+    HOUR = 'hour'
+    
+    RESOLUTION_CHOICES = [
+        (MINUTE, 'Minute'),
+        (HOUR, 'Hour'),
+    ]
+    
+    resolution = models.CharField(max_length=6, choices=RESOLUTION_CHOICES)
+    start = models.DateTimeField()
+    payment_method = models.CharField(max_length=20, choices=Payment.PAYMENT_METHOD_CHOICES)
+    currency = models.CharField(max_length=3)
+    count = models.IntegerField(default=0)
+    amount = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['resolution', 'start', 'payment_method', 'currency'],
+                                    name='unique_payment_window_bucket'),
+        ]
+    
+    def __str__(self):
+        return f"{self.resolution} from {self.start} {self.payment_method}: {self.count} ({self.amount} {self.currency})"
@@ -0,0 +1,168 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import requests
+from django.db import transaction
+from django.utils import timezone
+from intasend.exceptions import IntaSendServerError
+
+from .callbacks import COMPLETE_STATES, FAILED_STATES, parse_status_response
+from .gateway import get_intasend_service
+from .models import Payment
+from .reports import bump_reports_generation
+from .rollups import apply_rollup_deltas, payment_deltas, rollup_state
+from .stream import publish_status_change
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Errors worth retrying; anything else (bad request, auth) fails straight away
+RETRYABLE_ERRORS = (requests.RequestException, IntaSendServerError)
+
+
+class RateLimiter:
+    """Spaces calls out to at most ``rate`` per second across all threads"""
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def fetch_status(checkout_id, limiter, retries=3, backoff=0.5):
+    """Query Intasend for one invoice, retrying transient errors with exponential backoff"""
+    service = get_intasend_service()
+    for attempt in range(retries + 1):
+        limiter.wait()
+        try:
+            return service.collect.status(invoice_id=checkout_id)
+        except RETRYABLE_ERRORS as e:
+            if attempt == retries:
+                raise
+            delay = backoff * (2 ** attempt)
+            logger.warning(f"Status check for {checkout_id} failed ({str(e)}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def stale_pending_payments(older_than, page_size):
+    """Yield pages of pending payments with a checkout id, created before ``older_than`` ago"""
+    cutoff = timezone.now() - older_than
+    pending = (
+        Payment.objects.filter(status=Payment.PENDING, created_at__lt=cutoff)
+        .exclude(checkout_id='')
+        .only('id', 'checkout_id', 'status', 'payment_method', 'completed_at', 'created_at', 'currency', 'amount')
+        .order_by('id')
+    )
+    last_id = 0
+    while True:
+        page = list(pending.filter(id__gt=last_id)[:page_size])
+        if not page:
+            return
+        yield page
+        last_id = page[-1].id
+
+
+def apply_status(payment, status_response, now):
+    """Update an in-memory payment from a status response; returns True if it changed"""
+    payment_status, payment_method = parse_status_response(status_response)
+    changed = False
+
+    if payment.payment_method == Payment.UNKNOWN and payment_method != Payment.UNKNOWN:
+        payment.payment_method = payment_method
+        changed = True
+
+    if payment_status in COMPLETE_STATES:
+        payment.status = Payment.COMPLETE
+        payment.completed_at = now
+        changed = True
+    elif payment_status in FAILED_STATES:
+        payment.status = Payment.FAILED
+        changed = True
+
+    return changed
+
+
+def write_back(changed):
+    """Save reconciled payments with one bulk_update, skipping any that left pending meanwhile.
+
+    ``changed`` holds (payment, state before reconciling) pairs. The rows are
+    locked and re-checked first so a concurrent callback's transition is
+    never overwritten. Returns the payments that were written.
+    """
+    with transaction.atomic():
+        still_pending = dict(
+            Payment.objects.select_for_update()
+            .filter(id__in=[payment.id for payment, _ in changed], status=Payment.PENDING)
+            .values_list('id', 'payment_method')
+        )
+        written = []
+        deltas = {}
+        for payment, old_state in changed:
+            if payment.id not in still_pending:
+                continue
+            # Count the row out of the bucket it is in now, not the one we loaded it from
+            old_state['payment_method'] = still_pending[payment.id]
+            if payment.payment_method == Payment.UNKNOWN:
+                payment.payment_method = still_pending[payment.id]
+            payment_deltas(old_state, rollup_state(payment), deltas)
+            written.append(payment)
+        if written:
+            Payment.objects.bulk_update(written, ['status', 'payment_method', 'completed_at', 'updated_at'])
+            # bulk_update skips the save signals, so keep the rollup in step here
+            apply_rollup_deltas(deltas)
+            bump_reports_generation()
+            publish_status_change(*[payment.id for payment in written if payment.status != Payment.PENDING])
+    return written
+
+
+def reconcile_pending_payments(older_than=timedelta(minutes=30), page_size=500, concurrency=8,
+                               rate=20, retries=3, backoff=0.5):
+    """Refresh stale pending payments from Intasend page by page.
+
+    Each page is checked with up to ``concurrency`` gateway calls in flight,
+    never more than ``rate`` calls per second, and written back with one
+    ``bulk_update``. Returns a dict of counters.
+    """
+    limiter = RateLimiter(rate)
+    totals = {'checked': 0, 'updated': 0, 'errors': 0}
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for page in stale_pending_payments(older_than, page_size):
+            futures = [
+                (payment, executor.submit(fetch_status, payment.checkout_id, limiter, retries, backoff))
+                for payment in page
+            ]
+
+            now = timezone.now()
+            changed = []
+            for payment, future in futures:
+                totals['checked'] += 1
+                try:
+                    status_response = future.result()
+                except Exception as e:
+                    totals['errors'] += 1
+                    logger.error(f"Error checking payment {payment.id} ({payment.checkout_id}): {str(e)}")
+                    continue
+                old_state = rollup_state(payment)
+                if apply_status(payment, status_response, now):
+                    payment.updated_at = now
+                    changed.append((payment, old_state))
+
+            if changed:
+                changed = write_back(changed)
+                totals['updated'] += len(changed)
+            logger.info(f"Reconciled page of {len(page)} pending payments, {len(changed)} updated")
+
+    return totals
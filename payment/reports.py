@@ -0,0 +1,180 @@
+import base64
+import binascii
+import csv
+import hashlib
+from datetime import datetime
+from urllib.parse import urlencode
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Payment
+from .windows import SEVEN_DAYS, window_bounds
+
+# Rows fetched per round trip when streaming an export
+EXPORT_CHUNK_SIZE = 2000
+
+CSV_HEADER = ['Reference', 'Amount', 'Currency', 'Method', 'Status', 'Created Date', 'Completed Date', 'Customer']
+
+# Only the columns the export actually writes
+EXPORT_FIELDS = (
+    'reference', 'amount', 'currency', 'payment_method', 'status',
+    'created_at', 'completed_at', 'payer_name', 'payer_email', 'payer_phone',
+)
+
+
+# Bumped whenever payments change; cached report pages embed it in their key
+REPORTS_GENERATION_KEY = 'payment:reports:generation'
+
+
+class Echo:
+    """File-like object whose write() hands the formatted line straight back"""
+    def write(self, value):
+        return value
+
+
+def export_row(payment):
+    """Format one payment as a CSV row"""
+    return [
+        payment.reference,
+        payment.amount,
+        payment.currency,
+        payment.get_payment_method_display(),
+        payment.get_status_display(),
+        payment.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        payment.completed_at.strftime('%Y-%m-%d %H:%M:%S') if payment.completed_at else 'N/A',
+        payment.payer_name or payment.payer_email or payment.payer_phone or 'Unknown'
+    ]
+
+
+def stream_payments_csv(payments, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield the CSV export line by line without caching the queryset.
+
+    The header goes out before the first query runs, and rows are read with
+    ``iterator()`` so only one chunk is held in memory at a time (server-side
+    cursors on PostgreSQL, chunked fetches on SQLite).
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_HEADER)
+    for payment in payments.only(*EXPORT_FIELDS).iterator(chunk_size=chunk_size):
+        yield writer.writerow(export_row(payment))
+
+
+def payment_stats(payments):
+    """Compute the reports dashboard statistics with one conditional aggregate.
+
+    Every figure is a filtered COUNT/SUM over the same scan of ``payments``
+    instead of a separate query per number. The last 7 days figures count
+    payments completed in that window, as the window buckets do.
+    """
+    complete = Q(status=Payment.COMPLETE)
+    recent_complete = complete & Q(completed__gte=window_bounds(SEVEN_DAYS)[0])
+
+    totals = payments.annotate(completed=Coalesce('completed_at', 'created_at')).aggregate(
+        total_payments=Count('id'),
+        successful_payments=Count('id', filter=complete),
+        pending_payments=Count('id', filter=Q(status=Payment.PENDING)),
+        failed_payments=Count('id', filter=Q(status=Payment.FAILED)),
+        total_amount=Sum('amount', filter=complete),
+        count_7days=Count('id', filter=recent_complete),
+        total_7days=Sum('amount', filter=recent_complete),
+    )
+    totals['total_amount'] = totals['total_amount'] or 0
+    totals['total_7days'] = totals['total_7days'] or 0
+    return add_rates(totals)
+
+
+def add_rates(totals):
+    """Derive success rate and average transaction from the raw totals"""
+    # Calculate success rate and average transaction
+    totals['success_rate'] = 0
+    totals['avg_transaction'] = 0
+
+    if totals['total_payments'] > 0:
+        totals['success_rate'] = int((totals['successful_payments'] / totals['total_payments']) * 100)
+
+    if totals['successful_payments'] > 0:
+        totals['avg_transaction'] = float(totals['total_amount']) / totals['successful_payments']
+
+    return totals
+
+
+def encode_cursor(payment):
+    """Opaque cursor for a payment's position in the (created_at, id) ordering"""
+    raw = f"{payment.created_at.isoformat()}|{payment.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Turn a cursor back into (created_at, id); returns None if it is malformed"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, payment_id = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), int(payment_id)
+    except (ValueError, UnicodeError, binascii.Error):
+        return None
+
+
+def keyset_page(payments, page_size, after='', before=''):
+    """Fetch one page of payments, newest first, by (created_at, id) keyset.
+
+    ``after`` / ``before`` are cursors from a previous page. Each page is a
+    range scan starting at the cursor, so deep pages cost the same as the
+    first one. Returns (rows, next_cursor, previous_cursor); a cursor is ''
+    when there is no page in that direction.
+    """
+    after_key = decode_cursor(after) if after else None
+    before_key = decode_cursor(before) if before else None
+
+    if before_key:
+        created_at, payment_id = before_key
+        rows = list(
+            payments.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=payment_id))
+            .order_by('created_at', 'id')[:page_size + 1]
+        )
+        has_previous = len(rows) > page_size
+        rows = rows[:page_size][::-1]
+        has_next = True
+    else:
+        if after_key:
+            created_at, payment_id = after_key
+            payments = payments.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=payment_id))
+        rows = list(payments.order_by('-created_at', '-id')[:page_size + 1])
+        has_next = len(rows) > page_size
+        rows = rows[:page_size]
+        has_previous = bool(after_key)
+
+    next_cursor = encode_cursor(rows[-1]) if rows and has_next else ''
+    previous_cursor = encode_cursor(rows[0]) if rows and has_previous else ''
+    return rows, next_cursor, previous_cursor
+
+
+def _fresh_generation():
+    # Start from the clock so a counter lost to eviction never reuses an old value
+    return int(timezone.now().timestamp() * 1000)
+
+
+def reports_generation():
+    """Current payments generation for report cache keys"""
+    return cache.get_or_set(REPORTS_GENERATION_KEY, _fresh_generation, timeout=None)
+
+
+def _bump_generation():
+    try:
+        cache.incr(REPORTS_GENERATION_KEY)
+    except ValueError:
+        cache.add(REPORTS_GENERATION_KEY, _fresh_generation(), timeout=None)
+
+
+def bump_reports_generation():
+    """Retire every cached report page once the current transaction commits"""
+    transaction.on_commit(_bump_generation)
+
+
+def report_cache_key(params, generation):
+    """Cache key for a report page: normalized query parameters plus generation"""
+    query = urlencode(sorted((key, value) for key, value in params.items() if value))
+    return f"payment:reports:{generation}:{hashlib.sha1(query.encode()).hexdigest()}"
@@ -0,0 +1,176 @@
+import datetime
+import logging
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Coalesce, Trunc, TruncDate
+from django.utils import timezone
+
+from .models import Payment, PaymentDailyRollup, PaymentWindowBucket
+from .reports import add_rates, bump_reports_generation
+from .windows import SEVEN_DAYS, bucket_start, minute_retention_start, window_bounds, window_stats
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Payment fields that decide which rollup buckets a payment counts towards
+TRACKED_FIELDS = ('created_at', 'status', 'payment_method', 'currency', 'amount', 'completed_at')
+
+# Columns identifying a bucket of each rollup table; delta keys are (model, values)
+BUCKET_FIELDS = {
+    PaymentDailyRollup: ('date', 'status', 'payment_method', 'currency'),
+    PaymentWindowBucket: ('resolution', 'start', 'payment_method', 'currency'),
+}
+
+WINDOW_RESOLUTIONS = (PaymentWindowBucket.MINUTE, PaymentWindowBucket.HOUR)
+
+
+def rollup_state(payment):
+    """Snapshot the tracked fields of a payment"""
+    return {field: getattr(payment, field) for field in TRACKED_FIELDS}
+
+
+def completion_time(state):
+    """When a complete payment counts as completed; older rows may lack completed_at"""
+    return state['completed_at'] or state['created_at']
+
+
+def add_delta(deltas, state, sign):
+    """Add (or with sign=-1 remove) one payment's contribution to ``deltas``"""
+    keys = [(PaymentDailyRollup, (
+        timezone.localdate(state['created_at']),
+        state['status'],
+        state['payment_method'],
+        state['currency'],
+    ))]
+    if state['status'] == Payment.COMPLETE:
+        keys += [
+            (PaymentWindowBucket, (resolution, bucket_start(completion_time(state), resolution),
+                                   state['payment_method'], state['currency']))
+            for resolution in WINDOW_RESOLUTIONS
+        ]
+    change = sign * Decimal(str(state['amount']))
+    for key in keys:
+        count, amount = deltas.get(key, (0, Decimal('0')))
+        deltas[key] = (count + sign, amount + change)
+
+
+def payment_deltas(old_state, new_state, deltas=None):
+    """Rollup changes needed when a payment goes from ``old_state`` to ``new_state``.
+
+    Either state may be None for a created or deleted payment.
+    """
+    deltas = {} if deltas is None else deltas
+    if old_state is not None:
+        add_delta(deltas, old_state, -1)
+    if new_state is not None:
+        add_delta(deltas, new_state, 1)
+    return deltas
+
+
+def apply_rollup_deltas(deltas):
+    """Apply count/amount deltas to the rollup tables with in-place F() updates"""
+    for (model, values), (count, amount) in deltas.items():
+        if not count and not amount:
+            continue
+        fields = dict(zip(BUCKET_FIELDS[model], values))
+        bucket = model.objects.filter(**fields)
+        if bucket.update(count=F('count') + count, amount=F('amount') + amount):
+            continue
+        try:
+            with transaction.atomic():
+                model.objects.create(**fields, count=count, amount=amount)
+        except IntegrityError:
+            # Another process created the bucket first
+            bucket.update(count=F('count') + count, amount=F('amount') + amount)
+
+
+def window_buckets(resolution, since=None):
+    """Window buckets of one resolution computed from raw payments (completed ``since``, if given)"""
+    completed = Coalesce('completed_at', 'created_at')
+    payments = Payment.objects.order_by().filter(status=Payment.COMPLETE)
+    if since is not None:
+        payments = payments.annotate(completed=completed).filter(completed__gte=since)
+    return [
+        PaymentWindowBucket(resolution=resolution, **bucket)
+        for bucket in payments
+        .annotate(start=Trunc(completed, resolution, tzinfo=datetime.timezone.utc))
+        .values('start', 'payment_method', 'currency')
+        .annotate(count=Count('id'), amount=Sum('amount'))
+    ]
+
+
+def rebuild_rollups():
+    """Recompute the daily and window rollup tables from raw payments; returns the bucket count"""
+    buckets = (
+        Payment.objects.order_by()
+        .annotate(date=TruncDate('created_at'))
+        .values('date', 'status', 'payment_method', 'currency')
+        .annotate(count=Count('id'), amount=Sum('amount'))
+    )
+    with transaction.atomic():
+        PaymentDailyRollup.objects.all().delete()
+        rollups = PaymentDailyRollup.objects.bulk_create(
+            [PaymentDailyRollup(**bucket) for bucket in buckets],
+            batch_size=1000,
+        )
+        PaymentWindowBucket.objects.all().delete()
+        rollups += PaymentWindowBucket.objects.bulk_create(
+            window_buckets(PaymentWindowBucket.HOUR) + window_buckets(PaymentWindowBucket.MINUTE, minute_retention_start()),
+            batch_size=1000,
+        )
+        bump_reports_generation()
+    logger.info(f"Rebuilt payment rollups: {len(rollups)} buckets")
+    return len(rollups)
+
+
+def start_of_day(date):
+    """Aware datetime for midnight at the start of ``date`` in the current timezone"""
+    return timezone.make_aware(datetime.datetime.combine(date, datetime.time.min))
+
+
+def rollup_stats(payments, status='', payment_method='', date_from=None, date_to=None):
+    """Dashboard statistics read from the rollup tables instead of raw payments.
+
+    Accepts the same filters as the reports view except free-text search;
+    ``date_to`` is exclusive. Totals come from the daily rollup. Without
+    date filters the last 7 days figures come from the window buckets;
+    with them they are summed from ``payments`` (the filtered raw queryset),
+    since a creation date range doesn't map onto completion time buckets.
+    """
+    buckets = PaymentDailyRollup.objects.all()
+    if status:
+        buckets = buckets.filter(status=status)
+    if payment_method:
+        buckets = buckets.filter(payment_method=payment_method)
+    if date_from:
+        buckets = buckets.filter(date__gte=date_from)
+    if date_to:
+        buckets = buckets.filter(date__lt=date_to)
+
+    complete = Q(status=Payment.COMPLETE)
+    totals = buckets.aggregate(
+        total_payments=Sum('count'),
+        successful_payments=Sum('count', filter=complete),
+        pending_payments=Sum('count', filter=Q(status=Payment.PENDING)),
+        failed_payments=Sum('count', filter=Q(status=Payment.FAILED)),
+        total_amount=Sum('amount', filter=complete),
+    )
+    for key in totals:
+        totals[key] = totals[key] or 0
+
+    totals['count_7days'] = 0
+    totals['total_7days'] = 0
+    if date_from or date_to:
+        recent = payments.filter(complete).annotate(completed=Coalesce('completed_at', 'created_at')).filter(
+            completed__gte=window_bounds(SEVEN_DAYS)[0]
+        ).aggregate(count=Count('id'), amount=Sum('amount'))
+        totals['count_7days'] = recent['count']
+        totals['total_7days'] = recent['amount'] or 0
+    elif status in ('', Payment.COMPLETE):
+        recent = window_stats(SEVEN_DAYS, payment_method)
+        totals['count_7days'] = recent['count']
+        totals['total_7days'] = recent['amount']
+
+    return add_rates(totals)
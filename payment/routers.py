@@ -0,0 +1,54 @@
+import contextvars
+from contextlib import contextmanager
+
+from django.db import connections
+
+REPORTS_DB = 'reports'
+
+_reporting = contextvars.ContextVar('payment_reporting', default=False)
+
+
+@contextmanager
+def reporting_reads():
+    """Route reads made inside the block to the reports database, if one is configured.
+
+    A queryset picks its database when it is evaluated, so pin lazily
+    consumed querysets (e.g. a streamed export) with ``.using(qs.db)``
+    while still inside the block.
+    """
+    token = _reporting.set(True)
+    try:
+        yield
+    finally:
+        _reporting.reset(token)
+
+
+def reports_database():
+    """Alias report reads use: ``reports`` if configured, else ``default``"""
+    return REPORTS_DB if REPORTS_DB in connections.databases else 'default'
+
+
+class ReportsRouter:
+    """Sends reads inside ``reporting_reads()`` to the reports alias; everything else to default.
+
+    Writes always go to default, and the reports alias is never migrated
+    (it is a replica or a read-only view of default).
+    """
+    def db_for_read(self, model, **hints):
+        # Only payment data; sessions and users always come from default
+        if _reporting.get() and model._meta.app_label == 'payment':
+            return reports_database()
+        return None
+
+    def db_for_write(self, model, **hints):
+        # Explicit, so saving an instance read from reports doesn't write back there
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both aliases hold the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == REPORTS_DB:
+            return False
+        return None
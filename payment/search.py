@@ -0,0 +1,113 @@
+from django.db import connections, router
+from django.db.models import BooleanField, FloatField, Q
+from django.db.models.expressions import RawSQL
+
+from .models import Payment
+
+# Columns the reports search box looks in
+SEARCH_FIELDS = ('reference', 'checkout_id', 'payer_name', 'payer_email', 'payer_phone')
+
+# The trigram index (FTS5 or pg_trgm) can only serve terms this long
+MIN_INDEXED_TERM = 3
+
+# Matches are ranked with reference and checkout ID hits above payer detail hits
+SQLITE_RANK = "bm25(payment_search, 4.0, 4.0, 1.0, 1.0, 1.0)"
+
+# Must match the expression payment_search_trgm_idx is built on (migration 0007)
+POSTGRES_DOCUMENT = (
+    "(COALESCE(reference, '') || ' ' || COALESCE(checkout_id, '') || ' ' || COALESCE(payer_name, '')"
+    " || ' ' || COALESCE(payer_email, '') || ' ' || COALESCE(payer_phone, ''))"
+)
+
+
+def search_terms(query):
+    """Whitespace-separated terms of a search, split into (indexed, short) lists"""
+    terms = query.split()
+    return ([term for term in terms if len(term) >= MIN_INDEXED_TERM],
+            [term for term in terms if len(term) < MIN_INDEXED_TERM])
+
+
+def fts_query(terms):
+    """FTS5 query matching rows containing every term, each as a literal substring"""
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def like_pattern(term):
+    return '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def contains_any_field(term):
+    """Q for ``term`` appearing in any searched column (unindexed; fine for short terms)"""
+    condition = Q()
+    for field in SEARCH_FIELDS:
+        condition |= Q(**{f'{field}__icontains': term})
+    return condition
+
+
+def search_payments(payments, query):
+    """Restrict ``payments`` to rows where every term of ``query`` appears in a searched column.
+
+    Terms of three or more characters are looked up in the trigram index
+    (the FTS5 ``payment_search`` table on SQLite, ``pg_trgm`` on PostgreSQL);
+    shorter ones, and every term on other backends, fall back to ``LIKE``.
+    """
+    indexed, short = search_terms(query)
+    vendor = connections[payments.db].vendor
+    if indexed and vendor == 'sqlite':
+        payments = payments.filter(id__in=RawSQL(
+            "SELECT rowid FROM payment_search WHERE payment_search MATCH %s", [fts_query(indexed)]
+        ))
+    elif indexed and vendor == 'postgresql':
+        for term in indexed:
+            payments = payments.filter(RawSQL(
+                f"{POSTGRES_DOCUMENT} ILIKE %s", [like_pattern(term)], output_field=BooleanField()
+            ))
+    else:
+        short = indexed + short
+    for term in short:
+        payments = payments.filter(contains_any_field(term))
+    return payments
+
+
+def ranked_search(query, page=1, page_size=20):
+    """One page of payments matching ``query``, best match first.
+
+    Returns ``(payments, has_next)``; each payment has a ``search_rank``
+    (higher is better, ``None`` when the backend has no search index).
+    """
+    db = router.db_for_read(Payment)
+    vendor = connections[db].vendor
+    indexed, short = search_terms(query)
+    offset = (page - 1) * page_size
+
+    if indexed and vendor == 'sqlite':
+        # Rank inside the FTS table and fetch just this page's rows
+        sql = f"SELECT rowid, {SQLITE_RANK} AS score FROM payment_search WHERE payment_search MATCH %s"
+        params = [fts_query(indexed)]
+        for term in short:
+            sql += " AND (" + " OR ".join(f"{field} LIKE %s ESCAPE '\\'" for field in SEARCH_FIELDS) + ")"
+            params += [like_pattern(term)] * len(SEARCH_FIELDS)
+        sql += " ORDER BY score, rowid DESC LIMIT %s OFFSET %s"
+        with connections[db].cursor() as cursor:
+            cursor.execute(sql, params + [page_size + 1, offset])
+            scores = cursor.fetchall()
+        rows = Payment.objects.using(db).in_bulk([rowid for rowid, _ in scores[:page_size]])
+        payments = []
+        for rowid, score in scores[:page_size]:
+            if rowid in rows:
+                # bm25 is lower for better matches
+                rows[rowid].search_rank = -score
+                payments.append(rows[rowid])
+        return payments, len(scores) > page_size
+
+    matches = search_payments(Payment.objects.using(db), query)
+    if indexed and vendor == 'postgresql':
+        matches = matches.annotate(search_rank=RawSQL(
+            f"word_similarity(%s, {POSTGRES_DOCUMENT})", [query], output_field=FloatField()
+        )).order_by('-search_rank', '-id')
+    else:
+        matches = matches.order_by('-created_at', '-id')
+    payments = list(matches[offset:offset + page_size + 1])
+    for payment in payments:
+        payment.search_rank = getattr(payment, 'search_rank', None)
+    return payments[:page_size], len(payments) > page_size
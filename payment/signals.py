@@ -0,0 +1,42 @@
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from .models import Payment
+from .reports import bump_reports_generation
+from .rollups import TRACKED_FIELDS, apply_rollup_deltas, payment_deltas, rollup_state
+from .stream import publish_status_change
+
+
+@receiver(post_init, sender=Payment)
+def remember_rollup_state(sender, instance, **kwargs):
+    # Read straight from __dict__ so deferred fields are never loaded here
+    instance._rollup_state = {
+        field: instance.__dict__[field] for field in TRACKED_FIELDS if field in instance.__dict__
+    }
+
+
+@receiver(post_save, sender=Payment)
+def update_rollup_on_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    old_state = None
+    if not created:
+        old_state = instance._rollup_state
+        missing = [field for field in TRACKED_FIELDS if field not in old_state]
+        if missing:
+            # Deferred fields are not written by save(), so the stored values are the old ones
+            instance.refresh_from_db(fields=missing)
+            old_state = {**rollup_state(instance), **old_state}
+    new_state = rollup_state(instance)
+    if old_state != new_state:
+        apply_rollup_deltas(payment_deltas(old_state, new_state))
+        if old_state is not None and old_state['status'] != new_state['status']:
+            publish_status_change(instance.id)
+    instance._rollup_state = new_state
+    bump_reports_generation()
+
+
+@receiver(post_delete, sender=Payment)
+def update_rollup_on_delete(sender, instance, **kwargs):
+    apply_rollup_deltas(payment_deltas(rollup_state(instance), None))
+    bump_reports_generation()
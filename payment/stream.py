@@ -0,0 +1,154 @@
+import asyncio
+import json
+import logging
+import weakref
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Payment
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Versions only need to outlive the status pages watching them
+STATUS_VERSION_TIMEOUT = 24 * 60 * 60
+
+TERMINAL_STATUSES = (Payment.COMPLETE, Payment.FAILED)
+
+
+def status_version_key(payment_id):
+    return f"payment:status-version:{payment_id}"
+
+
+def _fresh_version():
+    # Start from the clock so a version lost to eviction never reuses an old value
+    return int(timezone.now().timestamp() * 1000)
+
+
+def _publish(payment_ids):
+    for payment_id in payment_ids:
+        key = status_version_key(payment_id)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _fresh_version(), STATUS_VERSION_TIMEOUT)
+    # Watchers in this process don't have to wait for the next poll
+    for loop, hub in list(_hubs.items()):
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(hub.wake, payment_ids)
+
+
+def publish_status_change(*payment_ids):
+    """Wake status streams watching these payments once the current transaction commits.
+
+    Other processes notice through a per-payment version in the cache, so
+    streams served by another worker need a shared cache (CACHE_URL).
+    """
+    transaction.on_commit(lambda: _publish(payment_ids))
+
+
+class StatusHub:
+    """Status stream watchers on one event loop.
+
+    Watchers wait on an ``asyncio.Event`` each. One poller per loop reads
+    the versions of every watched payment from the cache in a single
+    ``get_many`` and wakes the watchers of any that changed, so the cost
+    is per process, not per open stream.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.watchers = {}
+        self.versions = {}
+        self.poller = None
+
+    def wake(self, payment_ids):
+        for payment_id in payment_ids:
+            for event in self.watchers.get(payment_id, ()):
+                event.set()
+
+    @contextmanager
+    def watch(self, payment_id, version):
+        """Register a watcher that last saw ``version``; yields the event set on a change"""
+        changed = asyncio.Event()
+        watchers = self.watchers.setdefault(payment_id, set())
+        if not watchers:
+            self.versions[payment_id] = version
+        elif self.versions[payment_id] != version:
+            # It moved on between this watcher's read and now
+            changed.set()
+        watchers.add(changed)
+        if self.poller is None or self.poller.done():
+            self.poller = self.loop.create_task(self.poll())
+        try:
+            yield changed
+        finally:
+            watchers.discard(changed)
+            if not watchers:
+                del self.watchers[payment_id]
+                del self.versions[payment_id]
+
+    async def poll(self):
+        while self.watchers:
+            await asyncio.sleep(settings.PAYMENT_STREAM_POLL_INTERVAL)
+            keys = {status_version_key(payment_id): payment_id for payment_id in self.watchers}
+            try:
+                versions = await cache.aget_many(list(keys))
+            except Exception as e:
+                logger.error(f"Error polling payment status versions: {str(e)}")
+                continue
+            for key, payment_id in keys.items():
+                version = versions.get(key)
+                if payment_id in self.versions and version != self.versions[payment_id]:
+                    self.versions[payment_id] = version
+                    self.wake([payment_id])
+
+
+_hubs = weakref.WeakKeyDictionary()
+
+
+def get_status_hub():
+    """The StatusHub for the running event loop"""
+    loop = asyncio.get_running_loop()
+    hub = _hubs.get(loop)
+    if hub is None:
+        hub = _hubs[loop] = StatusHub(loop)
+    return hub
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def status_events(payment_id, status, version):
+    """Server-sent events for one payment: its status now, then each change until it is final.
+
+    ``version`` must have been read before ``status`` so that a change in
+    between is not missed. Comments are sent as heartbeats, and the stream
+    ends after ``PAYMENT_STREAM_MAX_SECONDS``; browsers reconnect by themselves.
+    """
+    yield f"retry: {settings.PAYMENT_STREAM_RETRY_MS}\n" + sse_event('status', {'id': payment_id, 'status': status})
+    if status in TERMINAL_STATUSES:
+        return
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.PAYMENT_STREAM_MAX_SECONDS
+    with get_status_hub().watch(payment_id, version) as changed:
+        while (remaining := deadline - loop.time()) > 0:
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=min(settings.PAYMENT_STREAM_HEARTBEAT, remaining))
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            changed.clear()
+            new_status = await Payment.objects.filter(id=payment_id).values_list('status', flat=True).afirst()
+            if new_status is None:
+                return
+            if new_status != status:
+                status = new_status
+                yield sse_event('status', {'id': payment_id, 'status': status})
+                if status in TERMINAL_STATUSES:
+                    return
@@ -0,0 +1,120 @@
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubIntasendHandler(BaseHTTPRequestHandler):
+    """Answers the Intasend checkout and status calls the payment app makes"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except ValueError:
+            return self.reply(400, {'errors': [{'detail': 'Invalid JSON'}]})
+        server.wait()
+        if server.should_error():
+            return self.reply(500, {'errors': [{'detail': 'Injected stub error'}]})
+
+        if self.path.endswith('/checkout/'):
+            return self.reply(200, server.create_invoice(payload))
+        if self.path.endswith('/payment/status/'):
+            invoice_id = payload.get('invoice_id', '')
+            state = server.invoice_state(invoice_id)
+            if state is None:
+                return self.reply(400, {'errors': [{'detail': f'Invoice {invoice_id} not found'}]})
+            return self.reply(200, {'invoice': {'invoice_id': invoice_id, 'state': state},
+                                    'state': state, 'provider': 'M-PESA'})
+        return self.reply(404, {'errors': [{'detail': f'Unknown endpoint {self.path}'}]})
+
+    def reply(self, status, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubIntasendServer(ThreadingHTTPServer):
+    """A local stand-in for the Intasend collection API.
+
+    Every call waits ``latency`` seconds (plus up to ``jitter`` more) and
+    fails with a 500 at ``error_rate``. An invoice reports PENDING, then
+    PROCESSING, and once ``settle_after`` seconds have passed COMPLETE, or
+    FAILED for a ``fail_rate`` share of invoices. Point the app at it with
+    ``INTASEND_API_BASE_URL = server.base_url``.
+    """
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0, jitter=0.0, error_rate=0.0, fail_rate=0.0,
+                 settle_after=0.0, seed=None):
+        super().__init__(address, StubIntasendHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.fail_rate = fail_rate
+        self.settle_after = settle_after
+        self.random = random.Random(seed)
+        self.invoices = {}
+        self.numbers = itertools.count(1)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/api/v1/'
+
+    def wait(self):
+        with self.lock:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def should_error(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def create_invoice(self, payload):
+        with self.lock:
+            invoice_id = f'STUB{next(self.numbers):08d}'
+            final = 'FAILED' if self.random.random() < self.fail_rate else 'COMPLETE'
+            self.invoices[invoice_id] = (time.monotonic(), final)
+        return {
+            'id': invoice_id,
+            'url': f'{self.base_url}checkout/{invoice_id}/',
+            'signature': 'stub',
+            'api_ref': payload.get('api_ref'),
+            'amount': payload.get('amount'),
+            'currency': payload.get('currency'),
+        }
+
+    def invoice_state(self, invoice_id):
+        """Current state of an invoice, or None if this server never issued it"""
+        with self.lock:
+            invoice = self.invoices.get(invoice_id)
+        if invoice is None:
+            return None
+        created, final = invoice
+        age = time.monotonic() - created
+        if age >= self.settle_after:
+            return final
+        return 'PENDING' if age < self.settle_after / 2 else 'PROCESSING'
+
+    def start(self):
+        """Serve from a background thread; returns the server"""
+        self.thread = threading.Thread(target=self.serve_forever, name='stub-intasend', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -1,3 +1,1297 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import logging.handlers
+import os
+import random
+import requests
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.http import StreamingHttpResponse
+from django.db import OperationalError, connection, connections
+from django.db.backends.sqlite3.base import DatabaseWrapper as SQLiteDatabaseWrapper
+from django.db.models import Count, Sum
+from django.db.models.functions import Coalesce
+from django.test import AsyncRequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import NoReverseMatch, reverse
+from django.utils import timezone
+from intasend.exceptions import IntaSendBadRequest, IntaSendServerError
+
+from . import async_views
+from .breaker import GatewayUnavailable
+from .bulk import create_bulk_checkouts, parse_batch, write_results
+from .callbacks import drain_callback_queue, find_payment, reconcile_callback
+from .classifier import classify_payment_method
+from .export import EXPORT_SCHEMA, export_window, write_payments
+from .gateway import (aget_cached_status, circuit_breaker, get_async_intasend_service, get_cached_status,
+                      get_intasend_service, reset_intasend_service, reset_status_cache_metrics, status_cache_key, status_cache_metrics)
+from .log import JsonFormatter, QueueListenerHandler, SamplingFilter
+from .metrics import REPORT_CACHE_LOOKUPS, render_metrics, reset_metrics
+from .models import CallbackEvent, Payment, PaymentDailyRollup, PaymentWindowBucket
+from .reconcile import reconcile_pending_payments
+from .routers import REPORTS_DB, reporting_reads
+from .reports import keyset_page, payment_stats, reports_generation
+from .rollups import rebuild_rollups, rollup_stats, start_of_day
+from .search import search_payments
+from .stream import status_version_key
+from .stub_gateway import StubIntasendServer
+from .transitions import transition_payment
+from .windows import WINDOWS, prune_window_buckets, window_bounds, window_stats
+
+
+# The reports connection can't see a TestCase's uncommitted rows; ReportsRoutingTests covers routing
+@override_settings(SECURE_SSL_REDIRECT=False, DATABASE_ROUTERS=[])
+class PaymentReportsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='finance', password='secret-pass-123')
+        self.client.force_login(self.user)
+        Payment.objects.create(amount=Decimal('100.00'), reference='payment-a', status=Payment.COMPLETE,
+                               payment_method=Payment.MPESA, payer_name='Alice')
+        Payment.objects.create(amount=Decimal('50.00'), reference='payment-b', status=Payment.PENDING)
+        Payment.objects.create(amount=Decimal('25.00'), reference='payment-c', status=Payment.FAILED,
+                               payer_email='carol@example.com')
+
+    def test_csv_export_is_streamed(self):
+        response = self.client.get(reverse('payment_reports'), {'export': 'csv'})
+        self.assertIsInstance(response, StreamingHttpResponse)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'Reference,Amount,Currency,Method,Status,Created Date,Completed Date,Customer')
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(any(line.startswith('payment-a,100.00,KES,M-Pesa,Complete,') and line.endswith(',Alice')
+                            for line in lines))
+
+    def test_csv_export_respects_filters(self):
+        response = self.client.get(reverse('payment_reports'), {'export': 'csv', 'status': Payment.FAILED})
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].startswith('payment-c,'))
+        self.assertTrue(lines[1].endswith(',carol@example.com'))
+
+    def test_stats_use_single_query(self):
+        with self.assertNumQueries(1):
+            stats = payment_stats(Payment.objects.all())
+        self.assertEqual(stats['total_payments'], 3)
+        self.assertEqual(stats['successful_payments'], 1)
+        self.assertEqual(stats['pending_payments'], 1)
+        self.assertEqual(stats['failed_payments'], 1)
+        self.assertEqual(stats['total_amount'], Decimal('100.00'))
+        self.assertEqual(stats['count_7days'], 1)
+        self.assertEqual(stats['total_7days'], Decimal('100.00'))
+        self.assertEqual(stats['success_rate'], 33)
+        self.assertEqual(stats['avg_transaction'], 100.0)
+
+    def test_stats_exclude_old_payments_from_7day_window(self):
+        Payment.objects.filter(reference='payment-a').update(created_at=timezone.now() - timedelta(days=8))
+        stats = payment_stats(Payment.objects.all())
+        self.assertEqual(stats['successful_payments'], 1)
+        self.assertEqual(stats['count_7days'], 0)
+        self.assertEqual(stats['total_7days'], 0)
+
+    def test_stats_on_empty_queryset(self):
+        stats = payment_stats(Payment.objects.none())
+        self.assertEqual(stats['total_payments'], 0)
+        self.assertEqual(stats['total_amount'], 0)
+        self.assertEqual(stats['success_rate'], 0)
+        self.assertEqual(stats['avg_transaction'], 0)
+
+    def test_reports_page_renders_stats(self):
+        response = self.client.get(reverse('payment_reports'), {'search': 'payment-'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['stats']['total_payments'], 3)
+        self.assertEqual(response.context['stats']['successful_payments'], 1)
+
+    @override_settings(PAYMENT_REPORTS_CACHE_TTL=60)
+    def test_report_data_is_cached_until_payments_change(self):
+        reset_metrics()
+        params = {'status': Payment.COMPLETE}
+        first = self.client.get(reverse('payment_reports'), params)
+        with self.assertNumQueries(2):  # session and user only
+            second = self.client.get(reverse('payment_reports'), params)
+        self.assertEqual(first.context['stats'], second.context['stats'])
+        self.assertEqual(REPORT_CACHE_LOOKUPS.values, {('miss',): 1, ('hit',): 1})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Payment.objects.create(amount=Decimal('10.00'), reference='payment-d', status=Payment.COMPLETE)
+        third = self.client.get(reverse('payment_reports'), params)
+        self.assertEqual(third.context['stats']['total_payments'], 2)
+        self.assertEqual(REPORT_CACHE_LOOKUPS.values[('miss',)], 2)
+
+    @override_settings(PAYMENT_REPORTS_CACHE_TTL=60)
+    def test_transition_retires_cached_report(self):
+        self.client.get(reverse('payment_reports'))
+        generation = reports_generation()
+        with self.captureOnCommitCallbacks(execute=True):
+            transition_payment(Payment.objects.get(reference='payment-b'), Payment.COMPLETE)
+        self.assertGreater(reports_generation(), generation)
+        response = self.client.get(reverse('payment_reports'))
+        self.assertEqual(response.context['stats']['successful_payments'], 2)
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.server.peers.add(self.client_address)
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(self.server.delay)
+        if self.path.endswith('/checkout/'):
+            self.server.calls.append(payload['api_ref'])
+            if payload['email'] in self.server.rejected:
+                self.send_error(400)
+                return
+            reply = {'id': 'INV-NEW', 'url': 'https://checkout.example/INV-NEW'}
+        else:
+            self.server.calls.append(payload['invoice_id'])
+            state = self.server.states.get(payload['invoice_id'], 'COMPLETE')
+            reply = {'invoice': {'invoice_id': payload['invoice_id']}, 'state': state}
+        body = json.dumps(reply).encode()
+        self.send_response(self.server.reply_status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubGatewayMixin:
+    """Points the Intasend clients at a local StatusHandler server"""
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StatusHandler)
+        self.server.peers = set()
+        self.server.calls = []
+        self.server.states = {}
+        self.server.rejected = set()
+        self.server.delay = 0
+        self.server.reply_status = 200
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{self.server.server_port}/api/v1/'
+        settings_override = override_settings(INTASEND_API_BASE_URL=base_url)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        reset_intasend_service()
+        self.addCleanup(reset_intasend_service)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+
+class PooledGatewayTests(StubGatewayMixin, TestCase):
+    def test_client_is_shared(self):
+        self.assertIs(get_intasend_service(), get_intasend_service())
+
+    def test_reset_builds_new_client(self):
+        client = get_intasend_service()
+        reset_intasend_service()
+        self.assertIsNot(get_intasend_service(), client)
+
+    def test_connections_are_reused(self):
+        for _ in range(5):
+            response = get_intasend_service().collect.status(invoice_id='INV-1')
+            self.assertEqual(response['state'], 'COMPLETE')
+        self.assertEqual(len(self.server.peers), 1)
+
+    def test_status_cache_ttl_depends_on_state(self):
+        cache.clear()
+        reset_status_cache_metrics()
+        self.server.states = {'INV-DONE': 'COMPLETE', 'INV-WAIT': 'PENDING'}
+        for _ in range(3):
+            get_cached_status('INV-DONE')
+            get_cached_status('INV-WAIT')
+        self.assertEqual(self.server.calls.count('INV-DONE'), 1)
+        self.assertEqual(self.server.calls.count('INV-WAIT'), 1)
+
+        # Callbacks skip a cached pending reply but still reuse a terminal one
+        get_cached_status('INV-WAIT', refresh_pending=True)
+        get_cached_status('INV-DONE', refresh_pending=True)
+        self.assertEqual(self.server.calls.count('INV-WAIT'), 2)
+        self.assertEqual(self.server.calls.count('INV-DONE'), 1)
+
+        with override_settings(INTASEND_STATUS_CACHE_PENDING_TTL=0):
+            cache.delete(status_cache_key('INV-WAIT'))
+            get_cached_status('INV-WAIT')
+            get_cached_status('INV-WAIT')
+        self.assertEqual(self.server.calls.count('INV-WAIT'), 4)
+
+        metrics = status_cache_metrics()
+        self.assertEqual(metrics['gateway_calls'], 5)
+        self.assertEqual(metrics['hits'], 5)
+        self.assertEqual(metrics['calls_saved'], 5)
+        self.assertEqual(metrics['hit_rate'], 0.5)
+
+    def test_concurrent_misses_share_one_request(self):
+        cache.clear()
+        reset_status_cache_metrics()
+        self.server.delay = 0.2
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(get_cached_status('INV-BUSY')))
+                   for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 10)
+        self.assertEqual(self.server.calls, ['INV-BUSY'])
+        self.assertEqual(status_cache_metrics()['collapsed'], 9)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, INTASEND_TEST_MODE=False, INTASEND_STATUS_TIMEOUT=0.1,
+                   INTASEND_CIRCUIT_FAILURE_THRESHOLD=3, INTASEND_CIRCUIT_RESET_TIMEOUT=60)
+class CircuitBreakerTests(StubGatewayMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        reset_metrics()
+        self.client.force_login(User.objects.create_user(username='finance', password='secret-pass-123'))
+        # Replies to calls that already timed out hit closed sockets; don't print those
+        self.server.handle_error = lambda request, client_address: None
+
+    def status_call(self):
+        start = time.perf_counter()
+        try:
+            get_intasend_service().collect.status(invoice_id='INV-1')
+            error = None
+        except Exception as e:
+            error = e
+        return error, time.perf_counter() - start
+
+    def test_outage_bounds_worker_time(self):
+        # Intasend hangs: calls give up at the deadline, then fail fast once the circuit opens
+        self.server.delay = 1.0
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda _: self.status_call(), range(24)))
+        self.assertTrue(all(error is not None for error, _ in results))
+        self.assertLess(max(seconds for _, seconds in results), 0.5)
+        short_circuited = [error for error, _ in results if isinstance(error, GatewayUnavailable)]
+        self.assertGreaterEqual(len(short_circuited), 24 - 8 - 3)
+        self.assertEqual(circuit_breaker.state, circuit_breaker.OPEN)
+        self.assertIn('payment_gateway_circuit_state 2', render_metrics())
+
+    def test_half_open_probe_closes_circuit(self):
+        self.server.delay = 0.3
+        for _ in range(3):
+            self.assertIsInstance(self.status_call()[0], requests.Timeout)
+        self.assertIsInstance(self.status_call()[0], GatewayUnavailable)
+
+        self.server.delay = 0
+        with override_settings(INTASEND_CIRCUIT_RESET_TIMEOUT=0):
+            self.assertIsNone(self.status_call()[0])
+        self.assertEqual(circuit_breaker.state, circuit_breaker.CLOSED)
+
+    def test_upstream_5xx_opens_circuit(self):
+        # A proxy's 503 still carries a JSON body that looks like a status reply
+        self.server.reply_status = 503
+        for _ in range(3):
+            self.assertIsInstance(self.status_call()[0], IntaSendServerError)
+        self.assertIsInstance(self.status_call()[0], GatewayUnavailable)
+        self.assertEqual(circuit_breaker.state, circuit_breaker.OPEN)
+
+    def test_bad_requests_do_not_open_circuit(self):
+        self.server.rejected = {'bad@example.com'}
+        for _ in range(5):
+            with self.assertRaises(IntaSendBadRequest):
+                get_intasend_service().collect.checkout(email='bad@example.com', amount=10, currency='KES')
+        self.assertEqual(circuit_breaker.state, circuit_breaker.CLOSED)
+
+    def test_views_degrade_while_open(self):
+        for _ in range(3):
+            circuit_breaker.record_failure()
+        payment = Payment.objects.create(amount=Decimal('10.00'), checkout_id='INV-DOWN')
+
+        response = self.client.get(reverse('payment_status', args=[payment.id]))
+        self.assertContains(response, "can't reach the payment provider")
+        response = self.client.post(reverse('create_checkout'), {'amount': '10'})
+        self.assertEqual(response.status_code, 503)
+        # With no callback worker configured, Intasend is asked to resend the callback later
+        response = self.client.get(reverse('payment_callback'), {'invoice_id': 'INV-DOWN', 'state': 'COMPLETE'})
+        self.assertEqual(response.status_code, 503)
+        self.assertGreater(int(response['Retry-After']), 0)
+
+        self.assertEqual(self.server.calls, [])
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertFalse(CallbackEvent.objects.exists())
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, Payment.PENDING)
+
+    @override_settings(PAYMENT_CALLBACK_ASYNC=True)
+    def test_queued_callback_waits_for_circuit(self):
+        for _ in range(3):
+            circuit_breaker.record_failure()
+        payment = Payment.objects.create(amount=Decimal('10.00'), checkout_id='INV-DOWN')
+        response = self.client.get(reverse('payment_callback'), {'invoice_id': 'INV-DOWN', 'state': 'COMPLETE'})
+        self.assertEqual(response.status_code, 200)
+        event = CallbackEvent.objects.get()
+        self.assertEqual(event.checkout_id, 'INV-DOWN')
+
+        # The worker leaves it queued until Intasend is back, then confirms it
+        self.assertEqual(drain_callback_queue(), 0)
+        circuit_breaker.record_success()
+        self.assertEqual(drain_callback_queue(), 1)
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, Payment.COMPLETE)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, INTASEND_TEST_MODE=False)
+class AsyncViewTests(StubGatewayMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.factory = AsyncRequestFactory()
+        self.user = User.objects.create_user(username='async', password='pw')
+
+    async def auser(self):
+        return self.user
+
+    async def test_checkout_records_invoice(self):
+        request = self.factory.post('/checkout/', {'amount': '25', 'email': 'a@example.com'})
+        response = await async_views.create_checkout(request)
+        await get_async_intasend_service().aclose()
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, 'https://checkout.example/INV-NEW')
+        payment = await Payment.objects.aget()
+        self.assertEqual(payment.checkout_id, 'INV-NEW')
+        self.assertEqual(self.server.calls, [payment.reference])
+
+    async def test_callback_and_status_complete_payment(self):
+        callback_payment = await Payment.objects.acreate(amount=Decimal('10.00'), checkout_id='INV-CB')
+        status_payment = await Payment.objects.acreate(amount=Decimal('5.00'), checkout_id='INV-ST')
+
+        await async_views.payment_callback(self.factory.get('/callback/', {'invoice_id': 'INV-CB'}))
+        request = self.factory.get(f'/status/{status_payment.id}/')
+        request.auser = self.auser
+        response = await async_views.payment_status(request, status_payment.id)
+        await get_async_intasend_service().aclose()
+
+        self.assertEqual(response.status_code, 200)
+        for payment in (callback_payment, status_payment):
+            await payment.arefresh_from_db()
+            self.assertEqual(payment.status, Payment.COMPLETE)
+        self.assertEqual(sorted(self.server.calls), ['INV-CB', 'INV-ST'])
+
+    async def test_concurrent_misses_share_one_request(self):
+        self.server.delay = 0.2
+        results = await asyncio.gather(*(aget_cached_status('INV-BUSY') for _ in range(10)))
+        await get_async_intasend_service().aclose()
+        self.assertEqual([r['state'] for r in results], ['COMPLETE'] * 10)
+        self.assertEqual(self.server.calls, ['INV-BUSY'])
+
+
+@override_settings(PAYMENT_STREAM_POLL_INTERVAL=0.05, PAYMENT_STREAM_HEARTBEAT=5)
+class StatusStreamTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='payer', password='pw')
+        self.payment = Payment.objects.create(amount=Decimal('10.00'), checkout_id='INV-SSE')
+
+    async def auser(self):
+        return self.user
+
+    async def open_stream(self, payment_id):
+        request = AsyncRequestFactory().get(f'/status/{payment_id}/events/')
+        request.auser = self.auser
+        response = await async_views.payment_events(request, payment_id)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        return aiter(response.streaming_content)
+
+    def complete(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            transition_payment(Payment.objects.get(id=self.payment.id), Payment.COMPLETE)
+
+    @override_settings(SECURE_SSL_REDIRECT=False)
+    def test_wsgi_status_page_keeps_refresh(self):
+        # Tests run with sync views and a locmem cache, as under gunicorn by default
+        payment = Payment.objects.create(amount=Decimal('10.00'))
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('payment_status', args=[payment.id]))
+        self.assertNotContains(response, 'EventSource')
+        self.assertContains(response, 'You can refresh this page')
+        with self.assertRaises(NoReverseMatch):
+            reverse('payment_events', args=[payment.id])
+
+    async def test_pushes_status_change_and_ends(self):
+        events = await self.open_stream(self.payment.id)
+        self.assertIn(b'"status": "pending"', await anext(events))
+        next_event = asyncio.ensure_future(anext(events))
+        await asyncio.sleep(0.01)
+        self.assertFalse(next_event.done())
+
+        await sync_to_async(self.complete)()
+        self.assertEqual(await asyncio.wait_for(next_event, 1),
+                         f'event: status\ndata: {{"id": {self.payment.id}, "status": "complete"}}\n\n'.encode())
+        with self.assertRaises(StopAsyncIteration):
+            await anext(events)
+
+    async def test_change_from_another_process_is_seen_through_cache(self):
+        events = await self.open_stream(self.payment.id)
+        await anext(events)
+        # Another worker's transition: only the DB row and the cached version change here
+        await Payment.objects.filter(id=self.payment.id).aupdate(status=Payment.FAILED)
+        await cache.aset(status_version_key(self.payment.id), 1)
+        self.assertIn(b'"status": "failed"', await asyncio.wait_for(anext(events), 1))
+
+    async def test_final_payment_gets_one_event(self):
+        await Payment.objects.filter(id=self.payment.id).aupdate(status=Payment.COMPLETE)
+        events = await self.open_stream(self.payment.id)
+        self.assertIn(b'"status": "complete"', await anext(events))
+        with self.assertRaises(StopAsyncIteration):
+            await anext(events)
+
+
+class LoggingPipelineTests(TestCase):
+    def record(self, level=logging.DEBUG, **extra):
+        record = logging.makeLogRecord({'name': 'payment.test', 'levelno': level, 'msg': 'Status %s', 'args': ('ok',)})
+        record.__dict__.update(extra)
+        return record
+
+    def test_json_formatter_caps_payloads(self):
+        formatter = JsonFormatter(max_field_chars=50)
+        line = json.loads(formatter.format(self.record(event='gateway_response', payload={'data': 'x' * 500})))
+        self.assertEqual(line['message'], 'Status ok')
+        self.assertEqual(line['event'], 'gateway_response')
+        self.assertLess(len(line['payload']), 100)
+        self.assertTrue(line['payload'].endswith('[512 chars]'))
+
+    def test_sampling_keeps_warnings_and_unsampled_events(self):
+        sampler = SamplingFilter({'gateway_response': 0})
+        self.assertFalse(sampler.filter(self.record(event='gateway_response')))
+        self.assertTrue(sampler.filter(self.record(logging.WARNING, event='gateway_response')))
+        self.assertTrue(sampler.filter(self.record(event='other')))
+        self.assertTrue(sampler.filter(self.record()))
+
+    def test_queue_handler_drops_instead_of_blocking(self):
+        target = logging.handlers.BufferingHandler(100)
+        handler = QueueListenerHandler([target], maxsize=1)
+        handler.stop()
+        for _ in range(3):
+            handler.handle(self.record())
+        self.assertEqual(handler.dropped, 2)
+        handler.start()
+        handler.stop()
+        self.assertEqual([r.getMessage() for r in target.buffer], ['Status ok'])
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, INTASEND_TEST_MODE=False)
+class MetricsTests(StubGatewayMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        reset_metrics()
+        reset_status_cache_metrics()
+        self.user = User.objects.create_user(username='metrics', password='pw', is_staff=True)
+        self.client.force_login(self.user)
+
+    def samples(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        lines = response.content.decode().splitlines()
+        return dict(line.rsplit(' ', 1) for line in lines if not line.startswith('#'))
+
+    def test_status_view_is_measured(self):
+        self.server.delay = 0.05
+        payment = Payment.objects.create(amount=Decimal('10.00'), checkout_id='INV-M')
+        for _ in range(2):
+            self.client.get(reverse('payment_status', args=[payment.id]))
+
+        samples = self.samples()
+        route = 'route="status/<int:payment_id>/"'
+        # The second view hit finds the payment complete and skips the gateway
+        self.assertEqual(self.server.calls, ['INV-M'])
+        self.assertEqual(samples['payment_gateway_request_duration_seconds_count{endpoint="payment/status/"}'], '1')
+        self.assertEqual(samples['payment_gateway_request_duration_seconds_bucket{endpoint="payment/status/",le="0.05"}'], '0')
+        self.assertGreaterEqual(float(samples['payment_gateway_request_duration_seconds_sum{endpoint="payment/status/"}']), 0.05)
+        self.assertEqual(samples[f'payment_http_request_duration_seconds_count{{{route},method="GET",status="200"}}'], '2')
+        self.assertGreaterEqual(float(samples[f'payment_http_gateway_seconds_total{{{route}}}']), 0.05)
+        self.assertGreater(int(samples[f'payment_http_db_queries_total{{{route}}}']), 2)
+        self.assertEqual(samples['payment_status_cache_lookups_total{outcome="gateway_calls"}'], '1')
+
+    def test_gateway_errors_are_counted(self):
+        self.server.server_close()
+        self.server.shutdown()
+        with self.assertRaises(requests.ConnectionError):
+            get_intasend_service().collect.status(invoice_id='INV-DOWN')
+        samples = self.samples()
+        self.assertEqual(samples['payment_gateway_errors_total{endpoint="payment/status/",error="ConnectionError"}'], '1')
+
+    def test_non_staff_are_denied_without_token(self):
+        self.client.logout()
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.client.force_login(User.objects.create_user(username='clerk', password='pw'))
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_token_is_accepted_when_set(self):
+        self.client.logout()
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, INTASEND_TEST_MODE=False)
+class BulkCheckoutTests(StubGatewayMixin, TestCase):
+    BATCH = (
+        'amount,currency,email,first_name,last_name\n'
+        '100,KES,a@example.com,Ann,One\n'
+        'abc,KES,b@example.com,Bad,Amount\n'
+        '250.50,,c@example.com,Cy,Three\n'
+        '75,USD,reject@example.com,Rae,Ject\n'
+    )
+
+    def test_batch_is_inserted_and_checked_out(self):
+        self.server.rejected = {'reject@example.com'}
+        report = create_bulk_checkouts(parse_batch(self.BATCH), concurrency=2, rate=0, batch_size=2)
+
+        self.assertEqual([entry['status'] for entry in report], ['created', 'invalid', 'created', 'failed'])
+        self.assertIn('Invalid amount', report[1]['error'])
+        self.assertEqual(report[0]['checkout_id'], 'INV-NEW')
+        self.assertEqual(report[0]['url'], 'https://checkout.example/INV-NEW')
+        self.assertEqual(sorted(self.server.calls), sorted(entry['reference'] for entry in report if 'reference' in entry))
+
+        payments = {payment.reference: payment for payment in Payment.objects.all()}
+        self.assertEqual(len(payments), 3)
+        created = payments[report[2]['reference']]
+        self.assertEqual((created.amount, created.currency, created.status), (Decimal('250.50'), 'KES', Payment.PENDING))
+        self.assertEqual(created.checkout_id, 'INV-NEW')
+        rejected = payments[report[3]['reference']]
+        self.assertEqual((rejected.status, rejected.checkout_id), (Payment.FAILED, ''))
+
+        # bulk_create/bulk_update kept the rollup in step
+        rollup = {(row.status, row.currency): (row.count, row.amount)
+                  for row in PaymentDailyRollup.objects.filter(count__gt=0)}
+        self.assertEqual(rollup, {
+            (Payment.PENDING, 'KES'): (2, Decimal('350.50')),
+            (Payment.FAILED, 'USD'): (1, Decimal('75.00')),
+        })
+
+    def test_json_numbers_are_accepted_or_reported(self):
+        rows = parse_batch(json.dumps([
+            {'amount': 10, 'phone_number': 254712345678, 'email': 'a@example.com'},
+            {'amount': 20, 'currency': 404},
+        ]), 'json')
+        report = create_bulk_checkouts(rows, concurrency=1, rate=0)
+        self.assertEqual([entry['status'] for entry in report], ['created', 'invalid'])
+        self.assertIn('Invalid currency', report[1]['error'])
+        self.assertEqual(Payment.objects.get().payer_phone, '254712345678')
+
+    def test_write_back_keeps_status_set_by_callback(self):
+        payment = Payment.objects.create(amount=Decimal('10.00'), reference='bulk-race')
+        payment.checkout_id = 'INV-RACE'
+        # The callback lands while the rest of the batch is still being checked out
+        transition_payment(Payment.objects.get(id=payment.id), Payment.COMPLETE)
+        write_results([payment], [])
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.checkout_id), (Payment.COMPLETE, 'INV-RACE'))
+
+    def test_endpoint_is_staff_only(self):
+        batch = json.dumps({'payments': [{'amount': 10, 'email': 'a@example.com'}]})
+        user = User.objects.create_user(username='clerk', password='pw')
+        self.client.force_login(user)
+        response = self.client.post(reverse('bulk_checkout'), batch, content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+        user.is_staff = True
+        user.save()
+        response = self.client.post(reverse('bulk_checkout'), batch, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['created'], 1)
+        self.assertEqual(Payment.objects.get().checkout_id, 'INV-NEW')
+
+
+def fake_service(response):
+    service = mock.Mock()
+    service.collect.status.return_value = response
+    return service
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, INTASEND_TEST_MODE=False)
+class CreateCheckoutTests(TestCase):
+    def test_checkout_writes_payment_once_then_sets_checkout_id(self):
+        # An existing payment today means the rollup bucket is already there
+        Payment.objects.create(amount=Decimal('1.00'))
+        service = mock.Mock()
+        service.collect.checkout.return_value = {'id': 'INV-ONE', 'url': 'https://checkout.example/INV-ONE'}
+        with mock.patch('payment.views.get_intasend_service', return_value=service):
+            # INSERT the payment, bump the rollup bucket, UPDATE checkout_id
+            with self.assertNumQueries(3):
+                response = self.client.post(reverse('create_checkout'), {'amount': '40', 'email': 'a@example.com'})
+        self.assertRedirects(response, 'https://checkout.example/INV-ONE', fetch_redirect_response=False)
+        payment = Payment.objects.latest('id')
+        self.assertEqual(payment.checkout_id, 'INV-ONE')
+        self.assertEqual(service.collect.checkout.call_args.kwargs['api_ref'], payment.reference)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, INTASEND_TEST_MODE=False)
+class PaymentCallbackTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.payment = Payment.objects.create(amount=Decimal('10.00'), reference='payment-cb', checkout_id='INV-CB')
+
+    def test_sync_callback_completes_payment(self):
+        service = fake_service({'state': 'COMPLETE', 'provider': 'MPESA'})
+        with mock.patch('payment.gateway.get_intasend_service', return_value=service):
+            response = self.client.get(reverse('payment_callback'), {'invoice_id': 'INV-CB'})
+        self.assertTrue(response.context['success'])
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, Payment.COMPLETE)
+        self.assertEqual(self.payment.payment_method, Payment.MPESA)
+        self.assertIsNotNone(self.payment.completed_at)
+
+    def test_unverified_callback_leaves_payment_pending(self):
+        service = fake_service(None)
+        service.collect.status.side_effect = [requests.Timeout('slow'), {'state': 'COMPLETE'}]
+        with mock.patch('payment.gateway.get_intasend_service', return_value=service):
+            self.assertIsNone(reconcile_callback(find_payment('INV-CB'), 'INV-CB'))
+            self.payment.refresh_from_db()
+            self.assertEqual(self.payment.status, Payment.PENDING)
+            reconcile_callback(self.payment, 'INV-CB')
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, Payment.COMPLETE)
+
+    @override_settings(PAYMENT_CALLBACK_ASYNC=True)
+    def test_async_callback_is_queued_without_gateway_call(self):
+        with mock.patch('payment.gateway.get_intasend_service') as get_service:
+            with self.assertNumQueries(1):
+                self.client.post(reverse('payment_callback'), {'invoice_id': 'INV-CB', 'state': 'COMPLETE'})
+        get_service.assert_not_called()
+        event = CallbackEvent.objects.get()
+        self.assertEqual(event.checkout_id, 'INV-CB')
+        self.assertEqual(event.state, CallbackEvent.QUEUED)
+        self.assertEqual(event.payload['state'], 'COMPLETE')
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, Payment.PENDING)
+
+    def test_worker_drains_queue(self):
+        CallbackEvent.objects.create(checkout_id='INV-CB', status='COMPLETE')
+        service = fake_service({'state': 'COMPLETE'})
+        with mock.patch('payment.gateway.get_intasend_service', return_value=service):
+            self.assertEqual(drain_callback_queue(), 1)
+            self.assertEqual(drain_callback_queue(), 0)
+        self.assertEqual(CallbackEvent.objects.get().state, CallbackEvent.DONE)
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, Payment.COMPLETE)
+
+    def test_worker_retries_after_gateway_error(self):
+        CallbackEvent.objects.create(checkout_id='INV-CB')
+        service = fake_service(None)
+        service.collect.status.side_effect = [requests.Timeout('slow'), {'state': 'COMPLETE'}]
+        with mock.patch('payment.gateway.get_intasend_service', return_value=service):
+            drain_callback_queue(max_attempts=3, retry_delay=0)
+            event = CallbackEvent.objects.get()
+            self.assertEqual((event.state, event.attempts), (CallbackEvent.QUEUED, 1))
+            self.assertIn('slow', event.last_error)
+            self.payment.refresh_from_db()
+            self.assertEqual(self.payment.status, Payment.PENDING)
+            drain_callback_queue(max_attempts=3, retry_delay=0)
+        event.refresh_from_db()
+        self.assertEqual(event.state, CallbackEvent.DONE)
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, Payment.COMPLETE)
+
+    def test_open_circuit_does_not_use_up_attempts(self):
+        CallbackEvent.objects.create(checkout_id='INV-CB')
+        with mock.patch('payment.callbacks.reconcile_callback', side_effect=GatewayUnavailable('open')):
+            for _ in range(3):
+                drain_callback_queue(max_attempts=1, retry_delay=0)
+        event = CallbackEvent.objects.get()
+        self.assertEqual((event.state, event.attempts), (CallbackEvent.QUEUED, 0))
+
+    def test_failed_callback_waits_before_retry(self):
+        CallbackEvent.objects.create(checkout_id='INV-EARLY')
+        self.assertEqual(drain_callback_queue(), 1)
+        self.assertEqual(drain_callback_queue(), 0)
+        event = CallbackEvent.objects.get()
+        self.assertEqual((event.state, event.attempts), (CallbackEvent.QUEUED, 1))
+
+    def test_worker_retries_then_fails_unknown_payment(self):
+        CallbackEvent.objects.create(checkout_id='INV-MISSING')
+        drain_callback_queue(max_attempts=2, retry_delay=0)
+        event = CallbackEvent.objects.get()
+        self.assertEqual(event.state, CallbackEvent.QUEUED)
+        self.assertEqual(event.attempts, 1)
+        drain_callback_queue(max_attempts=2, retry_delay=0)
+        event.refresh_from_db()
+        self.assertEqual(event.state, CallbackEvent.FAILED)
+        self.assertIn('INV-MISSING', event.last_error)
+
+
+class ReconcilePaymentsTests(TestCase):
+    def setUp(self):
+        old = timezone.now() - timedelta(hours=2)
+        self.complete = Payment.objects.create(amount=Decimal('10.00'), checkout_id='INV-OK')
+        self.failed = Payment.objects.create(amount=Decimal('10.00'), checkout_id='INV-BAD')
+        self.pending = Payment.objects.create(amount=Decimal('10.00'), checkout_id='INV-WAIT')
+        self.flaky = Payment.objects.create(amount=Decimal('10.00'), checkout_id='INV-FLAKY')
+        Payment.objects.update(created_at=old)
+        self.fresh = Payment.objects.create(amount=Decimal('10.00'), checkout_id='INV-NEW')
+        self.calls = []
+
+    def status(self, invoice_id):
+        self.calls.append(invoice_id)
+        if invoice_id == 'INV-FLAKY' and self.calls.count(invoice_id) == 1:
+            raise requests.ConnectionError('reset by peer')
+        states = {'INV-OK': 'COMPLETE', 'INV-BAD': 'FAILED', 'INV-WAIT': 'PENDING', 'INV-FLAKY': 'COMPLETE'}
+        return {'state': states[invoice_id], 'provider': 'CARD-PAYMENT'}
+
+    def test_reconciles_stale_pending_payments(self):
+        service = mock.Mock()
+        service.collect.status.side_effect = self.status
+        with mock.patch('payment.reconcile.get_intasend_service', return_value=service):
+            totals = reconcile_pending_payments(page_size=2, concurrency=2, rate=0, backoff=0)
+
+        self.assertEqual(totals, {'checked': 4, 'updated': 4, 'errors': 0})
+        self.assertNotIn('INV-NEW', self.calls)
+        self.assertEqual(self.calls.count('INV-FLAKY'), 2)
+        for payment, status in [(self.complete, Payment.COMPLETE), (self.failed, Payment.FAILED),
+                                (self.pending, Payment.PENDING), (self.flaky, Payment.COMPLETE),
+                                (self.fresh, Payment.PENDING)]:
+            payment.refresh_from_db()
+            self.assertEqual(payment.status, status)
+        self.assertEqual(self.complete.payment_method, Payment.CARD)
+        self.assertIsNotNone(self.complete.completed_at)
+
+
+class PaymentRollupTests(TestCase):
+    def rollup_rows(self):
+        return sorted(
+            (row.date, row.status, row.payment_method, row.currency, row.count, row.amount)
+            for row in PaymentDailyRollup.objects.exclude(count=0)
+        )
+
+    def assertRollupMatchesPayments(self):
+        incremental = self.rollup_rows()
+        rebuild_rollups()
+        self.assertEqual(incremental, self.rollup_rows())
+
+    def test_rollup_follows_payment_changes(self):
+        first = Payment.objects.create(amount=10.5)
+        second = Payment.objects.create(amount=Decimal('20.00'), currency='USD')
+        first.status = Payment.COMPLETE
+        first.payment_method = Payment.CARD
+        first.save()
+        Payment.objects.create(amount=Decimal('5.00'), status=Payment.FAILED)
+        second.delete()
+
+        deferred = Payment.objects.only('id', 'status').get(id=first.id)
+        deferred.status = Payment.FAILED
+        deferred.save()
+
+        self.assertRollupMatchesPayments()
+        self.assertEqual(PaymentDailyRollup.objects.get(status=Payment.FAILED, payment_method=Payment.CARD).count, 1)
+
+    def test_rollup_stats_match_raw_stats(self):
+        for amount, status, method in [(10, Payment.COMPLETE, Payment.MPESA), (20, Payment.COMPLETE, Payment.CARD),
+                                       (30, Payment.PENDING, Payment.UNKNOWN), (40, Payment.FAILED, Payment.CARD)]:
+            Payment.objects.create(amount=Decimal(amount), status=status, payment_method=method)
+        old = Payment.objects.create(amount=Decimal('50.00'), status=Payment.COMPLETE, payment_method=Payment.MPESA)
+        Payment.objects.filter(id=old.id).update(created_at=timezone.now() - timedelta(days=9))
+        rebuild_rollups()
+
+        today = timezone.localdate()
+        for filters in [{}, {'status': Payment.COMPLETE}, {'payment_method': Payment.CARD},
+                        {'date_from': today - timedelta(days=1), 'date_to': today + timedelta(days=1)}]:
+            payments = Payment.objects.all()
+            if 'status' in filters:
+                payments = payments.filter(status=filters['status'])
+            if 'payment_method' in filters:
+                payments = payments.filter(payment_method=filters['payment_method'])
+            if 'date_from' in filters:
+                payments = payments.filter(created_at__gte=start_of_day(filters['date_from']),
+                                           created_at__lt=start_of_day(filters['date_to']))
+            with self.subTest(filters=filters):
+                self.assertEqual(rollup_stats(payments, **filters), payment_stats(payments))
+
+
+class PaymentWindowTests(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        ages = [timedelta(minutes=3), timedelta(minutes=59), timedelta(minutes=61), timedelta(hours=23, minutes=30),
+                timedelta(hours=25), timedelta(days=6, hours=23), timedelta(days=8), timedelta(days=29, minutes=7),
+                timedelta(days=31), timedelta(days=40)]
+        for number, age in enumerate(ages):
+            Payment.objects.create(amount=Decimal(number + 1), status=Payment.COMPLETE, completed_at=self.now - age,
+                                   payment_method=Payment.CARD if number % 3 else Payment.MPESA,
+                                   currency='USD' if number % 4 == 0 else 'KES')
+        # No completed_at, so it counts from created_at
+        Payment.objects.create(amount=Decimal('7.50'), status=Payment.COMPLETE, payment_method=Payment.MPESA)
+        Payment.objects.create(amount=Decimal('90.00'), status=Payment.PENDING)
+        pending = Payment.objects.create(amount=Decimal('11.00'))
+        transition_payment(pending, Payment.COMPLETE, Payment.CARD)
+        refunded = Payment.objects.create(amount=Decimal('13.00'), status=Payment.COMPLETE,
+                                          completed_at=self.now - timedelta(hours=2))
+        refunded.status = Payment.FAILED
+        refunded.save()
+
+    def oracle(self, window, payment_method=''):
+        start, _ = window_bounds(window, self.now)
+        payments = Payment.objects.filter(status=Payment.COMPLETE).annotate(
+            completed=Coalesce('completed_at', 'created_at')).filter(completed__gte=start)
+        if payment_method:
+            payments = payments.filter(payment_method=payment_method)
+        totals = payments.aggregate(count=Count('id'), amount=Sum('amount'))
+        return totals['count'], totals['amount'] or Decimal('0')
+
+    def assertWindowsMatchOracle(self):
+        for name, window in WINDOWS.items():
+            for payment_method in ['', Payment.MPESA, Payment.CARD]:
+                with self.subTest(window=name, payment_method=payment_method):
+                    stats = window_stats(window, payment_method, self.now)
+                    self.assertEqual((stats['count'], stats['amount']), self.oracle(window, payment_method))
+
+    def test_incremental_windows_match_raw_payments(self):
+        self.assertWindowsMatchOracle()
+        self.assertEqual(window_stats(WINDOWS['1h'], now=self.now)['count'], 4)
+
+    def test_rebuilt_windows_match_raw_payments(self):
+        rebuild_rollups()
+        self.assertWindowsMatchOracle()
+
+    @override_settings(PAYMENT_WINDOW_MINUTE_RETENTION_DAYS=2)
+    def test_windows_past_minute_retention_start_on_the_hour(self):
+        self.assertGreater(prune_window_buckets(), 0)
+        self.assertFalse(PaymentWindowBucket.objects.filter(
+            resolution=PaymentWindowBucket.MINUTE, start__lt=self.now - timedelta(days=3)).exists())
+        start, _ = window_bounds(WINDOWS['7d'], self.now)
+        self.assertEqual((start.minute, start.second), (0, 0))
+        self.assertWindowsMatchOracle()
+
+    def test_window_stats_never_read_payments(self):
+        with CaptureQueriesContext(connection) as queries:
+            window_stats(WINDOWS['30d'], Payment.CARD, self.now)
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('"payment_payment"', queries[0]['sql'])
+
+    @override_settings(SECURE_SSL_REDIRECT=False, DATABASE_ROUTERS=[])
+    def test_windows_endpoint(self):
+        self.client.force_login(User.objects.create_user(username='finance', password='secret-pass-123'))
+        response = self.client.get(reverse('payment_windows'), {'window': '24h', 'payment_method': Payment.MPESA})
+        count, amount = self.oracle(WINDOWS['24h'], Payment.MPESA)
+        self.assertEqual(response.json()['windows']['24h']['count'], count)
+        self.assertEqual(Decimal(response.json()['windows']['24h']['amount']), amount)
+        self.assertEqual(self.client.get(reverse('payment_windows'), {'window': '2w'}).status_code, 400)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, DATABASE_ROUTERS=[], PAYMENT_EXPORT_LAG_SECONDS=0)
+class PaymentExportTests(TestCase):
+    def setUp(self):
+        self.complete = Payment.objects.create(amount=Decimal('1234.56'), reference='payment-a', status=Payment.COMPLETE,
+                                               payment_method=Payment.MPESA, completed_at=timezone.now(),
+                                               payer_name='Alice')
+        self.pending = Payment.objects.create(amount=Decimal('0.10'), currency='USD', reference='payment-b')
+
+    def read(self, data, export_format):
+        if export_format == 'parquet':
+            return pq.read_table(pa.BufferReader(data))
+        return pa.ipc.open_file(pa.BufferReader(data)).read_all()
+
+    def test_formats_keep_decimal_and_timestamp_types(self):
+        for export_format in ['parquet', 'arrow']:
+            with self.subTest(export_format=export_format):
+                buffer = io.BytesIO()
+                payments, _ = export_window(Payment.objects.all())
+                self.assertEqual(write_payments(payments, buffer, export_format, batch_size=1), 2)
+                table = self.read(buffer.getvalue(), export_format)
+                self.assertEqual(table.schema, EXPORT_SCHEMA)
+                rows = table.to_pylist()
+                self.assertEqual([row['amount'] for row in rows], [Decimal('1234.56'), Decimal('0.10')])
+                self.assertEqual(rows[0]['completed_at'], self.complete.completed_at)
+                self.assertIsNone(rows[1]['completed_at'])
+                self.assertEqual(rows[1]['currency'], 'USD')
+
+    def test_incremental_export_since_watermark(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'payments.parquet')
+            watermark = os.path.join(directory, 'watermark')
+            call_command('export_payments', output, watermark_file=watermark, stdout=io.StringIO())
+            self.assertEqual(pq.read_table(output).num_rows, 2)
+
+            transition_payment(self.pending, Payment.FAILED)
+            call_command('export_payments', output, watermark_file=watermark, stdout=io.StringIO())
+            table = pq.read_table(output)
+            self.assertEqual(table.column('reference').to_pylist(), ['payment-b'])
+            self.assertEqual(table.column('status').to_pylist(), [Payment.FAILED])
+
+            call_command('export_payments', output, watermark_file=watermark, stdout=io.StringIO())
+            self.assertEqual(pq.read_table(output).num_rows, 0)
+
+    def test_export_endpoint_streams_file(self):
+        self.client.force_login(User.objects.create_user(username='finance', password='secret-pass-123'))
+        response = self.client.get(reverse('payment_export'), {'format': 'arrow'})
+        self.assertIsInstance(response, StreamingHttpResponse)
+        table = self.read(b''.join(response.streaming_content), 'arrow')
+        self.assertEqual(table.column('reference').to_pylist(), ['payment-a', 'payment-b'])
+
+        response = self.client.get(reverse('payment_export'), {'since': response['X-Export-Watermark']})
+        self.assertEqual(self.read(b''.join(response.streaming_content), 'parquet').num_rows, 0)
+        self.assertEqual(self.client.get(reverse('payment_export'), {'format': 'xlsx'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('payment_export'), {'since': 'yesterday'}).status_code, 400)
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, PAYMENT_REPORTS_PAGE_SIZE=2, DATABASE_ROUTERS=[])
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(User.objects.create_user(username='finance', password='secret-pass-123'))
+        same_time = timezone.now() - timedelta(hours=1)
+        self.payments = [
+            Payment.objects.create(amount=Decimal(i + 1), reference=f'payment-{i}',
+                                   status=Payment.COMPLETE if i % 2 else Payment.PENDING)
+            for i in range(5)
+        ]
+        # Two payments share a timestamp so the id tiebreak matters
+        Payment.objects.filter(id__in=[self.payments[1].id, self.payments[2].id]).update(created_at=same_time)
+        self.ordered = list(Payment.objects.order_by('-created_at', '-id'))
+
+    def test_walks_forward_and_back(self):
+        rows, next_cursor, previous_cursor = keyset_page(Payment.objects.all(), 2)
+        self.assertEqual(rows, self.ordered[:2])
+        self.assertEqual(previous_cursor, '')
+        seen = list(rows)
+        while next_cursor:
+            rows, next_cursor, previous_cursor = keyset_page(Payment.objects.all(), 2, after=next_cursor)
+            self.assertTrue(previous_cursor)
+            seen.extend(rows)
+        self.assertEqual(seen, self.ordered)
+
+        rows, next_cursor, previous_cursor = keyset_page(Payment.objects.all(), 2, before=previous_cursor)
+        self.assertEqual(rows, self.ordered[2:4])
+        self.assertTrue(next_cursor)
+        rows, next_cursor, previous_cursor = keyset_page(Payment.objects.all(), 2, before=previous_cursor)
+        self.assertEqual(rows, self.ordered[:2])
+        self.assertEqual(previous_cursor, '')
+
+    def test_invalid_cursor_returns_first_page(self):
+        rows, _, previous_cursor = keyset_page(Payment.objects.all(), 2, after='not-a-cursor')
+        self.assertEqual(rows, self.ordered[:2])
+        self.assertEqual(previous_cursor, '')
+
+    def test_report_page_keeps_filters_in_cursors(self):
+        response = self.client.get(reverse('payment_reports'), {'status': Payment.PENDING})
+        self.assertEqual(len(response.context['payments']), 2)
+        self.assertEqual(response.context['filter_query'], 'status=pending')
+        self.assertContains(response, f"?status=pending&after={response.context['next_cursor']}")
+
+        response = self.client.get(reverse('payment_reports'),
+                                   {'status': Payment.PENDING, 'after': response.context['next_cursor']})
+        self.assertEqual([p.status for p in response.context['payments']], [Payment.PENDING])
+        self.assertEqual(response.context['next_cursor'], '')
+
+
+@override_settings(SECURE_SSL_REDIRECT=False, DATABASE_ROUTERS=[])
+class PaymentSearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(User.objects.create_user(username='finance', password='secret-pass-123'))
+        self.jane = Payment.objects.create(amount=Decimal('10.00'), reference='payment-jane1', payer_name='Jane Wanjiru',
+                                           payer_email='jane@example.com', payer_phone='254712345678')
+        self.bob = Payment.objects.create(amount=Decimal('20.00'), reference='payment-bob01', checkout_id='INV-JANE42',
+                                          payer_name='Bob Otieno')
+        Payment.objects.create(amount=Decimal('30.00'), reference='payment-carol', payer_email='carol@example.com')
+
+    def test_matches_payer_fields_and_checkout_id(self):
+        def search(query):
+            return set(search_payments(Payment.objects.all(), query))
+
+        self.assertEqual(search('wanjiru'), {self.jane})
+        self.assertEqual(search('712345'), {self.jane})
+        self.assertEqual(search('jane'), {self.jane, self.bob})
+        self.assertEqual(search('jane otieno'), {self.bob})
+        self.assertEqual(search('ob'), {self.bob})
+        self.assertEqual(search('nobody'), set())
+
+    def test_index_follows_bulk_and_queryset_writes(self):
+        Payment.objects.filter(id=self.bob.id).update(payer_name='Robert Kamau')
+        Payment.objects.bulk_create([Payment(amount=Decimal('5.00'), reference='payment-kamau2')])
+        self.assertEqual({p.reference for p in search_payments(Payment.objects.all(), 'kamau')},
+                         {'payment-bob01', 'payment-kamau2'})
+        self.assertFalse(search_payments(Payment.objects.all(), 'otieno').exists())
+
+    @skipUnless(connection.vendor == 'sqlite', 'FTS5 index is SQLite only')
+    def test_uses_fts_index(self):
+        with CaptureQueriesContext(connection) as queries:
+            list(search_payments(Payment.objects.all(), 'wanjiru'))
+        self.assertIn('payment_search MATCH', queries[0]['sql'])
+
+    def test_ranked_results_are_paginated(self):
+        response = self.client.get(reverse('payment_search'), {'q': 'jane', 'page_size': 1})
+        data = response.json()
+        self.assertEqual(data['next_page'], 2)
+        self.assertEqual([row['reference'] for row in data['results']], ['payment-jane1'])
+
+        data = self.client.get(reverse('payment_search'), {'q': 'jane', 'page_size': 1, 'page': 2}).json()
+        self.assertEqual([row['reference'] for row in data['results']], ['payment-bob01'])
+        self.assertIsNone(data['next_page'])
+
+    def test_report_search_box_covers_payer_fields(self):
+        response = self.client.get(reverse('payment_reports'), {'search': 'carol@'})
+        self.assertEqual([p.reference for p in response.context['payments']], ['payment-carol'])
+        self.assertEqual(response.context['stats']['total_payments'], 1)
+
+
+class StubIntasendServerTests(TestCase):
+    def setUp(self):
+        self.server = StubIntasendServer(seed=1).start()
+        self.addCleanup(self.server.stop)
+        self.session = requests.Session()
+        self.addCleanup(self.session.close)
+
+    def call(self, endpoint, payload):
+        return self.session.post(f'{self.server.base_url}{endpoint}', json=payload, timeout=5)
+
+    def test_invoice_settles_after_delay(self):
+        self.server.settle_after = 0.2
+        invoice = self.call('checkout/', {'api_ref': 'payment-1', 'amount': 10}).json()
+        self.assertEqual(invoice['url'], f"{self.server.base_url}checkout/{invoice['id']}/")
+        self.assertEqual(self.call('payment/status/', {'invoice_id': invoice['id']}).json()['state'], 'PENDING')
+        time.sleep(0.25)
+        self.assertEqual(self.call('payment/status/', {'invoice_id': invoice['id']}).json()['state'], 'COMPLETE')
+        self.assertEqual(self.call('payment/status/', {'invoice_id': 'STUB-UNKNOWN'}).status_code, 400)
+
+    def test_injects_errors_and_failures(self):
+        self.server.error_rate = 1.0
+        self.assertEqual(self.call('checkout/', {'api_ref': 'payment-1'}).status_code, 500)
+        self.server.error_rate = 0.0
+        self.server.fail_rate = 1.0
+        invoice = self.call('checkout/', {'api_ref': 'payment-2'}).json()
+        self.assertEqual(self.server.invoice_state(invoice['id']), 'FAILED')
+
+
+@override_settings(INTASEND_TEST_MODE=False)
+class LoadTestCommandTests(TransactionTestCase):
+    def test_runs_payments_through_every_step(self):
+        out = io.StringIO()
+        call_command('loadtest', flows=4, rate=0, concurrency=2, latency=0, test_db=False, stdout=out)
+        output = out.getvalue()
+        for step in ('create_checkout', 'payment_callback', 'payment_status'):
+            self.assertRegex(output, rf'{step}\s+4\s+0\s')
+        self.assertIn('Final payment status: complete: 4', output)
+        self.assertEqual(Payment.objects.filter(status=Payment.COMPLETE, payment_method=Payment.MPESA).count(), 4)
+
+
+class PaymentMethodClassifierTests(TestCase):
+    TOKENS = [
+        ('M-PESA', Payment.MPESA), ('mpesa', Payment.MPESA), ('Visa', Payment.CARD),
+        ('CARD-PAYMENT', Payment.CARD), ('MasterCard', Payment.CARD), ('GOOGLE-PAY', Payment.GOOGLE_PAY),
+        ('gpay', Payment.GOOGLE_PAY), ('BANK-TRANSFER', Payment.BANK), ('PAYPAL', None), ('', None),
+    ]
+    PRIORITY = [Payment.MPESA, Payment.CARD, Payment.GOOGLE_PAY, Payment.BANK]
+
+    def expected_for_value(self, parts):
+        methods = [method for _, method in parts if method]
+        return min(methods, key=self.PRIORITY.index) if methods else None
+
+    def test_known_responses(self):
+        cases = [
+            ({'payment_method': 'M-PESA'}, Payment.MPESA),
+            ({'payment_method': 'visa', 'provider': 'MPESA'}, Payment.CARD),
+            ({'channel': 'mastercard'}, Payment.CARD),
+            ({'provider': 'GOOGLE-PAY'}, Payment.GOOGLE_PAY),
+            ({'provider': 'PAYPAL'}, Payment.OTHER),
+            ({'provider': None}, Payment.OTHER),
+            ({'state': 'COMPLETE', 'narrative': 'Paid by bank transfer'}, Payment.BANK),
+            ({'state': 'COMPLETE', 'invoice': {'provider': 'CARD'}}, Payment.UNKNOWN),
+            ({}, Payment.UNKNOWN),
+        ]
+        for response, expected in cases:
+            with self.subTest(response=response):
+                self.assertEqual(classify_payment_method(response), expected)
+
+    def test_random_corpus_matches_specification(self):
+        rng = random.Random(20240504)
+        fields = ['payment_method', 'channel', 'provider', 'state', 'narrative', 'account']
+        for _ in range(2000):
+            response = {}
+            values = {}
+            for field in rng.sample(fields, rng.randint(0, len(fields))):
+                parts = rng.sample(self.TOKENS, rng.randint(0, 3))
+                response[field] = ' '.join(token for token, _ in parts)
+                values[field] = self.expected_for_value(parts)
+
+            named = [field for field in ['payment_method', 'channel', 'provider'] if field in response]
+            if named:
+                expected = values[named[0]] or Payment.OTHER
+            else:
+                expected = next((values[field] for field in response if values[field]), Payment.UNKNOWN)
+            with self.subTest(response=response):
+                self.assertEqual(classify_payment_method(response), expected)
+
+
+@override_settings(INTASEND_TEST_MODE=False)
+class PaymentTransitionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.payment = Payment.objects.create(amount=Decimal('10.00'), checkout_id='INV-T')
+
+    def test_terminal_payment_is_not_overwritten(self):
+        stale = Payment.objects.get(id=self.payment.id)
+        self.assertTrue(transition_payment(self.payment, Payment.COMPLETE, Payment.CARD))
+        self.assertFalse(transition_payment(stale, Payment.FAILED))
+        self.assertEqual(stale.status, Payment.COMPLETE)
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, Payment.COMPLETE)
+        self.assertEqual(self.payment.payment_method, Payment.CARD)
+        self.assertEqual(PaymentDailyRollup.objects.get(status=Payment.COMPLETE).count, 1)
+        self.assertEqual(PaymentDailyRollup.objects.get(status=Payment.PENDING).count, 0)
+
+    def test_duplicate_callback_is_a_single_lookup(self):
+        service = fake_service({'state': 'COMPLETE'})
+        with mock.patch('payment.gateway.get_intasend_service', return_value=service):
+            reconcile_callback(find_payment('INV-T'), 'INV-T')
+            with self.assertNumQueries(1):
+                status = reconcile_callback(find_payment('INV-T'), 'INV-T', 'FAILED')
+        self.assertEqual(status, Payment.COMPLETE)
+        self.assertEqual(service.collect.status.call_count, 1)
+
+
+@override_settings(INTASEND_TEST_MODE=False)
+@skipUnless(connection.vendor == 'sqlite', 'SQLite tuning only')
+class SQLiteProfileTests(TestCase):
+    def test_pragmas_are_applied(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 20000)
+        self.assertEqual(connection.transaction_mode, 'IMMEDIATE')
+
+
+@skipUnless(REPORTS_DB in connections, 'No reports database configured')
+@override_settings(SECURE_SSL_REDIRECT=False)
+class ReportsRoutingTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(User.objects.create_user(username='finance', password='secret-pass-123'))
+        Payment.objects.create(amount=Decimal('10.00'), reference='payment-routed', status=Payment.COMPLETE)
+
+    def test_report_reads_use_reports_connection(self):
+        with CaptureQueriesContext(connections['default']) as default_queries, \
+                CaptureQueriesContext(connections[REPORTS_DB]) as report_queries:
+            response = self.client.get(reverse('payment_reports'))
+            export = self.client.get(reverse('payment_reports'), {'export': 'csv'})
+            export_body = b''.join(export.streaming_content)
+        self.assertContains(response, 'payment-routed')
+        self.assertIn(b'payment-routed', export_body)
+        self.assertTrue(any('payment_payment' in q['sql'] for q in report_queries.captured_queries))
+        # default only served the session and user
+        self.assertFalse(any('payment_' in q['sql'] for q in default_queries.captured_queries))
+
+    def test_export_command_reads_reports_connection(self):
+        Payment.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+        with tempfile.TemporaryDirectory() as directory, \
+                CaptureQueriesContext(connections['default']) as default_queries, \
+                CaptureQueriesContext(connections[REPORTS_DB]) as report_queries:
+            output = os.path.join(directory, 'payments.parquet')
+            call_command('export_payments', output, stdout=io.StringIO())
+            self.assertEqual(pq.read_table(output).column('reference').to_pylist(), ['payment-routed'])
+        self.assertTrue(any('payment_payment' in q['sql'] for q in report_queries.captured_queries))
+        self.assertFalse(any('payment_payment' in q['sql'] for q in default_queries.captured_queries))
+
+    def test_writes_and_other_reads_stay_on_default(self):
+        with reporting_reads():
+            payment = Payment.objects.get(reference='payment-routed')
+            self.assertEqual(payment._state.db, REPORTS_DB)
+            self.assertEqual(User.objects.all().db, 'default')
+            payment.payer_name = 'Routed'
+            payment.save()
+        self.assertEqual(Payment.objects.get().payer_name, 'Routed')
+        self.assertEqual(Payment.objects.all().db, 'default')
+
+
+@skipUnless(REPORTS_DB in connections and connection.vendor == 'sqlite', 'SQLite read-only reports only')
+@override_settings(SECURE_SSL_REDIRECT=False)
+class ReadOnlyReportsTests(TransactionTestCase):
+    """Reports through a separate ``mode=ro`` connection to the test database file, as configured in production.
+
+    The test runner makes ``reports`` a mirror of default (the same
+    connection), so swap in a real read-only one for these tests.
+    """
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(User.objects.create_user(username='finance', password='secret-pass-123'))
+        Payment.objects.create(amount=Decimal('10.00'), reference='payment-read-only', status=Payment.COMPLETE)
+        options = connection.settings_dict['OPTIONS']
+        self.reports = SQLiteDatabaseWrapper({
+            **connection.settings_dict,
+            'NAME': f"file:{connection.settings_dict['NAME']}?mode=ro",
+            'OPTIONS': {
+                'timeout': options['timeout'],
+                'init_command': options['init_command'].replace('PRAGMA journal_mode=WAL;', ''),
+            },
+        }, alias=REPORTS_DB)
+        mirror = connections[REPORTS_DB]
+        connections[REPORTS_DB] = self.reports
+        self.addCleanup(setattr, connections, REPORTS_DB, mirror)
+        self.addCleanup(self.reports.close)
+
+    def test_reports_read_committed_rows(self):
+        with CaptureQueriesContext(self.reports) as report_queries:
+            response = self.client.get(reverse('payment_reports'))
+        self.assertContains(response, 'payment-read-only')
+        self.assertTrue(any('payment_payment' in q['sql'] for q in report_queries.captured_queries))
+
+    def test_reports_connection_cannot_write(self):
+        with reporting_reads():
+            payment = Payment.objects.get(reference='payment-read-only')
+            self.assertEqual(payment._state.db, REPORTS_DB)
+            with self.assertRaisesMessage(OperationalError, 'readonly'):
+                Payment.objects.using(REPORTS_DB).update(payer_name='Lost')
+            # The router still sends the save to default
+            payment.payer_name = 'Saved'
+            payment.save()
+        self.assertEqual(Payment.objects.get().payer_name, 'Saved')
+
+
+class ConcurrentCallbackTests(TransactionTestCase):
+    CALLBACKS = 200
+
+    def test_parallel_callbacks_transition_once(self):
+        cache.clear()
+        payment = Payment.objects.create(amount=Decimal('10.00'), checkout_id='INV-RACE')
+        transitions = []
+        errors = []
+        start = threading.Barrier(20)
+
+        def callbacks(count):
+            try:
+                start.wait()
+                for _ in range(count):
+                    target = Payment.objects.get(id=payment.id)
+                    transitions.append(transition_payment(target, Payment.COMPLETE, Payment.MPESA))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=callbacks, args=(self.CALLBACKS // 20,)) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(transitions), self.CALLBACKS)
+        self.assertEqual(transitions.count(True), 1)
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, Payment.COMPLETE)
+        self.assertEqual(PaymentDailyRollup.objects.get(status=Payment.COMPLETE).count, 1)
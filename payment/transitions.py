@@ -0,0 +1,77 @@
+import logging
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Payment
+from .reports import bump_reports_generation
+from .rollups import apply_rollup_deltas, payment_deltas, rollup_state
+from .stream import publish_status_change
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = (Payment.COMPLETE, Payment.FAILED)
+
+
+def _conditional_update(payment, changes, retry=True):
+    """UPDATE the payment only if its status and method are still what we last saw.
+
+    On a miss the status and method are re-read and, with ``retry``, the
+    update is tried once more unless the payment has meanwhile reached a
+    terminal status. Returns True if the row was written.
+    """
+    for _ in range(2 if retry else 1):
+        old_state = rollup_state(payment)
+        with transaction.atomic():
+            updated = Payment.objects.filter(
+                id=payment.id, status=payment.status, payment_method=payment.payment_method
+            ).update(**changes)
+            if updated:
+                for field, value in changes.items():
+                    setattr(payment, field, value)
+                # Queryset updates skip the save signals, so keep the rollup in step here
+                new_state = rollup_state(payment)
+                apply_rollup_deltas(payment_deltas(old_state, new_state))
+                payment._rollup_state = new_state
+                bump_reports_generation()
+                if new_state['status'] != old_state['status']:
+                    publish_status_change(payment.id)
+                return True
+        payment.refresh_from_db(fields=['status', 'payment_method', 'completed_at'])
+        if payment.status in TERMINAL_STATUSES:
+            return False
+    return False
+
+
+def transition_payment(payment, new_status, payment_method=Payment.UNKNOWN):
+    """Move a pending payment to COMPLETE or FAILED exactly once.
+
+    The write is a conditional ``UPDATE ... WHERE status = 'pending'``, so when
+    callbacks and status checks race only the first one lands; the others
+    see the terminal status and do nothing. ``payment`` is updated in place.
+    Returns True if this call made the transition.
+    """
+    if payment.status in TERMINAL_STATUSES:
+        return False
+
+    now = timezone.now()
+    changes = {'status': new_status, 'updated_at': now}
+    if new_status == Payment.COMPLETE:
+        changes['completed_at'] = now
+    if payment_method != Payment.UNKNOWN:
+        changes['payment_method'] = payment_method
+
+    if _conditional_update(payment, changes):
+        logger.info(f"Payment {payment.id} moved to {new_status.upper()}")
+        return True
+    logger.info(f"Payment {payment.id} already {payment.status.upper()}, transition skipped")
+    return False
+
+
+def set_payment_method(payment, payment_method):
+    """Record the payment method if it is still unknown; returns True if it was written"""
+    if payment_method == Payment.UNKNOWN or payment.payment_method != Payment.UNKNOWN:
+        return False
+    # No retry: if the method was set meanwhile, the other writer's value stands
+    return _conditional_update(payment, {'payment_method': payment_method, 'updated_at': timezone.now()}, retry=False)
@@ -1,10 +1,22 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import async_views, views
+
+# Under an ASGI server the async views keep the worker free while Intasend responds
+gateway_views = async_views if settings.PAYMENT_ASYNC_VIEWS else views
 
 urlpatterns = [
     path('', views.home, name='home'),
-    path('checkout/', views.create_checkout, name='create_checkout'),
-    path('callback/', views.payment_callback, name='payment_callback'),
-    path('status/<int:payment_id>/', views.payment_status, name='payment_status'),
+    path('checkout/', gateway_views.create_checkout, name='create_checkout'),
+    path('checkout/bulk/', views.bulk_checkout, name='bulk_checkout'),
+    path('callback/', gateway_views.payment_callback, name='payment_callback'),
+    path('status/<int:payment_id>/', gateway_views.payment_status, name='payment_status'),
     path('reports/', views.payment_reports, name='payment_reports'),
-] 
\ No newline at end of file
+    path('reports/search/', views.payment_search, name='payment_search'),
+    path('reports/windows/', views.payment_windows, name='payment_windows'),
+    path('reports/export/', views.payment_export, name='payment_export'),
+]
+
+if settings.PAYMENT_STATUS_STREAM:
+    # Each open stream is a long-lived response; under WSGI it would hold a worker throughout
+    urlpatterns.append(path('status/<int:payment_id>/events/', async_views.payment_events, name='payment_events'))
@@ -1,27 +1,56 @@
+from asgiref.sync import iscoroutinefunction, sync_to_async
 from django.shortcuts import render, redirect
 from django.conf import settings
 from django.urls import reverse
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth import login, authenticate
 from django.contrib import messages
-from django.db.models import Sum
-import json
-import uuid
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.core.cache import cache
 import logging
-import csv
+import math
+from urllib.parse import urlencode
 from datetime import datetime, timedelta
-from intasend import APIService
+from .bulk import create_bulk_checkouts, parse_batch, summarize
+from .callbacks import (COMPLETE_STATES, FAILED_STATES, PENDING_STATES, enqueue_callback, find_payment,
+                        parse_status_response, reconcile_callback)
+from .breaker import GatewayUnavailable
+from .checkout import checkout_arguments, checkout_error, checkout_invoice_id, new_reference
+from .export import EXPORT_FORMATS, export_window, stream_payments_export
+from .gateway import circuit_breaker, gateway_available, get_cached_status, get_intasend_service
+from .metrics import REPORT_CACHE_LOOKUPS, render_metrics
 from .models import Payment
+from .routers import reporting_reads
+from .reports import keyset_page, payment_stats, report_cache_key, reports_generation, stream_payments_csv
+from .rollups import rollup_stats, start_of_day
+from .search import ranked_search, search_payments
+from .transitions import set_payment_method, transition_payment
+from .windows import WINDOWS, window_stats
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
+GATEWAY_UNAVAILABLE_MESSAGE = 'Payments are temporarily unavailable. Please try again in a few minutes.'
+CALLBACK_QUEUED_MESSAGE = 'Payment received and is being confirmed. Please check back shortly.'
+CALLBACK_UNAVAILABLE_MESSAGE = ("We can't reach the payment provider to confirm this payment right now. "
+                                "It will be confirmed once the provider is back.")
+
 # Custom decorator for payment-specific features
 def payment_login_required(function):
     """Custom login required decorator that adds a payment-specific message"""
+    if iscoroutinefunction(function):
+        async def async_wrapper(request, *args, **kwargs):
+            user = await request.auser()
+            if not user.is_authenticated:
+                await sync_to_async(messages.info)(request, "You need to login to access payment details and reports.")
+                return redirect(f"{settings.LOGIN_URL}?next={request.path}")
+            return await function(request, *args, **kwargs)
+        return async_wrapper
+
     def wrapper(request, *args, **kwargs):
         if not request.user.is_authenticated:
             messages.info(request, "You need to login to access payment details and reports.")
@@ -34,6 +63,13 @@ def home(request):
     sandbox_message = "Using Intasend SANDBOX mode - no real payments will be processed" if settings.INTASEND_TEST_MODE else ""
     return render(request, 'payment/home.html', {'sandbox_message': sandbox_message})
 
+def metrics(request):
+    """Prometheus metrics for this worker process; for the METRICS_TOKEN bearer or staff users"""
+    token_ok = settings.METRICS_TOKEN and request.headers.get('Authorization') == f"Bearer {settings.METRICS_TOKEN}"
+    if not (token_ok or request.user.is_staff):
+        return HttpResponse(status=403)
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 def register(request):
     """User registration view"""
     if request.method == 'POST':
@@ -49,6 +85,54 @@ def register(request):
         form = UserCreationForm()
     return render(request, 'payment/register.html', {'form': form})
 
+def form_checkout_arguments(request, amount, reference):
+    """Keyword arguments for ``collect.checkout`` from the payment form"""
+    return checkout_arguments(
+        amount, reference,
+        phone_number=request.POST.get('phone_number', ''),
+        email=request.POST.get('email', ''),
+        first_name=request.POST.get('first_name', ''),
+        last_name=request.POST.get('last_name', ''),
+        redirect_url=request.build_absolute_uri(reverse('payment_callback')),
+    )
+
+def callback_parameters(request):
+    """Checkout ID and status from a callback, accepting Intasend's different parameter names"""
+    # Check for different possible parameter names in both GET and POST
+    checkout_id = request.GET.get('invoice_id', '') or request.POST.get('invoice_id', '')
+    if not checkout_id:
+        checkout_id = request.GET.get('id', '') or request.POST.get('id', '')
+    if not checkout_id:
+        checkout_id = request.GET.get('checkout_id', '') or request.POST.get('checkout_id', '')
+        
+    status = request.GET.get('status', '') or request.POST.get('status', '')
+    if not status:
+        status = request.GET.get('state', '') or request.POST.get('state', '')
+    
+    # Handle sandbox mode - in sandbox, we'll simulate a successful payment
+    # if no clear status is provided
+    if settings.INTASEND_TEST_MODE and not status:
+        logger.info("Sandbox mode: simulating successful payment")
+        status = 'SUCCESS'
+    
+    return checkout_id, status
+
+def callback_result(payment, payment_status):
+    """Template context for the result page after a callback was reconciled"""
+    if payment_status in COMPLETE_STATES:
+        return {'success': True, 'message': 'Payment successful!', 'payment': payment}
+    elif payment_status in PENDING_STATES:
+        return {
+            'success': False,
+            'message': 'Payment is still pending. Please check back later.',
+            'payment': payment
+        }
+    return {
+        'success': False,
+        'message': f'Payment failed or was cancelled. Status: {payment_status}',
+        'payment': payment
+    }
+
 def create_checkout(request):
     """Create a checkout session with Intasend"""
     if request.method != 'POST':
@@ -59,91 +143,51 @@ def create_checkout(request):
         if amount <= 0:
             return render(request, 'payment/home.html', {'error': 'Please enter a valid amount'})
         
+        # Fail fast, before writing a payment, while Intasend is known to be down
+        if not gateway_available():
+            logger.warning("Intasend circuit open, refusing new checkout")
+            return render(request, 'payment/home.html', {'error': GATEWAY_UNAVAILABLE_MESSAGE}, status=503)
+        
         # Log the payment attempt
         logger.info(f"Processing payment attempt for amount: {amount}")
         logger.info(f"Using TEST MODE: {settings.INTASEND_TEST_MODE}")
         
-        # Create a payment record
+        # Generate the reference first so the row is written complete in one INSERT
+        reference = new_reference()
         payment = Payment.objects.create(
             amount=amount,
+            reference=reference,
             payer_phone=request.POST.get('phone_number', ''),
             payer_email=request.POST.get('email', ''),
             payer_name=f"{request.POST.get('first_name', '')} {request.POST.get('last_name', '')}".strip()
         )
         
-        # Generate a unique reference
-        reference = f"payment-{uuid.uuid4().hex[:8]}"
-        payment.reference = reference
-        payment.save()
-        
         logger.info(f"Created payment record with reference: {reference}")
         
-        # Initialize the Intasend API service
-        service = APIService(
-            publishable_key=settings.INTASEND_PUBLISHABLE_KEY,
-            token=settings.INTASEND_SECRET_KEY,
-            test=settings.INTASEND_TEST_MODE
-        )
-        
-        # Gather customer information
-        phone_number = request.POST.get('phone_number', '')
-        email = request.POST.get('email', '')
-        first_name = request.POST.get('first_name', '')
-        last_name = request.POST.get('last_name', '')
-        
-        # Ensure phone number has country code for sandbox
-        if settings.INTASEND_TEST_MODE and phone_number and not phone_number.startswith('+'):
-            if not phone_number.startswith('254'):
-                phone_number = '254' + phone_number.lstrip('0')
-                logger.info(f"Formatted phone number for sandbox: {phone_number}")
-        
-        # Log API call details
-        logger.info(f"Calling Intasend API with: phone={phone_number}, email={email}, amount={amount}, reference={reference}")
+        # Get the Intasend API service
+        service = get_intasend_service()
         
         # Create checkout using Intasend SDK
-        response = service.collect.checkout(
-            phone_number=phone_number,
-            email=email,
-            amount=amount,
-            currency="KES",
-            comment="Payment via Django app",
-            first_name=first_name,
-            last_name=last_name,
-            api_ref=reference,
-            redirect_url=request.build_absolute_uri(reverse('payment_callback'))
-        )
+        response = service.collect.checkout(**form_checkout_arguments(request, amount, reference))
         
         # Log the full response for debugging
-        logger.info(f"Checkout Response: {json.dumps(response, default=str)}")
+        logger.debug("Checkout response", extra={'event': 'gateway_response', 'payload': response})
         
         if 'url' in response:
             # Get the invoice ID from the response
-            invoice_id = None
-            if 'invoice' in response and isinstance(response['invoice'], dict):
-                invoice_id = response['invoice'].get('id', '')
-            elif 'id' in response:
-                invoice_id = response.get('id')
+            invoice_id = checkout_invoice_id(response)
                 
             if invoice_id:
-                payment.checkout_id = invoice_id
-                payment.save()
                 logger.info(f"Payment checkout created successfully: {invoice_id}")
             else:
                 logger.warning("No invoice ID found in response, using reference as checkout_id")
-                payment.checkout_id = reference
-                payment.save()
+            payment.checkout_id = invoice_id or reference
+            payment.save(update_fields=['checkout_id', 'updated_at'])
             
             # Redirect to Intasend checkout URL
             return redirect(response.get('url'))
         else:
-            error_msg = 'Failed to create payment session'
-            if 'errors' in response:
-                error_msg = f"API Error: {json.dumps(response['errors'])}"
-            elif 'message' in response:
-                error_msg = f"API Error: {response['message']}"
-            elif isinstance(response, dict):
-                error_msg = f"API Error: {json.dumps(response)}"
-                
+            error_msg = checkout_error(response)
             logger.error(f"Payment creation failed: {error_msg}")
             return render(request, 'payment/home.html', {'error': error_msg})
             
@@ -154,33 +198,68 @@ def create_checkout(request):
         logger.error(traceback.format_exc())
         return render(request, 'payment/home.html', {'error': error})
 
+@payment_login_required
+def bulk_checkout(request):
+    """Start checkouts for a CSV or JSON batch of payments; staff only"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST a CSV or JSON batch'}, status=405)
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Only staff can create bulk checkouts'}, status=403)
+
+    upload = request.FILES.get('file')
+    if upload:
+        data = upload.read().decode('utf-8-sig')
+        batch_format = 'json' if upload.name.lower().endswith('.json') else 'csv'
+    else:
+        data = request.body.decode('utf-8-sig')
+        batch_format = 'json' if request.content_type == 'application/json' else 'csv'
+
+    try:
+        rows = parse_batch(data, batch_format)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    if len(rows) > settings.BULK_CHECKOUT_MAX_ROWS:
+        return JsonResponse({
+            'error': f"Batch has {len(rows)} rows; the limit is {settings.BULK_CHECKOUT_MAX_ROWS}. "
+                     f"Use the bulk_checkout management command for larger batches."
+        }, status=400)
+
+    logger.info(f"Bulk checkout of {len(rows)} rows requested by {request.user.username}")
+    report = create_bulk_checkouts(
+        rows,
+        redirect_url=request.build_absolute_uri(reverse('payment_callback')),
+        concurrency=settings.BULK_CHECKOUT_CONCURRENCY,
+        rate=settings.BULK_CHECKOUT_RATE,
+    )
+    return JsonResponse({**summarize(report), 'rows': report})
+
+def callback_retry_after():
+    """Seconds a callback refused during an outage should wait before Intasend resends it"""
+    return str(max(1, math.ceil(circuit_breaker.retry_in() or settings.INTASEND_CIRCUIT_RESET_TIMEOUT)))
+
+def callback_unavailable(request):
+    """Retryable 503 for a callback that can't be verified while the circuit is open.
+
+    Without PAYMENT_CALLBACK_ASYNC there may be no worker to drain a queue,
+    so the callback is left for Intasend to resend instead.
+    """
+    response = render(request, 'payment/result.html', {'success': False, 'message': CALLBACK_UNAVAILABLE_MESSAGE},
+                      status=503)
+    response['Retry-After'] = callback_retry_after()
+    return response
+
 @csrf_exempt
 def payment_callback(request):
     """Handle the callback from Intasend after payment"""
     logger.info(f"Payment callback received: {request.method}")
-    logger.info(f"Callback GET parameters: {request.GET}")
-    logger.info(f"Callback POST parameters: {request.POST}")
+    logger.debug("Callback parameters", extra={
+        'event': 'callback_params', 'payload': {'GET': request.GET.dict(), 'POST': request.POST.dict()}
+    })
     
     if request.method == 'GET' or request.method == 'POST':
-        # Check for different possible parameter names in both GET and POST
-        checkout_id = request.GET.get('invoice_id', '') or request.POST.get('invoice_id', '')
-        if not checkout_id:
-            checkout_id = request.GET.get('id', '') or request.POST.get('id', '')
-        if not checkout_id:
-            checkout_id = request.GET.get('checkout_id', '') or request.POST.get('checkout_id', '')
-            
-        status = request.GET.get('status', '') or request.POST.get('status', '')
-        if not status:
-            status = request.GET.get('state', '') or request.POST.get('state', '')
-            
+        checkout_id, status = callback_parameters(request)
         logger.info(f"Processing callback for checkout ID: {checkout_id}, status: {status}")
         
-        # Handle sandbox mode - in sandbox, we'll simulate a successful payment
-        # if no clear status is provided
-        if settings.INTASEND_TEST_MODE and not status:
-            logger.info("Sandbox mode: simulating successful payment")
-            status = 'SUCCESS'
-        
         # If we still don't have a checkout ID, check if we can find a payment by reference
         if not checkout_id:
             reference = request.GET.get('reference', '') or request.POST.get('reference', '')
@@ -200,20 +279,16 @@ def payment_callback(request):
                 'message': 'Invalid request - missing checkout ID'
             })
         
+        # Fast-ack mode: persist the callback and let the worker talk to Intasend
+        if settings.PAYMENT_CALLBACK_ASYNC:
+            enqueue_callback(checkout_id, status, {**request.GET.dict(), **request.POST.dict()})
+            return render(request, 'payment/result.html', {'success': False, 'message': CALLBACK_QUEUED_MESSAGE})
+        if not gateway_available():
+            return callback_unavailable(request)
+        
         try:
             # Try to find the payment record
-            payment = None
-            try:
-                payment = Payment.objects.get(checkout_id=checkout_id)
-                logger.info(f"Found payment record by checkout_id: {payment.id}")
-            except Payment.DoesNotExist:
-                # Try to find by reference if checkout_id lookup fails
-                try:
-                    payment = Payment.objects.filter(reference=checkout_id).first()
-                    if payment:
-                        logger.info(f"Found payment record by reference: {payment.id}")
-                except Exception:
-                    pass
+            payment = find_payment(checkout_id)
             
             if not payment:
                 logger.error(f"Payment record not found for checkout ID: {checkout_id}")
@@ -222,132 +297,12 @@ def payment_callback(request):
                     'message': f'Payment record not found for ID: {checkout_id}'
                 })
             
-            # Initialize the Intasend API service to check status
-            service = APIService(
-                publishable_key=settings.INTASEND_PUBLISHABLE_KEY,
-                token=settings.INTASEND_SECRET_KEY,
-                test=settings.INTASEND_TEST_MODE
-            )
-            
-            payment_status = None
-            payment_method = Payment.UNKNOWN
-            
-            # Get payment status from Intasend
-            try:
-                logger.info(f"Checking payment status with Intasend for invoice ID: {checkout_id}")
-                status_response = service.collect.status(invoice_id=checkout_id)
-                logger.info(f"Status Response: {json.dumps(status_response, default=str)}")
-                
-                # Extract payment status - handle different response formats
-                if 'state' in status_response:
-                    payment_status = status_response.get('state', '').lower()
-                elif 'status' in status_response:
-                    payment_status = status_response.get('status', '').lower()
-                
-                # Try to extract payment method from response
-                if 'payment_method' in status_response:
-                    method = status_response.get('payment_method', '').lower()
-                    if 'mpesa' in method:
-                        payment_method = Payment.MPESA
-                    elif 'card' in method or 'visa' in method or 'mastercard' in method:
-                        payment_method = Payment.CARD
-                    elif 'google' in method or 'gpay' in method:
-                        payment_method = Payment.GOOGLE_PAY
-                    elif 'bank' in method:
-                        payment_method = Payment.BANK
-                    else:
-                        payment_method = Payment.OTHER
-                
-                # Alternatively check channel info
-                elif 'channel' in status_response:
-                    channel = status_response.get('channel', '').lower()
-                    if 'mpesa' in channel:
-                        payment_method = Payment.MPESA
-                    elif 'card' in channel or 'visa' in channel or 'mastercard' in channel:
-                        payment_method = Payment.CARD
-                    elif 'google' in channel:
-                        payment_method = Payment.GOOGLE_PAY
-                    elif 'bank' in channel:
-                        payment_method = Payment.BANK
-                    else:
-                        payment_method = Payment.OTHER
-                
-                # Check if provider field exists and contains card info
-                elif 'provider' in status_response:
-                    provider = status_response.get('provider', '').lower()
-                    if 'mpesa' in provider:
-                        payment_method = Payment.MPESA
-                    elif 'card' in provider or 'visa' in provider or 'mastercard' in provider:
-                        payment_method = Payment.CARD
-                    elif 'google' in provider:
-                        payment_method = Payment.GOOGLE_PAY
-                    elif 'bank' in provider:
-                        payment_method = Payment.BANK
-                    else:
-                        payment_method = Payment.OTHER
-                
-                # Direct check for card payment indicators in any field
-                else:
-                    for key, value in status_response.items():
-                        if isinstance(value, str):
-                            value_lower = value.lower()
-                            if 'card' in value_lower or 'visa' in value_lower or 'mastercard' in value_lower:
-                                payment_method = Payment.CARD
-                                break
-                            elif 'mpesa' in value_lower:
-                                payment_method = Payment.MPESA
-                                break
-                            elif 'google' in value_lower or 'gpay' in value_lower:
-                                payment_method = Payment.GOOGLE_PAY
-                                break
-                
-            except Exception as e:
-                logger.error(f"Error getting status from API: {str(e)}")
-            
-            logger.info(f"Detected payment status from API: {payment_status}")
-            logger.info(f"Detected payment method: {payment_method}")
-            
-            # If no status from API, use the one from URL parameters
-            if not payment_status and status:
-                payment_status = status.lower()
-                logger.info(f"Using status from URL: {payment_status}")
-            
-            # Handle sandbox mode with missing status
-            if settings.INTASEND_TEST_MODE and not payment_status:
-                logger.info("Sandbox mode: No status detected, simulating success")
-                payment_status = 'success'
-            
-            # Update payment method
-            payment.payment_method = payment_method
-            
-            if payment_status in ['complete', 'success', 'paid']:
-                payment.status = Payment.COMPLETE
-                # Set completion timestamp
-                import datetime
-                payment.completed_at = datetime.datetime.now()
-                payment.save()
-                logger.info(f"Payment marked as COMPLETE")
-                return render(request, 'payment/result.html', {
-                    'success': True,
-                    'message': 'Payment successful!',
-                    'payment': payment
-                })
-            elif payment_status in ['pending', 'processing']:
-                logger.info(f"Payment is still PENDING")
-                return render(request, 'payment/result.html', {
-                    'success': False,
-                    'message': 'Payment is still pending. Please check back later.',
-                    'payment': payment
-                })
-            else:
-                payment.status = Payment.FAILED
-                payment.save()
-                logger.info(f"Payment marked as FAILED")
-                return render(request, 'payment/result.html', {
-                    'success': False,
-                    'message': f'Payment failed or was cancelled. Status: {payment_status}',
-                    'payment': payment
-                })
+            # Check the status with Intasend and update the payment
+            payment_status = reconcile_callback(payment, checkout_id, status)
+            return render(request, 'payment/result.html', callback_result(payment, payment_status))
+        
+        except GatewayUnavailable:
+            return callback_unavailable(request)
                 
         except Exception as e:
             logger.error(f"Error processing callback: {str(e)}")
@@ -367,6 +322,7 @@ def payment_status(request, payment_id):
     try:
         payment = Payment.objects.get(id=payment_id)
         logger.info(f"Checking status for payment ID: {payment_id}")
+        gateway_unavailable = False
         
         # Handle sandbox mode - in sandbox, if status is still pending after some time, 
         # we'll simulate a successful payment
@@ -376,101 +332,45 @@ def payment_status(request, payment_id):
             time_threshold = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=1)
             if payment.created_at < time_threshold:
                 logger.info(f"Sandbox mode: Simulating success for older pending payment")
-                payment.status = Payment.COMPLETE
-                payment.save()
+                transition_payment(payment, Payment.COMPLETE)
                 return render(request, 'payment/status.html', {'payment': payment, 'sandbox_mode': True})
         
-        # Initialize the Intasend API service
-        service = APIService(
-            publishable_key=settings.INTASEND_PUBLISHABLE_KEY,
-            token=settings.INTASEND_SECRET_KEY,
-            test=settings.INTASEND_TEST_MODE
-        )
-        
-        # Get updated status if we have a checkout_id
-        if payment.checkout_id:
+        # Get updated status if we have a checkout_id and the payment can still change
+        if payment.checkout_id and payment.status == Payment.PENDING:
             try:
                 logger.info(f"Checking payment status with Intasend for checkout ID: {payment.checkout_id}")
-                status_response = service.collect.status(invoice_id=payment.checkout_id)
-                logger.info(f"Status Response: {json.dumps(status_response, default=str)}")
+                status_response = get_cached_status(payment.checkout_id)
+                logger.debug("Status response", extra={'event': 'gateway_response', 'payload': status_response})
                 
-                payment_status = None
-                if 'state' in status_response:
-                    payment_status = status_response.get('state', '').lower()
-                elif 'status' in status_response:
-                    payment_status = status_response.get('status', '').lower()
-                    
+                payment_status, payment_method = parse_status_response(status_response)
                 logger.info(f"Detected payment status: {payment_status}")
                 
-                # Update payment method if still unknown or if we have better information
-                if payment.payment_method == Payment.UNKNOWN:
-                    payment_method = Payment.UNKNOWN
-                    
-                    # Try to extract payment method from response
-                    if 'payment_method' in status_response:
-                        method = status_response.get('payment_method', '').lower()
-                        if 'mpesa' in method:
-                            payment_method = Payment.MPESA
-                        elif 'card' in method:
-                            payment_method = Payment.CARD
-                        elif 'google' in method or 'gpay' in method:
-                            payment_method = Payment.GOOGLE_PAY
-                        elif 'bank' in method:
-                            payment_method = Payment.BANK
-                        else:
-                            payment_method = Payment.OTHER
-                    
-                    # Alternatively check channel info
-                    elif 'channel' in status_response:
-                        channel = status_response.get('channel', '').lower()
-                        if 'mpesa' in channel:
-                            payment_method = Payment.MPESA
-                        elif 'card' in channel:
-                            payment_method = Payment.CARD
-                        elif 'google' in channel:
-                            payment_method = Payment.GOOGLE_PAY
-                        elif 'bank' in channel:
-                            payment_method = Payment.BANK
-                        else:
-                            payment_method = Payment.OTHER
-                    
-                    # Check if provider field exists and contains card info
-                    elif 'provider' in status_response:
-                        provider = status_response.get('provider', '').lower()
-                        if 'mpesa' in provider:
-                            payment_method = Payment.MPESA
-                        elif 'card' in provider or 'visa' in provider or 'mastercard' in provider:
-                            payment_method = Payment.CARD
-                        elif 'google' in provider:
-                            payment_method = Payment.GOOGLE_PAY
-                        elif 'bank' in provider:
-                            payment_method = Payment.BANK
-                        
-                    # If we determined a payment method, update it
-                    if payment_method != Payment.UNKNOWN:
-                        logger.info(f"Updating payment method to: {payment_method}")
-                        payment.payment_method = payment_method
-                        payment.save()
-                
-                if payment_status in ['complete', 'success', 'paid']:
-                    if payment.status != Payment.COMPLETE:
-                        payment.status = Payment.COMPLETE
-                        payment.save()
-                        logger.info(f"Updated payment to COMPLETE")
-                elif payment_status in ['failed', 'cancelled', 'rejected']:
-                    if payment.status != Payment.FAILED:
-                        payment.status = Payment.FAILED
-                        payment.save()
-                        logger.info(f"Updated payment to FAILED")
+                if payment_status in COMPLETE_STATES:
+                    transition_payment(payment, Payment.COMPLETE, payment_method)
+                elif payment_status in FAILED_STATES:
+                    transition_payment(payment, Payment.FAILED, payment_method)
+                else:
+                    # Update payment method if still unknown and the response names one
+                    set_payment_method(payment, payment_method)
+            except GatewayUnavailable as e:
+                # Degraded mode: show the status we have without waiting on Intasend
+                logger.warning(f"Showing stored status for payment {payment_id}: {str(e)}")
+                gateway_unavailable = True
             except Exception as e:
                 logger.error(f"Error checking payment status: {str(e)}")
         
-        return render(request, 'payment/status.html', {'payment': payment, 'sandbox_mode': settings.INTASEND_TEST_MODE})
+        return render(request, 'payment/status.html', {
+            'payment': payment,
+            'sandbox_mode': settings.INTASEND_TEST_MODE,
+            'gateway_unavailable': gateway_unavailable,
+            'status_stream': settings.PAYMENT_STATUS_STREAM,
+        })
     except Payment.DoesNotExist:
         logger.error(f"Payment record not found for ID: {payment_id}")
         return redirect('home')
 
 @payment_login_required
+@reporting_reads()
 def payment_reports(request):
     """View for displaying and filtering payment reports"""
     # Get filter parameters
@@ -481,9 +381,12 @@ def payment_reports(request):
     search = request.GET.get('search', '')
     
     # Base queryset
-    payments = Payment.objects.all().order_by('-created_at')
+    payments = Payment.objects.all().order_by('-created_at', '-id')
     
     # Apply filters
+    date_from_obj = None
+    date_to_obj = None
+    
     if status:
         payments = payments.filter(status=status)
     
@@ -492,90 +395,161 @@ def payment_reports(request):
     
     if date_from:
         try:
-            date_from_obj = datetime.strptime(date_from, '%Y-%m-%d')
-            payments = payments.filter(created_at__gte=date_from_obj)
+            date_from_obj = datetime.strptime(date_from, '%Y-%m-%d').date()
+            payments = payments.filter(created_at__gte=start_of_day(date_from_obj))
         except (ValueError, TypeError):
-            pass
+            date_from_obj = None
     
     if date_to:
         try:
-            date_to_obj = datetime.strptime(date_to, '%Y-%m-%d')
+            date_to_obj = datetime.strptime(date_to, '%Y-%m-%d').date()
             # Add one day to include the end date in the range
             date_to_obj = date_to_obj + timedelta(days=1)
-            payments = payments.filter(created_at__lt=date_to_obj)
+            payments = payments.filter(created_at__lt=start_of_day(date_to_obj))
         except (ValueError, TypeError):
-            pass
+            date_to_obj = None
     
     if search:
-        payments = payments.filter(reference__icontains=search) | payments.filter(checkout_id__icontains=search)
-    
-    # Calculate statistics
-    total_payments = payments.count()
-    successful_payments = payments.filter(status=Payment.COMPLETE).count()
-    pending_payments = payments.filter(status=Payment.PENDING).count()
-    failed_payments = payments.filter(status=Payment.FAILED).count()
-    
-    total_amount = payments.filter(status=Payment.COMPLETE).aggregate(Sum('amount'))['amount__sum'] or 0
-    
-    # Calculate success rate and average transaction
-    success_rate = 0
-    avg_transaction = 0
+        payments = search_payments(payments, search)
     
-    if total_payments > 0:
-        success_rate = int((successful_payments / total_payments) * 100)
+    # Check if export to CSV is requested
+    if request.GET.get('export') == 'csv':
+        # Stream the rows so memory stays flat however large the export is; pin the
+        # reports database now since the rows are read after the view returns
+        response = StreamingHttpResponse(stream_payments_csv(payments.using(payments.db)), content_type='text/csv')
+        response['Content-Disposition'] = f'attachment; filename="payments-report-{timezone.localdate().strftime("%Y%m%d")}.csv"'
+        return response
     
-    if successful_payments > 0:
-        avg_transaction = float(total_amount) / successful_payments
+    try:
+        page_size = int(request.GET.get('page_size', settings.PAYMENT_REPORTS_PAGE_SIZE))
+    except (ValueError, TypeError):
+        page_size = settings.PAYMENT_REPORTS_PAGE_SIZE
+    page_size = max(1, min(page_size, settings.PAYMENT_REPORTS_MAX_PAGE_SIZE))
+    after = request.GET.get('after', '')
+    before = request.GET.get('before', '')
     
-    # Last 7 days stats
-    seven_days_ago = datetime.now() - timedelta(days=7)
-    payments_7days = payments.filter(created_at__gte=seven_days_ago)
-    total_7days = payments_7days.filter(status=Payment.COMPLETE).aggregate(Sum('amount'))['amount__sum'] or 0
-    count_7days = payments_7days.filter(status=Payment.COMPLETE).count()
+    filters = {
+        'status': status,
+        'payment_method': payment_method,
+        'date_from': date_from,
+        'date_to': date_to,
+        'search': search,
+    }
+    # Query string that carries the active filters into export and paging links
+    filter_params = {key: value for key, value in filters.items() if value}
+    if page_size != settings.PAYMENT_REPORTS_PAGE_SIZE:
+        filter_params['page_size'] = page_size
     
-    # Check if export to CSV is requested
-    if request.GET.get('export') == 'csv':
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = f'attachment; filename="payments-report-{datetime.now().strftime("%Y%m%d")}.csv"'
-        
-        writer = csv.writer(response)
-        writer.writerow(['Reference', 'Amount', 'Currency', 'Method', 'Status', 'Created Date', 'Completed Date', 'Customer'])
-        
-        for payment in payments:
-            writer.writerow([
-                payment.reference,
-                payment.amount,
-                payment.currency,
-                payment.get_payment_method_display(),
-                payment.get_status_display(),
-                payment.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-                payment.completed_at.strftime('%Y-%m-%d %H:%M:%S') if payment.completed_at else 'N/A',
-                payment.payer_name or payment.payer_email or payment.payer_phone or 'Unknown'
-            ])
+    # Statistics and the table page are shared between users with the same
+    # filters until a payment changes (which bumps the generation)
+    cache_ttl = settings.PAYMENT_REPORTS_CACHE_TTL
+    data = None
+    if cache_ttl:
+        cache_key = report_cache_key({**filter_params, 'after': after, 'before': before}, reports_generation())
+        data = cache.get(cache_key)
+        REPORT_CACHE_LOOKUPS.inc(('miss' if data is None else 'hit',))
+    if data is None:
+        # Calculate dashboard statistics from the daily rollup when the filters map
+        # onto its buckets, otherwise in a single aggregate query over raw payments
+        if search or not settings.PAYMENT_REPORTS_USE_ROLLUP:
+            stats = payment_stats(payments)
+        else:
+            stats = rollup_stats(payments, status, payment_method, date_from_obj, date_to_obj)
         
-        return response
+        # Fetch only the requested page of the table, by keyset cursor
+        page, next_cursor, previous_cursor = keyset_page(payments, page_size, after=after, before=before)
+        data = {'payments': page, 'next_cursor': next_cursor, 'previous_cursor': previous_cursor, 'stats': stats}
+        if cache_ttl:
+            cache.set(cache_key, data, cache_ttl)
     
     # Prepare context with filters and statistics
     context = {
-        'payments': payments,
-        'filters': {
-            'status': status,
-            'payment_method': payment_method,
-            'date_from': date_from,
-            'date_to': date_to,
-            'search': search,
-        },
-        'stats': {
-            'total_payments': total_payments,
-            'successful_payments': successful_payments,
-            'pending_payments': pending_payments,
-            'failed_payments': failed_payments,
-            'total_amount': total_amount,
-            'total_7days': total_7days,
-            'count_7days': count_7days,
-            'success_rate': success_rate,
-            'avg_transaction': avg_transaction,
-        }
+        'filters': filters,
+        'filter_query': urlencode(filter_params),
+        **data,
     }
     
     return render(request, 'payment/reports.html', context)
+
+@payment_login_required
+@reporting_reads()
+def payment_export(request):
+    """Stream payments as Parquet or an Arrow IPC file (?format=parquet|arrow&since=<ISO timestamp>).
+
+    The ``X-Export-Watermark`` response header is the ``since`` to send
+    next time to fetch only the payments changed in between.
+    """
+    export_format = request.GET.get('format', 'parquet')
+    if export_format not in EXPORT_FORMATS:
+        return JsonResponse({'error': f"format must be one of {', '.join(EXPORT_FORMATS)}"}, status=400)
+    since = None
+    if request.GET.get('since'):
+        since = parse_datetime(request.GET['since'])
+        if since is None:
+            return JsonResponse({'error': 'since must be an ISO 8601 timestamp'}, status=400)
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since)
+
+    payments, until = export_window(Payment.objects.all(), since)
+    content_type, extension = EXPORT_FORMATS[export_format]
+    # Pin the reports database now since the rows are read after the view returns
+    response = StreamingHttpResponse(stream_payments_export(payments.using(payments.db), export_format),
+                                     content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="payments-{until.strftime("%Y%m%dT%H%M%S")}.{extension}"'
+    response['X-Export-Watermark'] = until.isoformat()
+    return response
+
+@payment_login_required
+@reporting_reads()
+def payment_windows(request):
+    """Completed payment totals over trailing windows (?window=1h|24h|7d|30d, default all of them)"""
+    payment_method = request.GET.get('payment_method', '')
+    window = request.GET.get('window', '')
+    if window and window not in WINDOWS:
+        return JsonResponse({'error': f"window must be one of {', '.join(WINDOWS)}"}, status=400)
+    now = timezone.now()
+    windows = {}
+    for name in [window] if window else WINDOWS:
+        stats = window_stats(WINDOWS[name], payment_method, now)
+        windows[name] = {
+            'start': stats['start'].isoformat(),
+            'end': stats['end'].isoformat(),
+            'count': stats['count'],
+            'amount': str(stats['amount']),
+            'methods': {method: {'count': totals['count'], 'amount': str(totals['amount'])}
+                        for method, totals in stats['methods'].items()},
+        }
+    return JsonResponse({'payment_method': payment_method, 'windows': windows})
+
+@payment_login_required
+@reporting_reads()
+def payment_search(request):
+    """Payments matching ?q= across reference, checkout ID and payer details, best match first"""
+    query = request.GET.get('q', '').strip()
+    try:
+        page = max(1, int(request.GET.get('page', 1)))
+        page_size = int(request.GET.get('page_size', settings.PAYMENT_REPORTS_PAGE_SIZE))
+    except (ValueError, TypeError):
+        return JsonResponse({'error': 'page and page_size must be integers'}, status=400)
+    page_size = max(1, min(page_size, settings.PAYMENT_REPORTS_MAX_PAGE_SIZE))
+
+    results, has_next = ranked_search(query, page, page_size) if query else ([], False)
+    return JsonResponse({
+        'query': query,
+        'page': page,
+        'next_page': page + 1 if has_next else None,
+        'results': [{
+            'id': payment.id,
+            'reference': payment.reference,
+            'checkout_id': payment.checkout_id,
+            'amount': str(payment.amount),
+            'currency': payment.currency,
+            'status': payment.status,
+            'payment_method': payment.payment_method,
+            'payer_name': payment.payer_name,
+            'payer_email': payment.payer_email,
+            'payer_phone': payment.payer_phone,
+            'created_at': payment.created_at.isoformat(),
+            'rank': payment.search_rank,
+        } for payment in results],
+    })
@@ -0,0 +1,90 @@
+import datetime
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import Q, Sum
+from django.utils import timezone
+
+from .models import PaymentWindowBucket
+
+ONE_HOUR = datetime.timedelta(hours=1)
+SEVEN_DAYS = datetime.timedelta(days=7)
+
+# Trailing windows offered by the reports windows endpoint
+WINDOWS = {
+    '1h': ONE_HOUR,
+    '24h': datetime.timedelta(hours=24),
+    '7d': SEVEN_DAYS,
+    '30d': datetime.timedelta(days=30),
+}
+
+
+def bucket_start(moment, resolution):
+    """Start (in UTC) of the minute or hour bucket containing ``moment``"""
+    moment = moment.astimezone(datetime.timezone.utc).replace(second=0, microsecond=0)
+    if resolution == PaymentWindowBucket.HOUR:
+        moment = moment.replace(minute=0)
+    return moment
+
+
+def minute_retention_start(now=None):
+    """Oldest hour still kept in minute buckets"""
+    retention = datetime.timedelta(days=settings.PAYMENT_WINDOW_MINUTE_RETENTION_DAYS)
+    return bucket_start((now or timezone.now()) - retention, PaymentWindowBucket.HOUR)
+
+
+def window_bounds(window, now=None):
+    """[start, end) of the trailing ``window`` ending with the current minute.
+
+    Windows reaching back past the minute bucket retention start on the hour.
+    """
+    now = now or timezone.now()
+    end = bucket_start(now, PaymentWindowBucket.MINUTE) + datetime.timedelta(minutes=1)
+    start = end - window
+    if start < minute_retention_start(now):
+        start = bucket_start(start, PaymentWindowBucket.HOUR)
+    return start, end
+
+
+def window_stats(window, payment_method='', now=None):
+    """Completed payment count and amount over a trailing window, per method and overall.
+
+    Reads whole hours from hour buckets and the partial hours at either end
+    from minute buckets, so the cost depends on the window's length in
+    buckets, never on the number of payments.
+    """
+    start, end = window_bounds(window, now)
+    first_hour = bucket_start(start, PaymentWindowBucket.HOUR)
+    if first_hour < start:
+        first_hour += ONE_HOUR
+    last_hour = bucket_start(end, PaymentWindowBucket.HOUR)
+    minutes = Q(resolution=PaymentWindowBucket.MINUTE)
+    if first_hour < last_hour:
+        buckets = (
+            (minutes & Q(start__gte=start, start__lt=first_hour))
+            | Q(resolution=PaymentWindowBucket.HOUR, start__gte=first_hour, start__lt=last_hour)
+            | (minutes & Q(start__gte=last_hour, start__lt=end))
+        )
+    else:
+        buckets = minutes & Q(start__gte=start, start__lt=end)
+    rows = PaymentWindowBucket.objects.filter(buckets)
+    if payment_method:
+        rows = rows.filter(payment_method=payment_method)
+    totals = rows.values('payment_method').annotate(total_count=Sum('count'), total_amount=Sum('amount'))
+
+    stats = {'start': start, 'end': end, 'count': 0, 'amount': Decimal('0'), 'methods': {}}
+    for row in totals.order_by('payment_method'):
+        if not row['total_count']:
+            continue
+        stats['methods'][row['payment_method']] = {'count': row['total_count'], 'amount': row['total_amount']}
+        stats['count'] += row['total_count']
+        stats['amount'] += row['total_amount']
+    return stats
+
+
+def prune_window_buckets():
+    """Delete minute buckets past PAYMENT_WINDOW_MINUTE_RETENTION_DAYS; returns how many"""
+    deleted, _ = PaymentWindowBucket.objects.filter(
+        resolution=PaymentWindowBucket.MINUTE, start__lt=minute_retention_start()
+    ).delete()
+    return deleted